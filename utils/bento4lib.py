@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+__author__    = 'Gilles Boccon-Gibod (bok@bok.net)'
+__copyright__ = 'Copyright 2011-2013 Axiomatic Systems, LLC.'
+
+###
+# In-process access to the Bento4 shared library (libBento4C) through ctypes.
+# The library is used to open files and enumerate their tracks and sample
+# descriptions. The C API does not export movie fragments, so fragments are
+# iterated by reading the 'moof' box headers directly.
+
+import sys
+import os.path as path
+import ctypes
+import struct
+import io
+
+AP4_FILE_BYTE_STREAM_MODE_READ = 0
+
+AP4_TRACK_TYPES = {
+    1: 'Audio',
+    2: 'Video',
+    3: 'System',
+    4: 'Hint',
+    5: 'Text',
+    6: 'JPEG',
+    7: 'RTP',
+    8: 'Subtitles'
+}
+
+AP4_SAMPLE_DESCRIPTION_TYPE_PROTECTED = 2
+
+AP4_TRUN_FLAG_DATA_OFFSET_PRESENT                    = 0x0001
+AP4_TRUN_FLAG_FIRST_SAMPLE_FLAGS_PRESENT             = 0x0004
+AP4_TRUN_FLAG_SAMPLE_DURATION_PRESENT                = 0x0100
+AP4_TRUN_FLAG_SAMPLE_SIZE_PRESENT                    = 0x0200
+AP4_TRUN_FLAG_SAMPLE_FLAGS_PRESENT                   = 0x0400
+AP4_TRUN_FLAG_SAMPLE_COMPOSITION_TIME_OFFSET_PRESENT = 0x0800
+AP4_TFHD_FLAG_BASE_DATA_OFFSET_PRESENT               = 0x0001
+AP4_TFHD_FLAG_SAMPLE_DESCRIPTION_INDEX_PRESENT       = 0x0002
+AP4_TFHD_FLAG_DEFAULT_SAMPLE_DURATION_PRESENT        = 0x0008
+
+# container boxes, with the size of the fields preceding their children
+CONTAINER_HEADER_SIZES = {
+    'moov': 0, 'trak': 0, 'mdia': 0, 'minf': 0, 'stbl': 0, 'mvex': 0,
+    'moof': 0, 'traf': 0, 'sinf': 0, 'schi': 0,
+    'stsd': 8, 'encv': 78, 'enca': 28
+}
+
+if sys.platform.startswith('darwin'):
+    BENTO4_LIBRARY_NAME = 'libBento4C.dylib'
+elif sys.platform.startswith('win'):
+    BENTO4_LIBRARY_NAME = 'Bento4C.dll'
+else:
+    BENTO4_LIBRARY_NAME = 'libBento4C.so'
+
+def FourCC(value):
+    return struct.pack('>I', value)
+
+def HexBytes(data):
+    return '['+' '.join(['%02x' % ord(x) for x in data])+']'
+
+class Bento4Lib:
+    def __init__(self, library_path):
+        self.library_path = library_path
+        self.lib = ctypes.CDLL(library_path)
+
+        # declare the prototypes of the functions we use
+        P = ctypes.c_void_p
+        self.declare('AP4_FileByteStream_Create', P, [ctypes.c_char_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int)])
+        self.declare('AP4_ByteStream_Release', None, [P])
+        self.declare('AP4_File_FromStream', P, [P, ctypes.c_int])
+        self.declare('AP4_File_Destroy', None, [P])
+        self.declare('AP4_File_GetMovie', P, [P])
+        self.declare('AP4_Movie_GetTrackCount', ctypes.c_uint, [P])
+        self.declare('AP4_Movie_GetTrackByIndex', P, [P, ctypes.c_uint])
+        self.declare('AP4_Track_GetId', ctypes.c_uint, [P])
+        self.declare('AP4_Track_GetType', ctypes.c_int, [P])
+        self.declare('AP4_Track_GetLanguage', ctypes.c_char_p, [P])
+        self.declare('AP4_Track_GetMediaTimeScale', ctypes.c_uint, [P])
+        self.declare('AP4_Track_GetSampleDescription', P, [P, ctypes.c_uint])
+        self.declare('AP4_SampleDescription_GetType', ctypes.c_int, [P])
+        self.declare('AP4_SampleDescription_GetFormat', ctypes.c_uint, [P])
+        self.declare('AP4_SampleDescription_AsVideo', P, [P])
+        self.declare('AP4_SampleDescription_AsAudio', P, [P])
+        self.declare('AP4_SampleDescription_AsAvc', P, [P])
+        self.declare('AP4_SampleDescription_AsMpeg', P, [P])
+        self.declare('AP4_SampleDescription_AsMpegAudio', P, [P])
+        self.declare('AP4_ProtectedSampleDescription_GetOriginalSampleDescription', P, [P])
+        self.declare('AP4_VideoSampleDescription_GetWidth', ctypes.c_ushort, [P])
+        self.declare('AP4_VideoSampleDescription_GetHeight', ctypes.c_ushort, [P])
+        self.declare('AP4_AudioSampleDescription_GetSampleRate', ctypes.c_uint, [P])
+        self.declare('AP4_AudioSampleDescription_GetChannelCount', ctypes.c_ushort, [P])
+        self.declare('AP4_AvcSampleDescription_GetProfile', ctypes.c_ubyte, [P])
+        self.declare('AP4_AvcSampleDescription_GetProfileCompatibility', ctypes.c_ubyte, [P])
+        self.declare('AP4_AvcSampleDescription_GetLevel', ctypes.c_ubyte, [P])
+        self.declare('AP4_AvcSampleDescription_GetSequenceParameterCount', ctypes.c_uint, [P])
+        self.declare('AP4_AvcSampleDescription_GetSequenceParameter', P, [P, ctypes.c_uint])
+        self.declare('AP4_AvcSampleDescription_GetPictureParameterCount', ctypes.c_uint, [P])
+        self.declare('AP4_AvcSampleDescription_GetPictureParameter', P, [P, ctypes.c_uint])
+        self.declare('AP4_MpegSampleDescription_GetObjectTypeId', ctypes.c_ubyte, [P])
+        self.declare('AP4_MpegSampleDescription_GetDecoderInfo', P, [P])
+        self.declare('AP4_MpegAudioSampleDescription_GetMpeg4AudioObjectType', ctypes.c_ubyte, [P])
+        self.declare('AP4_DataBuffer_GetData', P, [P])
+        self.declare('AP4_DataBuffer_GetDataSize', ctypes.c_uint, [P])
+
+    def declare(self, name, restype, argtypes):
+        function = getattr(self.lib, name)
+        function.restype  = restype
+        function.argtypes = argtypes
+
+    def data_buffer(self, buffer):
+        if not buffer:
+            return ''
+        size = int(self.lib.AP4_DataBuffer_GetDataSize(buffer))
+        if size == 0:
+            return ''
+        return ctypes.string_at(self.lib.AP4_DataBuffer_GetData(buffer), size)
+
+    def open_file(self, filename):
+        result = ctypes.c_int(0)
+        stream = self.lib.AP4_FileByteStream_Create(filename, AP4_FILE_BYTE_STREAM_MODE_READ, ctypes.byref(result))
+        if not stream or result.value < 0:
+            raise Exception('cannot open file '+filename+' (%d)' % result.value)
+        try:
+            # only parse the 'moov' part of the file, the rest is scanned by iterate_fragments()
+            file = self.lib.AP4_File_FromStream(stream, 1)
+        finally:
+            self.lib.AP4_ByteStream_Release(stream)
+        if not file:
+            raise Exception('cannot parse file '+filename)
+        return file
+
+    def get_tracks(self, file):
+        movie = self.lib.AP4_File_GetMovie(file)
+        if not movie:
+            return []
+        return [self.lib.AP4_Movie_GetTrackByIndex(movie, i) for i in range(int(self.lib.AP4_Movie_GetTrackCount(movie)))]
+
+    def get_sample_description_info(self, sample_description):
+        info = {}
+        if self.lib.AP4_SampleDescription_GetType(sample_description) == AP4_SAMPLE_DESCRIPTION_TYPE_PROTECTED:
+            info['protection'] = {'coding': FourCC(self.lib.AP4_SampleDescription_GetFormat(sample_description))}
+            sample_description = self.lib.AP4_ProtectedSampleDescription_GetOriginalSampleDescription(sample_description)
+        info['coding'] = FourCC(self.lib.AP4_SampleDescription_GetFormat(sample_description))
+
+        video = self.lib.AP4_SampleDescription_AsVideo(sample_description)
+        if video:
+            info['width']  = self.lib.AP4_VideoSampleDescription_GetWidth(video)
+            info['height'] = self.lib.AP4_VideoSampleDescription_GetHeight(video)
+        avc = self.lib.AP4_SampleDescription_AsAvc(sample_description)
+        if avc:
+            info['avc_profile']        = self.lib.AP4_AvcSampleDescription_GetProfile(avc)
+            info['avc_profile_compat'] = self.lib.AP4_AvcSampleDescription_GetProfileCompatibility(avc)
+            info['avc_level']          = self.lib.AP4_AvcSampleDescription_GetLevel(avc)
+            info['avc_sps'] = [self.data_buffer(self.lib.AP4_AvcSampleDescription_GetSequenceParameter(avc, i)).encode('hex')
+                               for i in range(int(self.lib.AP4_AvcSampleDescription_GetSequenceParameterCount(avc)))]
+            info['avc_pps'] = [self.data_buffer(self.lib.AP4_AvcSampleDescription_GetPictureParameter(avc, i)).encode('hex')
+                               for i in range(int(self.lib.AP4_AvcSampleDescription_GetPictureParameterCount(avc)))]
+        mpeg = self.lib.AP4_SampleDescription_AsMpeg(sample_description)
+        if mpeg:
+            info['object_type']  = self.lib.AP4_MpegSampleDescription_GetObjectTypeId(mpeg)
+            info['decoder_info'] = self.data_buffer(self.lib.AP4_MpegSampleDescription_GetDecoderInfo(mpeg)).encode('hex')
+        mpeg_audio = self.lib.AP4_SampleDescription_AsMpegAudio(sample_description)
+        if mpeg_audio:
+            info['mpeg_4_audio_object_type'] = self.lib.AP4_MpegAudioSampleDescription_GetMpeg4AudioObjectType(mpeg_audio)
+        audio = self.lib.AP4_SampleDescription_AsAudio(sample_description)
+        if audio:
+            info['sample_rate'] = int(self.lib.AP4_AudioSampleDescription_GetSampleRate(audio))
+            info['channels']    = self.lib.AP4_AudioSampleDescription_GetChannelCount(audio)
+        return info
+
+    def get_info(self, filename):
+        # returns the subset of the 'mp4info --format json' output used by the packager
+        file = self.open_file(filename)
+        try:
+            tracks = []
+            for track in self.get_tracks(file):
+                sample_description = self.lib.AP4_Track_GetSampleDescription(track, 0)
+                tracks.append({'id':                  int(self.lib.AP4_Track_GetId(track)),
+                               'type':                AP4_TRACK_TYPES.get(self.lib.AP4_Track_GetType(track), 'Unknown'),
+                               'language':            self.lib.AP4_Track_GetLanguage(track) or 'und',
+                               'media':               {'timescale': int(self.lib.AP4_Track_GetMediaTimeScale(track))},
+                               'sample_descriptions': [self.get_sample_description_info(sample_description)] if sample_description else []})
+        finally:
+            self.lib.AP4_File_Destroy(file)
+
+        return {'movie': {'fragments': HasMovieExtends(filename)}, 'tracks': tracks}
+
+    def iterate_fragments(self, filename):
+        # yields the top-level boxes of the file in the same form as 'mp4dump --format json',
+        # limited to the fields used by the packager
+        file = io.FileIO(filename, "rb")
+        try:
+            cursor = 0
+            while True:
+                header = file.read(8)
+                if len(header) < 8:
+                    break
+                (size, type) = struct.unpack('>I4s', header)
+                if size == 1:
+                    size = struct.unpack('>Q', file.read(8))[0]
+                elif size == 0:
+                    size = path.getsize(filename)-cursor
+                if size < 8:
+                    break
+                if type in ['moov', 'moof']:
+                    file.seek(cursor)
+                    yield ParseBox(file.read(size), 0)
+                else:
+                    yield {'name': type, 'size': size}
+                cursor += size
+                file.seek(cursor)
+        finally:
+            file.close()
+
+def HasMovieExtends(filename):
+    # a movie is fragmented if its 'moov' has an 'mvex' child
+    file = io.FileIO(filename, "rb")
+    try:
+        cursor = 0
+        while True:
+            header = file.read(8)
+            if len(header) < 8:
+                return False
+            (size, type) = struct.unpack('>I4s', header)
+            if size == 1:
+                size = struct.unpack('>Q', file.read(8))[0]
+            if size < 8:
+                return False
+            if type == 'moov':
+                moov = ParseBox(header+file.read(size-8), 0)
+                return len([child for child in moov['children'] if child['name'] == 'mvex']) != 0
+            cursor += size
+            file.seek(cursor)
+    finally:
+        file.close()
+
+def ParseBox(data, offset):
+    (size, type) = struct.unpack('>I4s', data[offset:offset+8])
+    header_size = 8
+    if size == 1:
+        size = struct.unpack('>Q', data[offset+8:offset+16])[0]
+        header_size = 16
+    elif size == 0:
+        size = len(data)-offset
+    box = {'name': type, 'size': size}
+    payload = offset+header_size
+
+    if type in CONTAINER_HEADER_SIZES:
+        children = []
+        cursor = payload+CONTAINER_HEADER_SIZES[type]
+        while cursor+8 <= offset+size:
+            child = ParseBox(data, cursor)
+            if child['size'] < 8:
+                break
+            children.append(child)
+            cursor += child['size']
+        box['children'] = children
+        return box
+
+    if type in ['tkhd', 'mdhd', 'trex', 'tfhd', 'tfdt', 'trun', 'tenc']:
+        version_and_flags = struct.unpack('>I', data[payload:payload+4])[0]
+        version = version_and_flags >> 24
+        flags   = version_and_flags & 0xFFFFFF
+        fields  = payload+4
+        if type == 'tkhd':
+            if version == 1:
+                box['id'] = struct.unpack('>I', data[fields+16:fields+20])[0]
+            else:
+                box['id'] = struct.unpack('>I', data[fields+8:fields+12])[0]
+        elif type == 'mdhd':
+            if version == 1:
+                box['timescale'] = struct.unpack('>I', data[fields+16:fields+20])[0]
+            else:
+                box['timescale'] = struct.unpack('>I', data[fields+8:fields+12])[0]
+        elif type == 'trex':
+            (box['track id'], sample_description_index, box['default sample duration']) = struct.unpack('>III', data[fields:fields+12])
+        elif type == 'tfhd':
+            box['track ID'] = struct.unpack('>I', data[fields:fields+4])[0]
+            cursor = fields+4
+            if flags & AP4_TFHD_FLAG_BASE_DATA_OFFSET_PRESENT:
+                cursor += 8
+            if flags & AP4_TFHD_FLAG_SAMPLE_DESCRIPTION_INDEX_PRESENT:
+                cursor += 4
+            if flags & AP4_TFHD_FLAG_DEFAULT_SAMPLE_DURATION_PRESENT:
+                box['default sample duration'] = struct.unpack('>I', data[cursor:cursor+4])[0]
+        elif type == 'tfdt':
+            if version == 1:
+                box['base media decode time'] = struct.unpack('>Q', data[fields:fields+8])[0]
+            else:
+                box['base media decode time'] = struct.unpack('>I', data[fields:fields+4])[0]
+        elif type == 'trun':
+            sample_count = struct.unpack('>I', data[fields:fields+4])[0]
+            box['sample count'] = sample_count
+            if flags & AP4_TRUN_FLAG_SAMPLE_DURATION_PRESENT:
+                cursor = fields+4
+                if flags & AP4_TRUN_FLAG_DATA_OFFSET_PRESENT:
+                    cursor += 4
+                if flags & AP4_TRUN_FLAG_FIRST_SAMPLE_FLAGS_PRESENT:
+                    cursor += 4
+                entry_size = 4
+                for flag in [AP4_TRUN_FLAG_SAMPLE_SIZE_PRESENT, AP4_TRUN_FLAG_SAMPLE_FLAGS_PRESENT, AP4_TRUN_FLAG_SAMPLE_COMPOSITION_TIME_OFFSET_PRESENT]:
+                    if flags & flag:
+                        entry_size += 4
+                # the duration is the first field of each entry
+                entries = data[cursor:cursor+entry_size*sample_count]
+                durations = struct.unpack('>'+('I'+'x'*(entry_size-4))*sample_count, entries)
+                box['sample durations'] = sum(durations)
+        elif type == 'tenc':
+            box['default_KID'] = HexBytes(data[fields+4:fields+20])
+
+    return box
+
+LoadedLibraries = {}
+
+def LoadBento4Lib(options):
+    # load the shared library once per process, from the executables directory or next to this script
+    for directory in [options.exec_dir, path.dirname(path.abspath(__file__))]:
+        library_path = path.join(directory, BENTO4_LIBRARY_NAME)
+        if library_path in LoadedLibraries:
+            return LoadedLibraries[library_path]
+        if path.exists(library_path):
+            try:
+                LoadedLibraries[library_path] = Bento4Lib(library_path)
+            except (OSError, AttributeError):
+                LoadedLibraries[library_path] = None
+            return LoadedLibraries[library_path]
+    return None
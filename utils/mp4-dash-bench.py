@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+###
+# Benchmarks the packaging tools on synthetic fragmented MP4 files (see mp4synth.py),
+# so that the numbers only depend on the code and on the machine. Each stage
+# (parsing, bandwidth computation, manifests, split, cloning over HTTP) is timed
+# separately, and the results can be saved as JSON and compared with a previous run
+
+from optparse import OptionParser
+from subprocess import Popen
+import shutil
+import imp
+import platform
+import threading
+import SimpleHTTPServer
+import BaseHTTPServer
+import urllib
+from mp4utils import *
+import mp4synth
+
+SCRIPT_PATH = path.abspath(path.dirname(__file__))
+mp4dash = imp.load_source('mp4dash', path.join(SCRIPT_PATH, 'mp4-dash.py'))
+
+BENCHMARKS = ['mp4file', 'mp4file-no-lib', 'bandwidth', 'dash', 'smooth', 'split', 'clone']
+
+class Quiet:
+    # silences the progress messages of the packager while it is being timed
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'wb')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+class StaticFileHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    # serves the files of the server's root directory instead of the current directory
+    def translate_path(self, url_path):
+        url_path = urllib.unquote(url_path.split('?', 1)[0].split('#', 1)[0])
+        return path.join(self.server.root_dir, *[part for part in url_path.split('/') if part not in ('', '.', '..')])
+
+    def log_message(self, format, *args):
+        pass
+
+class StaticFileServer:
+    # local HTTP server, running in a thread, on a port chosen by the system
+    def __init__(self, root_dir):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StaticFileHandler)
+        self.server.root_dir = root_dir
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_url(self, name):
+        return 'http://127.0.0.1:%d/%s' % (self.server.server_address[1], name)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class Fixtures:
+    # the synthetic media files used by the benchmarks
+    def __init__(self, options, work_dir):
+        self.filenames = []
+        self.encrypted_filename = None
+        media_dir = path.join(work_dir, 'media')
+        os.mkdir(media_dir)
+        parameters = dict(fragment_count=options.fragment_count, mfra=options.mfra,
+                          sample_durations_in_trun=options.sample_durations_in_trun)
+        video_tracks = mp4synth.MakeTracks(options.video_count, 0,
+                                           samples_per_fragment=options.samples_per_fragment,
+                                           sample_size=options.sample_size,
+                                           sample_size_variation=options.sample_size_variation)
+        for (index, track) in enumerate(video_tracks):
+            track.track_id = 1
+            filename = path.join(media_dir, 'video-%d.mp4' % (index+1))
+            mp4synth.MakeFragmentedMp4(filename, [track], seed=options.seed+index, **parameters)
+            self.filenames.append(filename)
+        for track in mp4synth.MakeTracks(0, options.audio_count):
+            track.track_id = 1
+            filename = path.join(media_dir, 'audio-%d.mp4' % len(self.filenames))
+            track.language = ('eng', 'fra', 'deu', 'spa')[len(self.filenames)%4]
+            mp4synth.MakeFragmentedMp4(filename, [track], seed=options.seed+len(self.filenames), **parameters)
+            self.filenames.append(filename)
+
+        # a file with CENC signaling, only parsed
+        if options.encrypted:
+            self.encrypted_filename = path.join(media_dir, 'video-encrypted.mp4')
+            mp4synth.MakeFragmentedMp4(self.encrypted_filename, video_tracks[:1], encrypted=True, seed=options.seed, **parameters)
+
+        self.size = sum([os.path.getsize(filename) for filename in self.filenames])
+
+class Benchmark:
+    def __init__(self, options, fixtures, work_dir):
+        self.options   = options
+        self.fixtures  = fixtures
+        self.work_dir  = work_dir
+        self.results   = collections.OrderedDict()
+        self.run_count = 0
+
+    def packager_options(self, *args):
+        if self.options.exec_dir:
+            return ['--exec-dir', self.options.exec_dir] + list(args)
+        return list(args)
+
+    def parse_options(self, *args):
+        options = mp4dash.CreateOptionParser().parse_args(self.packager_options(*args))[0]
+        options.bento4_executor = Bento4Executor(options.exec_dir)
+        return options
+
+    def new_output_dir(self):
+        self.run_count += 1
+        return path.join(self.work_dir, 'out-%d' % self.run_count)
+
+    def time(self, name, function, setup=None):
+        # run the function once to warm up, then the number of iterations asked for
+        if name not in self.options.benchmarks:
+            return
+        if self.options.verbose:
+            print 'Running', name
+        times = []
+        for i in xrange(self.options.iterations+1):
+            state = setup() if setup else None
+            start = time.time()
+            function(state)
+            times.append(time.time()-start)
+        times = sorted(times[1:])
+        self.results[name] = collections.OrderedDict([('iterations', len(times)),
+                                                      ('min',        times[0]),
+                                                      ('median',     times[len(times)/2]),
+                                                      ('mean',       sum(times)/len(times)),
+                                                      ('max',        times[-1])])
+
+    def run(self):
+        filenames = self.fixtures.filenames
+        if self.fixtures.encrypted_filename:
+            filenames = filenames + [self.fixtures.encrypted_filename]
+
+        # parsing, with the Bento4 library and with the command line tools
+        options = self.parse_options()
+        self.time('mp4file', lambda state: [Mp4File(options, filename) for filename in filenames])
+        no_lib_options = self.parse_options('--no-bento4-lib')
+        self.time('mp4file-no-lib', lambda state: [Mp4File(no_lib_options, filename) for filename in filenames])
+
+        # bandwidth, for a few buffer times
+        tracks = []
+        for filename in self.fixtures.filenames:
+            tracks += Mp4File(options, filename).tracks.values()
+        def compute_bandwidths(state):
+            for track in tracks:
+                for buffer_time in (1.0, 2.0, 5.0, 10.0):
+                    ComputeBandwidth(buffer_time, track.segment_sizes, track.segment_durations)
+        self.time('bandwidth', compute_bandwidths)
+
+        # manifests, from an analysis done once
+        packager = mp4dash.DashPackager(*mp4dash.ParseDashPackagerArguments(
+            self.packager_options('--no-media', '--smooth', '-o', self.new_output_dir()) + self.fixtures.filenames))
+        with Quiet():
+            packager.analyze()
+        manifest_options = packager.options
+        self.time('dash', lambda state: mp4dash.OutputDash(manifest_options, packager.audio_tracks, packager.video_tracks))
+        self.time('smooth', lambda state: mp4dash.OutputSmooth(manifest_options, packager.audio_tracks, packager.video_tracks))
+        packager.cleanup()
+
+        # split, in a new output directory each time
+        split_args = ['--jobs', str(self.options.jobs)] + self.fixtures.filenames
+        def setup_split():
+            packager = mp4dash.DashPackager(*mp4dash.ParseDashPackagerArguments(
+                self.packager_options('-o', self.new_output_dir(), *split_args)))
+            with Quiet():
+                packager.analyze()
+                packager.output_manifests()
+            return packager
+        def split(packager):
+            with Quiet():
+                packager.output_media()
+            packager.cleanup()
+        self.time('split', split, setup_split)
+
+        # cloning of a packaged presentation, over HTTP
+        if 'clone' in self.options.benchmarks:
+            source_dir = self.new_output_dir()
+            with Quiet():
+                mp4dash.DashPackager(*mp4dash.ParseDashPackagerArguments(self.packager_options('-o', source_dir, *split_args))).package()
+            server = StaticFileServer(source_dir)
+            def clone(output_dir):
+                command = [sys.executable, path.join(SCRIPT_PATH, 'mp4-dash-clone.py')] + self.packager_options(server.get_url('stream.mpd'), output_dir)
+                if Popen(command, stdout=open(os.devnull, 'wb')).wait():
+                    raise Exception('ERROR: mp4-dash-clone.py failed')
+            try:
+                self.time('clone', clone, self.new_output_dir)
+            finally:
+                server.close()
+
+def CompareResults(results, baseline, threshold):
+    # returns the names of the benchmarks slower than the baseline by more than the threshold
+    regressions = []
+    for (name, result) in results['benchmarks'].iteritems():
+        if name not in baseline.get('benchmarks', {}):
+            continue
+        old = baseline['benchmarks'][name]['median']
+        new = result['median']
+        change = (new-old)/old if old > 0 else 0.0
+        status = 'OK'
+        if change > threshold:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif change < -threshold:
+            status = 'IMPROVEMENT'
+        print '  %-16s %10.4f s -> %10.4f s  %+7.1f%%  %s' % (name, old, new, 100.0*change, status)
+    return regressions
+
+def main():
+    parser = OptionParser(usage="%prog [options]",
+                          description="Time the packaging stages on synthetic media files")
+    parser.add_option('', '--verbose', dest="verbose", action='store_true', default=False,
+                      help="Be verbose")
+    parser.add_option('', '--iterations', dest="iterations", metavar="<n>", type="int", default=5,
+                      help="Number of timed runs of each benchmark, after a warm-up run (default: 5)")
+    parser.add_option('', '--benchmarks', dest="benchmarks", metavar="<name>[,...]", default=','.join(BENCHMARKS),
+                      help="Benchmarks to run, among " + ', '.join(BENCHMARKS) + " (default: all)")
+    parser.add_option('', '--video-tracks', dest="video_count", metavar="<n>", type="int", default=3,
+                      help="Number of video renditions (default: 3)")
+    parser.add_option('', '--audio-tracks', dest="audio_count", metavar="<n>", type="int", default=1,
+                      help="Number of audio renditions (default: 1)")
+    parser.add_option('', '--fragments', dest="fragment_count", metavar="<n>", type="int", default=150,
+                      help="Number of fragments per rendition (default: 150)")
+    parser.add_option('', '--samples', dest="samples_per_fragment", metavar="<n>", type="int", default=48,
+                      help="Number of video samples per fragment (default: 48)")
+    parser.add_option('', '--sample-size', dest="sample_size", metavar="<bytes>", type="int", default=4000,
+                      help="Size of the video samples of the first rendition, halved for each following one (default: 4000)")
+    parser.add_option('', '--sample-size-variation', dest="sample_size_variation", metavar="<ratio>", type="float", default=0.5,
+                      help="Maximum relative variation of the video sample sizes (default: 0.5)")
+    parser.add_option('', '--sample-durations', dest="sample_durations_in_trun", action='store_true', default=False,
+                      help="Store the duration of each sample in the 'trun' boxes")
+    parser.add_option('', '--no-mfra', dest="mfra", action='store_false', default=True,
+                      help="Do not write an 'mfra' index in the media files")
+    parser.add_option('', '--encrypted', dest="encrypted", action='store_true', default=False,
+                      help="Also parse a file with CENC signaling")
+    parser.add_option('', '--seed', dest="seed", metavar="<n>", type="int", default=0,
+                      help="Seed for the sample size variations (default: 0)")
+    parser.add_option('', '--jobs', dest="jobs", metavar="<n>", type="int", default=1,
+                      help="Number of splits run in parallel (default: 1)")
+    parser.add_option('', '--work-dir', dest="work_dir", metavar="<dir>", default=None,
+                      help="Directory for the media files and the outputs (default: a temporary directory, removed at the end)")
+    parser.add_option('-o', '--output', dest="output_filename", metavar="<filename>", default=None,
+                      help="Write the results to a JSON file")
+    parser.add_option('', '--compare', dest="baseline_filename", metavar="<filename>", default=None,
+                      help="Compare the results with those of a previous run, and exit with an error if a benchmark is slower")
+    parser.add_option('', '--threshold', dest="threshold", metavar="<ratio>", type="float", default=0.10,
+                      help="Relative slowdown of the median time above which a benchmark is reported as a regression (default: 0.10)")
+    parser.add_option('', "--exec-dir", metavar="<exec_dir>", dest="exec_dir", default=None,
+                      help="Directory where the Bento4 executables are located")
+    (options, args) = parser.parse_args()
+    if len(args) != 0:
+        parser.print_help()
+        sys.exit(1)
+    if options.iterations < 1:
+        PrintErrorAndExit('ERROR: --iterations must be at least 1')
+    options.benchmarks = options.benchmarks.split(',')
+    for name in options.benchmarks:
+        if name not in BENCHMARKS:
+            PrintErrorAndExit('ERROR: unknown benchmark ' + name)
+    if options.exec_dir:
+        options.exec_dir = path.abspath(options.exec_dir)
+
+    if options.work_dir:
+        work_dir = options.work_dir
+        MakeNewDir(work_dir, exit_if_exists=True, severity='ERROR')
+    else:
+        work_dir = tempfile.mkdtemp()
+
+    try:
+        fixtures = Fixtures(options, work_dir)
+        benchmark = Benchmark(options, fixtures, work_dir)
+        benchmark.run()
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir)
+
+    parameters = collections.OrderedDict()
+    for name in ('video_count', 'audio_count', 'fragment_count', 'samples_per_fragment', 'sample_size',
+                 'sample_size_variation', 'sample_durations_in_trun', 'mfra', 'encrypted', 'seed', 'jobs'):
+        parameters[name] = getattr(options, name)
+    parameters['media_size'] = fixtures.size
+    environment = collections.OrderedDict([('python',   platform.python_version()),
+                                           ('platform', platform.platform()),
+                                           ('machine',  platform.machine()),
+                                           ('time',     XmlDateTime(time.time()))])
+    results = collections.OrderedDict([('environment', environment),
+                                       ('parameters',  parameters),
+                                       ('benchmarks',  benchmark.results)])
+    for (name, result) in benchmark.results.iteritems():
+        print '%-16s min=%.4f median=%.4f mean=%.4f max=%.4f s' % (name, result['min'], result['median'], result['mean'], result['max'])
+    if options.output_filename:
+        json.dump(results, open(options.output_filename, 'wb'), indent=2, separators=(',', ': '))
+
+    if options.baseline_filename:
+        baseline = json.load(open(options.baseline_filename, 'rb'))
+        if baseline.get('parameters') != json.loads(json.dumps(parameters)):
+            sys.stderr.write('WARNING: the baseline was run with different parameters\n')
+        print 'Compared with', options.baseline_filename
+        regressions = CompareResults(results, baseline, options.threshold)
+        if regressions:
+            PrintErrorAndExit('ERROR: slower than the baseline: ' + ', '.join(regressions))
+
+###########################
+if __name__ == '__main__':
+    main()
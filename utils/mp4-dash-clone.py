@@ -24,8 +24,15 @@ import shutil
 import itertools
 import json
 import sys
+import re
+import math
+import array
+import posixpath
+import time
+import threading
+import multiprocessing.pool
 from xml.etree import ElementTree
-from subprocess import check_output, CalledProcessError
+from mp4utils import Bento4Executor
 
 # constants
 DASH_NS_URN_COMPAT = 'urn:mpeg:DASH:schema:MPD:2011'
@@ -34,21 +41,10 @@ DASH_NS_COMPAT     = '{'+DASH_NS_URN_COMPAT+'}'
 DASH_NS            = '{'+DASH_NS_URN+'}'
 MARLIN_MAS_NS_URN  = 'urn:marlin:mas:1-0:services:schemas:mpd'
 MARLIN_MAS_NS      = '{'+MARLIN_MAS_NS_URN+'}'
+CLONE_CHUNK_SIZE   = 65536
 
 def Bento4Command(name, *args, **kwargs):
-    cmd = [os.path.join(Options.exec_dir, name)]
-    for kwarg in kwargs:
-        arg = kwarg.replace('_', '-')
-        cmd.append('--'+arg)
-        if not isinstance(kwargs[kwarg], bool):
-            cmd.append(kwargs[kwarg])
-    cmd += args
-    #print cmd
-    try:
-        return check_output(cmd) 
-    except CalledProcessError, e:
-        #print e
-        raise Exception("binary tool failed with error %d" % e.returncode)
+    return Options.executor.run(name, *args, **kwargs)
     
 def Mp4Info(filename, **args):
     return Bento4Command('mp4info', filename, **args)
@@ -63,34 +59,118 @@ def GetTrackIds(mp4):
         
     return track_ids
 
-def ProcessUrlTemplate(template, representation_id, bandwidth, time, number):
-    if representation_id is not None: result = template.replace('$RepresentationID$', representation_id)
-    if number is not None:
-        nstart = result.find('$Number')
-        if nstart >= 0:
-            nend = result.find('$', nstart+1)
-            if nend >= 0:
-                var = result[nstart+1 : nend]
-                if 'Number%' in var:
-                    value = var[6:] % (int(number))
-                else:
-                    value = number
-                result = result.replace('$'+var+'$', value)
-    if bandwidth is not None:         result = result.replace('$Bandwidth$', bandwidth)
-    if time is not None:              result = result.replace('$Time$', time)
-    result = result.replace('$$', '$')
-    return result
+URL_TEMPLATE_IDENTIFIER_PATTERN = re.compile(r'\$(RepresentationID|Number|Bandwidth|Time)(%0[0-9]+d)?\$')
+
+def CompileUrlTemplate(template, representation_id, bandwidth):
+    # turns a SegmentTemplate URL into a function of the segment number and time.
+    # $RepresentationID$ and $Bandwidth$ are substituted once, $Number$ and $Time$
+    # (with their optional %0<width>d format) become fields of a format string
+    format = ''
+    position = 0
+    for match in URL_TEMPLATE_IDENTIFIER_PATTERN.finditer(template):
+        format += template[position:match.start()].replace('$$', '$').replace('%', '%%')
+        (identifier, width) = match.groups()
+        if identifier == 'RepresentationID':
+            format += (representation_id or '').replace('%', '%%')
+        elif identifier == 'Bandwidth':
+            format += (width or '%d') % int(bandwidth or 0)
+        else:
+            format += '%(' + identifier.lower() + ')' + (width or '%d')[1:]
+        position = match.end()
+    format += template[position:].replace('$$', '$').replace('%', '%%')
+    return lambda number=0, time=0: format % {'number': number, 'time': time}
+
+XS_DURATION_PATTERN = re.compile(r'^P(?:([0-9.]+)Y)?(?:([0-9.]+)M)?(?:([0-9.]+)D)?(?:T(?:([0-9.]+)H)?(?:([0-9.]+)M)?(?:([0-9.]+)S)?)?$')
+
+def ParseDuration(duration):
+    # xs:duration (PnYnMnDTnHnMnS) to seconds, with years of 365 days and months
+    # of 30 days (they are only approximate, and in practice always 0).
+    # None if the duration cannot be parsed, so that the number of segments is
+    # found by loading them until one is missing
+    match = XS_DURATION_PATTERN.match(duration.strip())
+    if match is None:
+        print 'WARNING: ignoring invalid duration', duration
+        return None
+    try:
+        (years, months, days, hours, minutes, seconds) = [float(x or 0) for x in match.groups()]
+    except ValueError:
+        print 'WARNING: ignoring invalid duration', duration
+        return None
+    days += 365*years+30*months
+    return ((days*24+hours)*60+minutes)*60+seconds
     
-class DashSegmentBaseInfo:
+def ComputeLocalBasePath(url):
+    # the path, in the output directory, where the segments under an absolute
+    # BaseURL are cloned: a directory named after the host, then the URL path
+    parsed = urlparse.urlparse(url)
+    return '/' + re.sub(r'[^A-Za-z0-9._-]', '_', parsed.netloc) + (parsed.path or '/')
+
+def ResolveBaseUrl(xml, parent_base_url, parent_base_path):
+    # returns the base URL of an element and the matching path in the output directory,
+    # only the first BaseURL of an element is used. An absolute BaseURL is replaced,
+    # in the MPD, by the relative path of its clone, so that the cloned MPD does not
+    # refer to the origin servers
+    base_url = xml.find(DASH_NS+'BaseURL')
+    if base_url is None or not (base_url.text or '').strip():
+        return (parent_base_url, parent_base_path)
+    url = base_url.text.strip()
+    if url.startswith('http://') or url.startswith('https://'):
+        base_path = ComputeLocalBasePath(url)
+        relative_path = posixpath.relpath(base_path, posixpath.dirname(parent_base_path))
+        if base_path.endswith('/'):
+            relative_path += '/'
+        base_url.text = relative_path
+        return (url, base_path)
+    return (ComputeUrl(parent_base_url, url), urlparse.urljoin(parent_base_path, url))
+
+# the start times and durations of the timelines are 64-bit values
+if array.array('L').itemsize >= 8:
+    TIMELINE_TYPECODE = 'L'
+else:
+    TIMELINE_TYPECODE = 'd'
+
+class DashSegmentTimeline(object):
+    # the S entries of a SegmentTimeline, as arrays of (t, d, r), with all the
+    # start times resolved
+    __slots__ = ('times', 'durations', 'repeats')
+
+    def __init__(self, xml):
+        self.times     = array.array(TIMELINE_TYPECODE)
+        self.durations = array.array(TIMELINE_TYPECODE)
+        self.repeats   = array.array('l')
+        current_time = 0
+        for entry in xml.findall(DASH_NS+'S'):
+            s_t = entry.get('t')
+            if s_t is not None:
+                current_time = int(s_t)
+            duration = int(entry.get('d', 0))
+            repeat   = int(entry.get('r', 0))
+            self.times.append(current_time)
+            self.durations.append(duration)
+            self.repeats.append(repeat)
+            current_time += (1+repeat)*duration
+
+    def __iter__(self):
+        return itertools.izip(self.times, self.durations, self.repeats)
+
+    def __len__(self):
+        return len(self.repeats)+sum(self.repeats)
+
+class DashSegmentBaseInfo(object):
+    # the SegmentBase, SegmentTemplate or SegmentList of an element. Once resolved,
+    # the fields not set by the element are inherited from its parent
+    __slots__ = ('type', 'initialization', 'media', 'timescale', 'startNumber', 'duration', 'segment_timeline', 'segment_urls')
+
     def __init__(self, xml):
-        self.initialization = None
-        self.type = None
+        for field in self.__slots__:
+            setattr(self, field, None)
         for type in ['SegmentBase', 'SegmentTemplate', 'SegmentList']:
             e = xml.find(DASH_NS+type)
             if e is not None:
                 self.type = type
                 
                 # parse common elements
+                self.timescale = e.get('timescale')
                 
                 # type specifics
                 if type == 'SegmentBase' or type == 'SegmentList':
@@ -101,156 +181,154 @@ class DashSegmentBaseInfo:
                 if type == 'SegmentTemplate':
                     self.initialization = e.get('initialization')
                     self.media          = e.get('media')
-                    self.timescale      = e.get('timescale')
                     self.startNumber    = e.get('startNumber')
+                    self.duration       = e.get('duration')
+
+                if type == 'SegmentList':
+                    self.segment_urls = [seg.get('media') for seg in e.findall(DASH_NS+'SegmentURL') if seg.get('media') is not None]
                     
                 # segment timeline
                 st = e.find(DASH_NS+'SegmentTimeline')
                 if st is not None:
-                    self.segment_timeline = []
-                    entries = st.findall(DASH_NS+'S')
-                    for entry in entries:
-                        item = {}
-                        s_t = entry.get('t')
-                        if s_t is not None:
-                            item['t'] = int(s_t)
-                        s_d = entry.get('d')
-                        if s_d is not None:
-                            item['d'] = int(s_d)
-                        s_r = entry.get('r')
-                        if s_r is not None:
-                            item['r'] = int(s_r)
-                        else:
-                            item['r'] = 0
-                        self.segment_timeline.append(item)
+                    self.segment_timeline = DashSegmentTimeline(st)
     
                 break
+
+    def Resolve(self, parent):
+        # inherit the fields of the parent (already resolved) that are not set here,
+        # a SegmentBase does not hide a SegmentTemplate or SegmentList of a parent
+        if parent is None:
+            return self
+        for field in self.__slots__:
+            if getattr(self, field) is None:
+                setattr(self, field, getattr(parent, field))
+        if self.type not in ['SegmentTemplate', 'SegmentList'] and parent.type in ['SegmentTemplate', 'SegmentList']:
+            self.type = parent.type
+        return self
                    
-class DashRepresentation:
+class DashRepresentation(object):
+    __slots__ = ('parent', 'id', 'bandwidth', 'segment_base', 'segment_base_type', 'init_segment_url', 'base_url', 'base_path', 'period_duration')
+
     def __init__(self, xml, parent):
-        self.xml = xml
         self.parent = parent
-        self.init_segment_url = None
-        self.segment_urls = []
-        self.segment_base = DashSegmentBaseInfo(xml)
-        self.duration = 0
+        self.segment_base = DashSegmentBaseInfo(xml).Resolve(parent.segment_base)
+        (self.base_url, self.base_path) = ResolveBaseUrl(xml, parent.base_url, parent.base_path)
+        self.period_duration = parent.period_duration
         
         # parse standard attributes
         self.bandwidth = xml.get('bandwidth')
         self.id        = xml.get('id')
                     
         # compute the segment base type
-        node = self
         self.segment_base_type = None
-        while node is not None:
-            if node.segment_base.type in ['SegmentTemplate', 'SegmentList']:
-                self.segment_base_type = node.segment_base.type
-                break                
-            node = node.parent            
+        if self.segment_base.type in ['SegmentTemplate', 'SegmentList']:
+            self.segment_base_type = self.segment_base.type
         
         # compute the init segment URL
-        self.ComputeInitSegmentUrl()
-        
-    def SegmentBaseLookup(self, field):
-        node = self
-        while node is not None:
-            if field in node.segment_base.__dict__:
-                return node.segment_base.__dict__[field]
-            node = node.parent
-        return None
-
-    def AttributeLookup(self, field):
-        node = self
-        while node is not None:
-            if field in node.__dict__:
-                return node.__dict__[field]
-            node = node.parent
-        return None
-        
-    def ComputeInitSegmentUrl(self):
-        node = self
-        while node is not None:
-            if node.segment_base.initialization is not None:
-                self.initialization = node.segment_base.initialization
-                break                
-            node = node.parent
-            
-        self.init_segment_url = ProcessUrlTemplate(self.initialization, representation_id=self.id, bandwidth=self.bandwidth, time=None, number=None)
+        self.init_segment_url = CompileUrlTemplate(self.segment_base.initialization, self.id, self.bandwidth)()
                     
+    def ComputeOutputPath(self, url):
+        # where a segment is cloned, relative to the output directory: the relative
+        # BaseURLs are kept so that the URLs of the cloned MPD stay the same
+        return posixpath.normpath(urlparse.urljoin(self.base_path, url))
+
     def GenerateSegmentUrls(self):
         if self.segment_base_type == 'SegmentTemplate':
             return self.GenerateSegmentUrlsFromTemplate()
         else:
             return self.GenerateSegmentUrlsFromList()
             
+    def ComputeSegmentCount(self):
+        # number of segments of a template without a timeline, when the duration
+        # of the period (or of the presentation) is known, None otherwise
+        if self.segment_base.duration is None or self.period_duration is None:
+            return None
+        timescale = int(self.segment_base.timescale or 1)
+        return int(math.ceil(self.period_duration*timescale/int(self.segment_base.duration)-1e-9))
+
     def GenerateSegmentUrlsFromTemplate(self):
-        media = self.SegmentBaseLookup('media')
+        media = self.segment_base.media
         if media is None:
             print 'WARNING: no media attribute found for representation'
             return
+        url_template = CompileUrlTemplate(media, self.id, self.bandwidth)
         
-        timeline = self.SegmentBaseLookup('segment_timeline')
+        timeline = self.segment_base.segment_timeline
+        start = self.segment_base.startNumber
+        if start is None:
+            current_number = 1
+        else:
+            current_number = int(start)
         if timeline is None:
-            start = self.SegmentBaseLookup('startNumber')
-            if start is None:
-                current_number = 1
+            segment_count = self.ComputeSegmentCount()
+            if segment_count is None:
+                numbers = itertools.count(current_number)
             else:
-                current_number = int(start)
-            while True:
-                url = ProcessUrlTemplate(media, representation_id=self.id, bandwidth=self.bandwidth, time="0", number=str(current_number))
-                current_number += 1
-                yield url
+                numbers = xrange(current_number, current_number+segment_count)
+            for number in numbers:
+                yield url_template(number, 0)
                 
         else:
-            current_number = 1
-            current_time = 0
-            for s in timeline:
-                if 't' in s:
-                    current_time = s['t']
-                for r in xrange(1+s['r']):
-                    url = ProcessUrlTemplate(media, representation_id=self.id, bandwidth=self.bandwidth, time=str(current_time), number=str(current_number))
+            for (current_time, duration, repeat) in timeline:
+                for r in xrange(1+repeat):
+                    yield url_template(current_number, current_time)
                     current_number += 1
-                    current_time += s['d']
-                    yield url
+                    current_time += duration
+
+    def ListSegmentUrls(self):
+        # all the segment URLs, or None if their number is only known once a
+        # segment is missing (a template without a timeline or a duration)
+        if self.segment_base_type == 'SegmentTemplate' and self.segment_base.segment_timeline is None and self.ComputeSegmentCount() is None:
+            return None
+        return list(self.GenerateSegmentUrls())
                         
     def GenerateSegmentUrlsFromList(self):
-        segs = self.xml.find(DASH_NS+'SegmentList').findall(DASH_NS+'SegmentURL')
-        for seg in segs:
-            media = seg.get('media')
-            if media is not None:
-                yield media
+        return iter(self.segment_base.segment_urls or [])
         
     def __str__(self):
         result = "Representation: "
         return result
 
-class DashAdaptationSet:
+class DashAdaptationSet(object):
+    __slots__ = ('parent', 'segment_base', 'representations', 'base_url', 'base_path', 'period_duration')
+
     def __init__(self, xml, parent):
-        self.xml = xml
         self.parent = parent
-        self.segment_base = DashSegmentBaseInfo(xml)
+        self.segment_base = DashSegmentBaseInfo(xml).Resolve(parent.segment_base)
+        (self.base_url, self.base_path) = ResolveBaseUrl(xml, parent.base_url, parent.base_path)
+        self.period_duration = parent.period_duration
         self.representations = []
-        for r in self.xml.findall(DASH_NS+'Representation'):
-            self.representations.append(DashRepresentation(r, self))
         
     def __str__(self):
         result = 'Adaptation Set:\n' + '\n'.join([str (r) for r in self.representations])
         return result
 
-class DashPeriod:
+class DashPeriod(object):
+    __slots__ = ('parent', 'segment_base', 'adaptation_sets', 'base_url', 'base_path', 'start', 'period_duration')
+
     def __init__(self, xml, parent):
-        self.xml = xml
         self.parent = parent
-        self.segment_base = DashSegmentBaseInfo(xml)
+        self.segment_base = DashSegmentBaseInfo(xml).Resolve(parent.segment_base)
+        (self.base_url, self.base_path) = ResolveBaseUrl(xml, parent.base_url, parent.base_path)
+        self.start = ParseDuration(xml.get('start', 'PT0S'))
+
+        # without a duration, the period is assumed to last until the end of the
+        # presentation (which is only right for the last one, segment numbers
+        # computed from that are an upper bound for the other periods)
+        self.period_duration = None
+        if xml.get('duration') is not None:
+            self.period_duration = ParseDuration(xml.get('duration'))
+        elif parent.presentation_duration is not None and self.start is not None:
+            self.period_duration = parent.presentation_duration-self.start
         self.adaptation_sets = []
-        for s in self.xml.findall(DASH_NS+'AdaptationSet'):
-            self.adaptation_sets.append(DashAdaptationSet(s, self))
         
     def __str__(self):
         result = 'Period:\n' + '\n'.join([str(s) for s in self.adaptation_sets])
         return result
         
-class DashMPD:
+class DashMPD(object):
+    __slots__ = ('url', 'xml', 'parent', 'periods', 'segment_base', 'type', 'base_url', 'base_path', 'presentation_duration')
+
     def __init__(self, url, xml):
         self.url = url
         self.xml = xml
@@ -258,35 +336,96 @@ class DashMPD:
         self.periods = []
         self.segment_base = DashSegmentBaseInfo(xml)
         self.type = xml.get('type')
-        for p in self.xml.findall(DASH_NS+'Period'):
-            self.periods.append(DashPeriod(p, self))
         
-        # compute base URL (note: we'll just use the MPD URL for now)
-        self.base_urls = [url] 
-        base_url = self.xml.find(DASH_NS+'BaseURL')
-        if base_url is not None:
-            self.base_urls = [base_url.text]
+        # compute the base URL, relative to the MPD URL
+        (self.base_url, self.base_path) = ResolveBaseUrl(xml, url, '/')
+
+        self.presentation_duration = None
+        if xml.get('mediaPresentationDuration') is not None:
+            self.presentation_duration = ParseDuration(xml.get('mediaPresentationDuration'))
         
     def __str__(self):
         result = "MPD:\n" + '\n'.join([str(p) for p in self.periods])
         return result
         
-def ParseMpd(url, xml):
-    mpd_tree = ElementTree.XML(xml)
-    if mpd_tree.tag.startswith(DASH_NS_COMPAT):
-        global DASH_NS
-        global DASH_NS_URN
-        DASH_NS = DASH_NS_COMPAT
-        DASH_NS_URN = DASH_NS_URN_COMPAT
-        if Options.verbose:
-            print '@@@ Using backward compatible namespace'
-            
-    mpd = DashMPD(url, mpd_tree)
-    
-    if not (mpd.type is None or mpd.type == 'static'):
-        raise Exception('Only static MPDs are supported')
-        
-    return mpd
+class DashMpdReader:
+    # incremental MPD parser: the representations are returned as soon as their
+    # element is complete, so that they can be cloned while the rest of the MPD
+    # is still being loaded. The elements of a parent that come before its children
+    # (BaseURL, SegmentTemplate, ...) are complete when the first child starts, so
+    # each level of the model is created at that point
+    def __init__(self, url, file):
+        self.url  = url
+        self.file = file
+        self.mpd  = None
+
+    def FixElement(self, element):
+        # accept the 'Initialisation' spelling of some MPD generators
+        if 'nitialisation' in element.tag:
+            element.tag = element.tag.replace('nitialisation', 'nitialization')
+        for (name, value) in element.items():
+            if 'nitialisation' in name:
+                del element.attrib[name]
+                element.set(name.replace('nitialisation', 'nitialization'), value)
+
+    def CheckRoot(self, root):
+        if root.tag.startswith(DASH_NS_COMPAT):
+            global DASH_NS
+            global DASH_NS_URN
+            DASH_NS = DASH_NS_COMPAT
+            DASH_NS_URN = DASH_NS_URN_COMPAT
+            if Options.verbose:
+                print '@@@ Using backward compatible namespace'
+        if not (root.get('type') is None or root.get('type') == 'static'):
+            raise Exception('Only static MPDs are supported')
+
+    def ReadRepresentations(self):
+        root = None
+        (period, period_xml) = (None, None)
+        (adaptation_set, adaptation_set_xml) = (None, None)
+        for (event, element) in ElementTree.iterparse(self.file, events=('start', 'end')):
+            if event == 'start':
+                self.FixElement(element)
+                if root is None:
+                    root = element
+                    self.CheckRoot(root)
+                elif element.tag == DASH_NS+'Period':
+                    if self.mpd is None:
+                        self.mpd = DashMPD(self.url, root)
+                    (period, period_xml) = (None, element)
+                elif element.tag == DASH_NS+'AdaptationSet':
+                    period = period or self.AddPeriod(period_xml)
+                    (adaptation_set, adaptation_set_xml) = (None, element)
+                elif element.tag == DASH_NS+'Representation':
+                    adaptation_set = adaptation_set or self.AddAdaptationSet(adaptation_set_xml, period)
+            else:
+                if element.tag == DASH_NS+'Representation':
+                    representation = DashRepresentation(element, adaptation_set)
+                    adaptation_set.representations.append(representation)
+                    yield representation
+                elif element.tag == DASH_NS+'AdaptationSet':
+                    adaptation_set = adaptation_set or self.AddAdaptationSet(adaptation_set_xml, period)
+                elif element.tag == DASH_NS+'Period':
+                    period = period or self.AddPeriod(period_xml)
+                elif element is root and self.mpd is None:
+                    self.mpd = DashMPD(self.url, root)
+
+    def AddPeriod(self, xml):
+        period = DashPeriod(xml, self.mpd)
+        self.mpd.periods.append(period)
+        return period
+
+    def AddAdaptationSet(self, xml, period):
+        adaptation_set = DashAdaptationSet(xml, period)
+        period.adaptation_sets.append(adaptation_set)
+        return adaptation_set
+
+def ParseMpd(url, file):
+    # parse the whole MPD
+    reader = DashMpdReader(url, file)
+    for representation in reader.ReadRepresentations():
+        pass
+    return reader.mpd
         
 def MakeNewDir(dir, is_warning=False):
     if os.path.exists(dir):
@@ -315,9 +454,27 @@ def ComputeUrl(base_url, url):
     else:
         return urlparse.urljoin(base_url, url)
     
+class BandwidthThrottle:
+    # shared by all the downloads, keeps their total rate under max_bandwidth (in bits per second)
+    def __init__(self, max_bandwidth):
+        self.byte_rate = max_bandwidth/8.0
+        self.lock      = threading.Lock()
+        self.next_time = time.time()
+
+    def Consume(self, size):
+        # wait until the size bytes just read fit in the allowed rate
+        with self.lock:
+            now = time.time()
+            self.next_time = max(self.next_time, now)+size/self.byte_rate
+            delay = self.next_time-now
+        if delay > 0:
+            time.sleep(delay)
+
 class Cloner:
-    def __init__(self, root_dir):
+    # clones the segments of one representation
+    def __init__(self, root_dir, throttle=None):
         self.root_dir = root_dir
+        self.throttle = throttle
         self.track_ids = []
         self.init_filename = None
         
@@ -337,17 +494,14 @@ class Cloner:
         except:
             raise            
                 
-        data = OpenURL(url)
         outfile_name = os.path.join(self.root_dir, path_out)
         use_temp_file = False
         if Options.encrypt:
             use_temp_file = True
             outfile_name_final = outfile_name
             outfile_name += '.tmp'
-        outfile = open(outfile_name, 'wb+')
         try:
-            shutil.copyfileobj(data, outfile)
-            outfile.close()
+            self.Download(url, outfile_name)
             
             if Options.encrypt:
                 if is_init:
@@ -371,12 +525,126 @@ class Cloner:
                     print 'mp4encrypt '+(' '.join(args))
                 Bento4Command("mp4encrypt", *args)
         finally:
-            if use_temp_file and not is_init:
+            if use_temp_file and not is_init and os.path.exists(outfile_name):
                 os.unlink(outfile_name)
     
+    def Download(self, url, filename):
+        data = OpenURL(url)
+        outfile = open(filename, 'wb+')
+        try:
+            while True:
+                chunk = data.read(CLONE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                outfile.write(chunk)
+                if self.throttle:
+                    self.throttle.Consume(len(chunk))
+        finally:
+            outfile.close()
+            data.close()
+
+    def LoadInitSegment(self, url, path_out):
+        # the init segment is cloned by another representation, but the track ids
+        # and the fragments info for the encryption are needed here too
+        self.init_filename = os.path.join(self.root_dir, path_out.lstrip('/'))+'.%x.tmp' % id(self)
+        self.Download(url, self.init_filename)
+        self.track_ids = GetTrackIds(self.init_filename)
+
     def Cleanup(self):
         if (self.init_filename):
             os.unlink(self.init_filename)
+
+class OutputPaths:
+    # the URL cloned to each path, and the representation that clones it. A URL
+    # shared by several representations (the init segment and templates of the
+    # content periods around an ad, for example) is only cloned once, two
+    # different URLs cloned to the same file are an error rather than a silent
+    # overwrite
+    def __init__(self):
+        self.owners = {}
+        self.lock   = threading.Lock()
+
+    def Claim(self, path, url, representation):
+        # returns True if the representation clones the URL, False if another one does
+        with self.lock:
+            (owner_url, owner) = self.owners.setdefault(path, (url, representation))
+        if owner_url != url:
+            raise Exception(self.Describe(owner)+' and '+self.Describe(representation)+' clone different URLs to '+path+' ('+owner_url+' and '+url+')')
+        return owner is representation
+
+    def Describe(self, representation):
+        period = representation.parent.parent
+        return 'representation '+str(representation.id)+' of period '+str(period.parent.periods.index(period)+1)
+
+def CloneRepresentation(root_dir, representation, throttle, output_paths):
+    cloner = Cloner(root_dir, throttle)
+
+    # compute the base URL
+    base_url = representation.base_url
+    if Options.verbose:
+        print 'Base URL = '+base_url
+        
+    # process the init segment
+    if Options.verbose:
+        print '### Processing Initialization Segment'
+    url = ComputeUrl(base_url, representation.init_segment_url)
+    path_out = representation.ComputeOutputPath(representation.init_segment_url)
+    if output_paths.Claim(path_out, url, representation):
+        cloner.CloneSegment(url, path_out, True)
+    elif Options.encrypt:
+        cloner.LoadInitSegment(url, path_out)
+
+    # process all segment URLs (when their number is not known
+    # in advance, until one of them cannot be loaded)
+    if Options.verbose:
+        print '### Processing Media Segments for AdaptationSet', representation.id
+    for seg_url in representation.GenerateSegmentUrls():
+        url = ComputeUrl(base_url, seg_url)
+        path_out = representation.ComputeOutputPath(seg_url)
+        if not output_paths.Claim(path_out, url, representation):
+            continue
+        try:
+            cloner.CloneSegment(url, path_out, False)
+        except (urllib2.HTTPError, urllib2.URLError, IOError):
+            # move to the next representation
+            break
+    
+    # cleanup the init segment    
+    cloner.Cleanup()
+
+class CloneScheduler:
+    # clones the representations, of all the periods, as they are parsed, with
+    # at most max_concurrency of them at a time (in the calling thread if 1)
+    def __init__(self, root_dir, max_concurrency=1, max_bandwidth=0):
+        self.root_dir = root_dir
+        self.throttle = None
+        if max_bandwidth > 0:
+            self.throttle = BandwidthThrottle(max_bandwidth)
+        self.pool = None
+        if max_concurrency > 1:
+            self.pool = multiprocessing.pool.ThreadPool(max_concurrency)
+        self.output_paths = OutputPaths()
+        self.results = []
+
+    def Add(self, representation):
+        # the paths of the segments, when they are known in advance, are checked
+        # before the representation is cloned
+        for url in [representation.init_segment_url]+(representation.ListSegmentUrls() or []):
+            self.output_paths.Claim(representation.ComputeOutputPath(url), ComputeUrl(representation.base_url, url), representation)
+        if self.pool:
+            self.results.append(self.pool.apply_async(CloneRepresentation, (self.root_dir, representation, self.throttle, self.output_paths)))
+        else:
+            CloneRepresentation(self.root_dir, representation, self.throttle, self.output_paths)
+
+    def Wait(self):
+        # wait for all the representations, and raise the first error if any
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        for result in self.results:
+            result.get()
         
 def main():
     # determine the platform binary name
@@ -397,6 +665,12 @@ def main():
     parser.add_option('', "--exec-dir", metavar="<exec_dir>",
                       dest="exec_dir", default=os.path.join(SCRIPT_PATH, 'bin', platform),
                       help="Directory where the Bento4 executables are located")    
+    parser.add_option('', "--jobs", metavar="<n>", type="int",
+                      dest="jobs", default=1,
+                      help="Number of representations cloned in parallel, from any period (default: 1)")
+    parser.add_option('', "--max-bandwidth", metavar="<bits-per-second>", type="float",
+                      dest="max_bandwidth", default=0,
+                      help="Maximum total download rate (default: no limit)")
                       
     global Options
     (Options, args) = parser.parse_args()
@@ -412,54 +686,35 @@ def main():
             raise Exception('Invalid argument for --encrypt option')
         Options.kid = Options.encrypt[:32].decode('hex')
         Options.key = Options.encrypt[33:].decode('hex') 
+
+    # the Bento4 tools are run through the executor shared with mp4-dash.py
+    if Options.jobs < 1:
+        raise Exception('--jobs must be at least 1')
+    Options.executor = Bento4Executor(Options.exec_dir, Options.jobs, verbose=Options.verbose)
         
     # create the output dir
     MakeNewDir(output_dir, True)
     
-    # load and parse the MPD
+    # load the MPD, the representations are cloned as soon as they are parsed
     if Options.verbose: print "Loading MPD from", mpd_url
     try:
-        mpd_xml = OpenURL(mpd_url).read()
+        mpd_file = OpenURL(mpd_url)
     except Exception as e:
         print "ERROR: failed to load MPD:", e
         sys.exit(1)
         
     if Options.verbose: print "Parsing MPD"
-    mpd_xml = mpd_xml.replace('nitialisation', 'nitialization')
-    mpd = ParseMpd(mpd_url, mpd_xml)
+    mpd_reader = DashMpdReader(mpd_url, mpd_file)
+
+    scheduler = CloneScheduler(output_dir, Options.jobs, Options.max_bandwidth)
+    for representation in mpd_reader.ReadRepresentations():
+        scheduler.Add(representation)
+    scheduler.Wait()
+    mpd = mpd_reader.mpd
         
     ElementTree.register_namespace('', DASH_NS_URN)
     ElementTree.register_namespace('mas', MARLIN_MAS_NS_URN)
 
-    cloner = Cloner(output_dir)
-    for period in mpd.periods:
-        for adaptation_set in period.adaptation_sets:
-            for representation in adaptation_set.representations:
-                # compute the base URL
-                base_url = representation.AttributeLookup('base_urls')[0]
-                if Options.verbose:
-                    print 'Base URL = '+base_url
-                    
-                # process the init segment
-                if Options.verbose:
-                    print '### Processing Initialization Segment'
-                url = ComputeUrl(base_url, representation.init_segment_url)
-                cloner.CloneSegment(url, representation.init_segment_url, True)
-
-                # process all segment URLs                
-                if Options.verbose:
-                    print '### Processing Media Segments for AdaptationSet', representation.id
-                for seg_url in representation.GenerateSegmentUrls():
-                    url = ComputeUrl(base_url, seg_url)
-                    try:
-                        cloner.CloneSegment(url, seg_url, False)
-                    except (urllib2.HTTPError, urllib2.URLError, IOError):
-                        # move to the next representation
-                        break
-                
-                # cleanup the init segment    
-                cloner.Cleanup()
-                
     # modify the MPD if needed
     if Options.encrypt:
         for p in mpd.xml.findall(DASH_NS+'Period'):
@@ -474,6 +729,10 @@ def main():
     # write the MPD    
     xml_tree = ElementTree.ElementTree(mpd.xml)
     xml_tree.write(os.path.join(output_dir, os.path.basename(urlparse.urlparse(mpd_url).path)), encoding="UTF-8", xml_declaration=True)
+
+    if Options.verbose:
+        for line in Options.executor.format_stats():
+            print 'TOOL STATS:', line
     
 ###########################    
 SCRIPT_PATH = os.path.abspath(os.path.dirname(__file__))
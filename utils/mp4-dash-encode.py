@@ -3,6 +3,8 @@ from mp4utils import *
 from subprocess import check_output, CalledProcessError
 import json
 import math
+import tempfile
+import pipes
 
 # setup main options
 VERSION = "1.0.0"
@@ -19,15 +21,19 @@ def scale_resolution(pixels, aspect_ratio):
     y = RESOLUTION_ROUNDING_V*((int(math.ceil(x/aspect_ratio))+RESOLUTION_ROUNDING_V-1)/RESOLUTION_ROUNDING_V)
     return (x,y)
 
-def compute_bitrates_and_resolutions(options):
+def spread_bitrates(min_bitrate, max_bitrate, count):
     # spread the bitrates evenly
-    if options.bitrates > 1:
-        delta = (options.max_bitrate-options.min_bitrate)/(options.bitrates-1)
+    if count > 1:
+        delta = (max_bitrate-min_bitrate)/(count-1)
+        return [min_bitrate+delta*i for i in range(count)]
     else:
-        delta = 0
-    bitrates = [options.min_bitrate+delta*i for i in range(options.bitrates)]
+        return [max_bitrate]
+
+def compute_resolutions(options, bitrates, full_resolution_bitrate):
+    # the number of pixels grows with the bitrate to the power of 4/3, up to
+    # the resolution of the source at full_resolution_bitrate
     max_pixels = options.resolution[0]*options.resolution[1]
-    pixels = [max_pixels*pow(bitrate/options.max_bitrate, 4.0/3.0) for bitrate in bitrates]
+    pixels = [max_pixels*pow(min(1.0, bitrate/full_resolution_bitrate), 4.0/3.0) for bitrate in bitrates]
     resolutions = [scale_resolution(x, float(options.resolution[0])/float(options.resolution[1])) for x in pixels]
     bits_per_pixel = [1000.0*bitrates[i]/(24*pixels[i]) for i in range(len(pixels))]
 
@@ -37,35 +43,80 @@ def compute_bitrates_and_resolutions(options):
         print 'RESOLUTIONS: ', resolutions
         print 'BITS PER PIXEL:', bits_per_pixel
 
-    return (bitrates, resolutions)
+    return resolutions
+
+def remove_duplicate_rungs(bitrates, resolutions):
+    # when the range of bitrates collapses (for example when the per-title max
+    # bitrate is the min bitrate), the rungs with the same bitrate (which gives
+    # them the same resolution and output file name) are only encoded once
+    rungs = []
+    for (bitrate, resolution) in zip(bitrates, resolutions):
+        if not rungs or int(bitrate) != int(rungs[-1][0]):
+            rungs.append((bitrate, resolution))
+    if len(rungs) < len(bitrates):
+        sys.stderr.write('WARNING: only %d distinct bitrates out of %d\n' % (len(rungs), len(bitrates)))
+    return ([bitrate for (bitrate, resolution) in rungs], [resolution for (bitrate, resolution) in rungs])
+
+def compute_bitrates_and_resolutions(options):
+    bitrates = spread_bitrates(options.min_bitrate, options.max_bitrate, options.bitrates)
+    return (bitrates, compute_resolutions(options, bitrates, options.max_bitrate))
+
+def compute_per_title_bitrates_and_resolutions(options, analysis):
+    # the bitrate the title needs at the full resolution, extrapolated from the
+    # bitrate of the analysis encode with the inverse of the same power law
+    probe_pixels = analysis['width']*analysis['height']
+    max_pixels = options.resolution[0]*options.resolution[1]
+    full_resolution_bitrate = analysis['bitrate']*pow(float(max_pixels)/probe_pixels, 3.0/4.0)
+
+    # content that is easy to encode does not need the max bitrate, hard content
+    # gets the max bitrate at a lower resolution
+    max_bitrate = max(options.min_bitrate, min(options.max_bitrate, full_resolution_bitrate))
+    bitrates = spread_bitrates(options.min_bitrate, max_bitrate, options.bitrates)
+
+    if options.debug:
+        print 'FULL RESOLUTION BITRATE:', full_resolution_bitrate
+
+    return (bitrates, compute_resolutions(options, bitrates, full_resolution_bitrate))
 
 def run_command(options, cmd):
     if options.debug:
         print 'COMMAND: ', cmd
     try:
-        return check_output(cmd, shell=True)
+        return check_output(cmd)
     except CalledProcessError, e:
         message = "binary tool failed with error %d" % e.returncode
         if options.verbose:
             message += " - " + str(cmd)
         raise Exception(message)
 
+FFPROBE_CACHE_KEY = 'ffprobe -of json -show_format -show_streams'
+
 class MediaSource:
-    def __init__(self, options, filename):
+    def __init__(self, options, filename, cache):
         self.width = 0
         self.height = 0
         self.frame_rate = 0
+        self.duration = 0
+        self.has_audio = False
 
-        if not options.debug:
-            quiet = '-v quiet '
-        else:
-            quiet = ''
-
-        command = 'ffprobe -of json -show_format -show_streams '+quiet+filename
-        json_probe = run_command(options, command)
-        self.json_info = json.loads(json_probe, strict=False)
+        # the full output of ffprobe is kept in the cache, so that the
+        # source is only probed again when its content changes
+        self.json_info = cache.get(filename, 'probe', FFPROBE_CACHE_KEY)
+        if self.json_info is None:
+            command = ['ffprobe', '-of', 'json', '-show_format', '-show_streams']
+            if not options.debug:
+                command += ['-v', 'quiet']
+            json_probe = run_command(options, command+[filename])
+            self.json_info = json.loads(json_probe, strict=False)
+            cache.set(filename, 'probe', FFPROBE_CACHE_KEY, self.json_info)
+            cache.save()
+        elif options.verbose:
+            print 'Using the cached probe of', filename
+        self.duration = float(self.json_info.get('format', {}).get('duration', 0))
 
         for stream in self.json_info['streams']:
+            if stream['codec_type'] == 'audio':
+                self.has_audio = True
             if stream['codec_type'] == 'video':
                 self.width = stream['width']
                 self.height = stream['height']
@@ -84,6 +135,114 @@ class MediaSource:
     def __repr__(self):
         return 'Video: resolution='+str(self.width)+'x'+str(self.height)
 
+ENCODING_CACHE_FILENAME = '.mp4-dash-encode-cache.json'
+
+class EncodingCache:
+    # what the previous runs learned about the sources, under the digest of
+    # their content, so that a source is only probed and analyzed once
+    def __init__(self, filename):
+        self.filename = filename
+        self.inputs   = {}
+        self.sources  = {}
+        if filename and path.exists(filename):
+            try:
+                cache = json.load(open(filename))
+                self.inputs  = cache['inputs']
+                self.sources = cache['sources']
+            except Exception, e:
+                sys.stderr.write('WARNING: ignoring the encoding cache ' + filename + ' (' + str(e) + ')\n')
+                self.inputs  = {}
+                self.sources = {}
+
+    def get_digest(self, filename):
+        # the digest of the content is only recomputed when the size or the modification time changed
+        stat = os.stat(filename)
+        key = path.abspath(filename)
+        entry = self.inputs.get(key)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': ComputeFileDigest(filename)}
+            self.inputs[key] = entry
+        return entry['digest']
+
+    def get(self, filename, kind, key):
+        if not self.filename:
+            return None
+        return self.sources.get(self.get_digest(filename), {}).get(kind, {}).get(key)
+
+    def set(self, filename, kind, key, value):
+        if not self.filename:
+            return
+        self.sources.setdefault(self.get_digest(filename), {}).setdefault(kind, {})[key] = value
+
+    def save(self):
+        if not self.filename:
+            return
+        # other runs may have saved the cache in the meantime, keep what they added
+        if path.exists(self.filename):
+            previous = EncodingCache(self.filename)
+            for (digest, entries) in self.sources.iteritems():
+                for (kind, values) in entries.iteritems():
+                    previous.sources.setdefault(digest, {}).setdefault(kind, {}).update(values)
+            previous.inputs.update(self.inputs)
+            (self.inputs, self.sources) = (previous.inputs, previous.sources)
+        WriteFileAtomically(self.filename, json.dumps({'inputs': self.inputs, 'sources': self.sources}, indent=2, separators=(',', ': '), sort_keys=True))
+
+ANALYSIS_VERSION     = 1
+ANALYSIS_PROBE_WIDTH = 640
+
+def analyze_source(options, media_source, filename):
+    # encode a few windows spread over the source, at a low resolution and a
+    # constant quality: the bitrate the encoder needs for them measures how
+    # hard the title is to compress
+    width = min(media_source.width, ANALYSIS_PROBE_WIDTH)
+    height = RESOLUTION_ROUNDING_V*int(round(float(width*media_source.height)/media_source.width/RESOLUTION_ROUNDING_V))
+    if media_source.duration > options.analysis_duration:
+        window_duration = float(options.analysis_duration)/options.analysis_windows
+        step = media_source.duration/options.analysis_windows
+        windows = [(step*i+(step-window_duration)/2, window_duration) for i in range(options.analysis_windows)]
+    else:
+        windows = [(0.0, media_source.duration or float(options.analysis_duration))]
+
+    (fd, temp_filename) = tempfile.mkstemp(suffix='.mp4')
+    os.close(fd)
+    try:
+        results = []
+        for (start, duration) in windows:
+            cmd = ['ffmpeg', '-ss', '%.3f' % start, '-i', filename, '-t', '%.3f' % duration, '-an',
+                   '-vcodec', 'libx264', '-preset', 'veryfast', '-crf', str(options.analysis_crf), '-s', '%dx%d' % (width, height)]
+            if not options.debug:
+                cmd += ['-v', 'quiet']
+            cmd += ['-y', '-f', 'mp4', temp_filename]
+            run_command(options, cmd)
+            bitrate = 8.0*os.path.getsize(temp_filename)/duration/1000.0
+            if options.debug:
+                print 'ANALYSIS WINDOW: start=%.3f duration=%.3f bitrate=%.1f' % (start, duration, bitrate)
+            results.append({'start': start, 'duration': duration, 'bitrate': bitrate})
+    finally:
+        os.unlink(temp_filename)
+
+    total_duration = sum([result['duration'] for result in results])
+    return {'width':   width,
+            'height':  height,
+            'bitrate': sum([result['bitrate']*result['duration'] for result in results])/total_duration,
+            'windows': results}
+
+def get_source_analysis(options, cache, media_source, filename):
+    # the analysis depends on its parameters as well as on the source
+    key = 'v%d crf=%d windows=%d duration=%g' % (ANALYSIS_VERSION, options.analysis_crf, options.analysis_windows, options.analysis_duration)
+    analysis = cache.get(filename, 'analysis', key)
+    if analysis is None:
+        if options.verbose:
+            print 'ANALYZING', filename
+        analysis = analyze_source(options, media_source, filename)
+        cache.set(filename, 'analysis', key, analysis)
+        cache.save()
+    elif options.verbose:
+        print 'Using the cached analysis of', filename
+    if options.verbose:
+        print 'Analysis: %dx%d at %.1f kbps' % (analysis['width'], analysis['height'], analysis['bitrate'])
+    return analysis
+
 def main():
     # parse options
     global Options
@@ -96,7 +255,7 @@ def main():
     parser.add_option('-k', '--keep-files', dest="keep_files", action='store_true', default=False,
                       help="Keep intermediate files")
     parser.add_option('-o', '--output-dir', dest="output_dir",
-                      help="Output directory", metavar="<output-dir>", default='output')
+                      help="Output directory of the packaged title, in the --job-file line (default: output)", metavar="<output-dir>", default='output')
     parser.add_option('-b', '--bitrates', dest="bitrates",
                       help="Number of bitrates (default: 1)", default=1, type='int')
     parser.add_option('-r', '--resolution', dest='resolution',
@@ -115,6 +274,24 @@ def main():
                       help="Add a text overlay with the bitrate")
     parser.add_option('-f', '--force', dest="force_output", action="store_true",
                       help="Overwrite output files if they already exist", default=False)
+    parser.add_option('', '--separate-audio', dest='separate_audio', action='store_true', default=False,
+                      help="Encode the audio once, into its own file (audio.mp4), and the video bitrates without audio")
+    parser.add_option('', '--job-file', dest='job_filename', metavar='<filename>', default=None,
+                      help="Append a line with the files to package to <filename> (a job file for mp4-dash.py --batch)")
+    parser.add_option('', '--exec-dir', dest="exec_dir", metavar="<exec_dir>", default=None,
+                      help="Directory where the Bento4 executables are located (default: search the PATH)")
+    parser.add_option('', '--ladder', dest='ladder', metavar='linear|per-title', choices=['linear', 'per-title'], default='linear',
+                      help="How the bitrates and resolutions are chosen: linear (spread evenly between the min and max bitrates) or per-title (from the complexity of the source, measured by a fast analysis encode) (default: linear)")
+    parser.add_option('', '--analysis-crf', dest='analysis_crf', metavar='<crf>', type='int', default=23,
+                      help="Constant quality of the analysis encode, the quality the per-title ladder aims for (default: 23)")
+    parser.add_option('', '--analysis-duration', dest='analysis_duration', metavar='<seconds>', type='float', default=60.0,
+                      help="Total duration of the source encoded by the analysis (default: 60)")
+    parser.add_option('', '--analysis-windows', dest='analysis_windows', metavar='<n>', type='int', default=6,
+                      help="Number of windows, spread over the source, that the analysis encodes (default: 6)")
+    parser.add_option('', '--cache', dest='cache_filename', metavar='<filename>', default=ENCODING_CACHE_FILENAME,
+                      help="File where the probe and the analysis of the sources are kept between runs (default: "+ENCODING_CACHE_FILENAME+")")
+    parser.add_option('', '--no-cache', dest='cache_filename', action='store_const', const=None,
+                      help="Do not keep the probe and the analysis of the sources between runs")
     (options, args) = parser.parse_args()
     Options = options
     if len(args) == 0:
@@ -133,10 +310,14 @@ def main():
         if not options.video_profile in ['main', 'baseline']:
             raise Exception('ERROR: unknown video encoding profile')
 
+    if options.analysis_windows < 1 or options.analysis_duration <= 0:
+        raise Exception('ERROR: the analysis needs at least one window and a positive duration')
+
     if options.verbose:
         print 'Encoding', options.bitrates, 'bitrates, min bitrate =', options.min_bitrate, 'max bitrate =', options.max_bitrate
 
-    media_source = MediaSource(options, args[0])
+    cache = EncodingCache(options.cache_filename)
+    media_source = MediaSource(options, args[0], cache)
     if not options.resolution:
         options.resolution = [media_source.width, media_source.height]
     if options.verbose:
@@ -145,38 +326,85 @@ def main():
     if not options.segment_size:
         options.segment_size = 3*int(media_source.frame_rate+0.5)
 
-    if options.bitrates == 1:
-        options.min_bitrate = options.max_bitrate
+    if options.ladder == 'per-title':
+        analysis = get_source_analysis(options, cache, media_source, args[0])
+        (bitrates, resolutions) = compute_per_title_bitrates_and_resolutions(options, analysis)
+    else:
+        if options.bitrates == 1:
+            options.min_bitrate = options.max_bitrate
+        (bitrates, resolutions) = compute_bitrates_and_resolutions(options)
+    (bitrates, resolutions) = remove_duplicate_rungs(bitrates, resolutions)
+
+    # the Bento4 tools are run through the executor shared with mp4-dash.py
+    executor = Bento4Executor(options.exec_dir, debug=options.debug, verbose=options.verbose)
+    output_filenames = []
+
+    audio_opts = ['-strict', 'experimental', '-acodec', 'libfdk_aac', '-ac', '2', '-ab', '%dk' % (options.audio_bitrate)]
+    if options.separate_audio:
+        # encode the audio once, with fragments as long as the video segments,
+        # the video bitrates are encoded without audio
+        if media_source.has_audio:
+            output_filename = 'audio.mp4'
+            temp_filename = output_filename+'_'
+            cmd = ['ffmpeg', '-i', args[0], '-vn'] + audio_opts
+            if not options.debug:
+                cmd += ['-v', 'quiet']
+            if options.force_output:
+                cmd += ['-y']
+            cmd += ['-f', 'mp4', temp_filename]
+            if options.verbose:
+                print 'ENCODING audio bitrate: %d' % (options.audio_bitrate)
+            run_command(options, cmd)
+
+            fragment_duration = int(1000.0*options.segment_size/media_source.frame_rate)
+            executor.run('mp4fragment', temp_filename, output_filename, fragment_duration=str(fragment_duration))
+            output_filenames.append(output_filename)
 
-    (bitrates, resolutions) = compute_bitrates_and_resolutions(options)
+            if not options.keep_files:
+                os.unlink(temp_filename)
+        audio_opts = ['-an']
 
-    for i in range(options.bitrates):
+    for i in range(len(bitrates)):
         output_filename = 'video_%05d.mp4' % int(bitrates[i])
         temp_filename = output_filename+'_'
-        base_cmd  = "ffmpeg -i %s -strict experimental -acodec libfdk_aac -ac 2 -ab %dk -profile:v baseline -preset slow -vcodec libx264" % (args[0], options.audio_bitrate)
+        base_cmd  = ['ffmpeg', '-i', args[0]] + audio_opts + ['-profile:v', 'baseline', '-preset', 'slow', '-vcodec', 'libx264']
         if options.text_overlay:
-            base_cmd += ' -vf "drawtext=fontfile=/Library/Fonts/Courier New.ttf: text='+str(int(bitrates[i]))+'kbps '+str(resolutions[i][0])+'*'+str(resolutions[i][1])+': fontsize=50:  x=(w)/8: y=h-(2*lh): fontcolor=white:"'
+            base_cmd += ['-vf', 'drawtext=fontfile=/Library/Fonts/Courier New.ttf: text='+str(int(bitrates[i]))+'kbps '+str(resolutions[i][0])+'*'+str(resolutions[i][1])+': fontsize=50:  x=(w)/8: y=h-(2*lh): fontcolor=white:']
         if not options.debug:
-            base_cmd += ' -v quiet'
+            base_cmd += ['-v', 'quiet']
         if options.force_output:
-            base_cmd += ' -y'
+            base_cmd += ['-y']
         if options.video_profile:
-            base_cmd += ' -profile:v '+options.video_profile
+            base_cmd += ['-profile:v', options.video_profile]
 
         #x264_opts = "-x264opts keyint=%d:min-keyint=%d:scenecut=0:rc-lookahead=%d" % (options.segment_size, options.segment_size, options.segment_size)
-        x264_opts = "-force_key_frames 'expr:eq(mod(n,%d),0)' -x264opts rc-lookahead=%d" % (options.segment_size, options.segment_size)
-        x264_opts += ':vbv-bufsize=%d:vbv-maxrate=%d' % (bitrates[i], int(bitrates[i]*1.5))
-        cmd = base_cmd+' '+x264_opts+' -s '+str(resolutions[i][0])+'x'+str(resolutions[i][1])+' -f mp4 '+temp_filename
+        x264_opts = ['-force_key_frames', 'expr:eq(mod(n,%d),0)' % (options.segment_size),
+                     '-x264opts', 'rc-lookahead=%d:vbv-bufsize=%d:vbv-maxrate=%d' % (options.segment_size, bitrates[i], int(bitrates[i]*1.5))]
+        cmd = base_cmd+x264_opts+['-s', str(resolutions[i][0])+'x'+str(resolutions[i][1]), '-f', 'mp4', temp_filename]
         if options.verbose:
             print 'ENCODING bitrate: %d, resolution: %dx%d' % (int(bitrates[i]), resolutions[i][0], resolutions[i][1])
         run_command(options, cmd)
 
-        cmd = 'mp4fragment %s %s' % (temp_filename, output_filename)
-        run_command(options, cmd)
+        executor.run('mp4fragment', temp_filename, output_filename)
+        output_filenames.insert(i, output_filename)
 
         if not options.keep_files:
             os.unlink(temp_filename)
 
+    # the files to package with mp4-dash.py
+    if options.verbose:
+        print 'Files to package:', ' '.join(output_filenames)
+    if options.job_filename:
+        # the line packages the title to its own output directory, with absolute
+        # paths, so that job lines appended by runs in other directories work too
+        job = ['-o', path.abspath(options.output_dir)]+[path.abspath(filename) for filename in output_filenames]
+        with open(options.job_filename, 'a') as job_file:
+            job_file.write(' '.join([pipes.quote(arg) for arg in job])+'\n')
+
+    if options.verbose:
+        for line in executor.format_stats():
+            print 'TOOL STATS:', line
+
 ###########################
 if __name__ == '__main__':
     global Options
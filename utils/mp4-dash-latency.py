@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+###
+# Measures the latency of the low latency live mode of mp4-dash.py.
+# The fragments of the source files are appended one by one, in real time,
+# to growing copies of the sources packaged by mp4-dash.py --live --live-chunks,
+# and the latency of each chunk is the time between its appearance in the
+# copy and its availability in the output directory.
+
+from optparse import OptionParser
+from subprocess import Popen
+import shutil
+from mp4utils import *
+
+SCRIPT_PATH = path.abspath(path.dirname(__file__))
+
+class LiveSource:
+    # growing copy of a source file, with the chunks appended so far
+    def __init__(self, filename, live_filename):
+        self.filename      = filename
+        self.live_filename = live_filename
+        self.data          = open(filename, 'rb').read()
+        self.header        = ''
+        self.chunks        = []
+        self.trailer       = ''
+        for atom in WalkAtoms(filename):
+            atom_data = self.data[atom.position:atom.position+atom.size]
+            if atom.type == 'moof':
+                self.chunks.append(atom_data)
+            elif self.chunks and atom.type == 'mdat':
+                self.chunks[-1] += atom_data
+            elif self.chunks:
+                self.trailer += atom_data
+            else:
+                self.header += atom_data
+        self.append_times    = []
+        self.available_times = []
+        self.output_dir      = None
+
+    def append(self, data):
+        file = open(self.live_filename, 'ab')
+        file.write(data)
+        file.close()
+
+    def append_chunk(self):
+        self.append(self.chunks[len(self.append_times)])
+        self.append_times.append(time.time())
+
+    def find_output_dir(self, output_dir):
+        # the init segment is the header of the source
+        for (dirpath, dirnames, filenames) in os.walk(output_dir):
+            init_filename = path.join(dirpath, 'init.mp4')
+            if 'init.mp4' in filenames and open(init_filename, 'rb').read() == self.header:
+                self.output_dir = dirpath
+
+    def check_output(self, output_dir, chunk_count, segment_url_pattern):
+        # record the time at which the chunks appended so far are available
+        if self.output_dir is None:
+            self.find_output_dir(output_dir)
+            if self.output_dir is None:
+                return
+        now = time.time()
+        while len(self.available_times) < len(self.append_times):
+            chunk_index = len(self.available_times)
+            segment_index = chunk_index/chunk_count
+            segment_filename = path.join(self.output_dir, segment_url_pattern % segment_index)
+            segment_size = sum([len(chunk) for chunk in self.chunks[segment_index*chunk_count:chunk_index+1]])
+            if not path.exists(segment_filename) or os.path.getsize(segment_filename) < segment_size:
+                break
+            self.available_times.append(now)
+
+    def get_latencies(self):
+        return [available-appended for (appended, available) in zip(self.append_times, self.available_times)]
+
+def ComputeStats(latencies):
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+    return {'count':   len(latencies),
+            'min':     latencies[0],
+            'average': sum(latencies)/len(latencies),
+            'p95':     latencies[min(len(latencies)-1, int(0.95*len(latencies)))],
+            'max':     latencies[-1]}
+
+def main():
+    parser = OptionParser(usage="%prog [options] <media-file> [<media-file> ...]",
+                          description="Each <media-file> is a fragmented MP4 file with a single track, the fragments being the chunks of the live stream")
+    parser.add_option('', '--verbose', dest="verbose", action='store_true', default=False,
+                      help="Be verbose")
+    parser.add_option('', '--chunks', dest="chunk_count", metavar="<n>", type="int", default=4,
+                      help="Number of chunks per segment (default: 4)")
+    parser.add_option('', '--chunk-interval', dest="chunk_interval", metavar="<seconds>", type="float", default=None,
+                      help="Time between two chunk appends (default: the duration of a chunk)")
+    parser.add_option('', '--update-interval', dest="update_interval", metavar="<seconds>", type="float", default=0.05,
+                      help="How often the packager looks for new chunks (default: 0.05)")
+    parser.add_option('', '--poll-interval', dest="poll_interval", metavar="<seconds>", type="float", default=0.005,
+                      help="How often the output directory is checked (default: 0.005)")
+    parser.add_option('', '--work-dir', dest="work_dir", metavar="<dir>", default=None,
+                      help="Directory for the growing inputs and the output (default: a temporary directory, removed at the end)")
+    parser.add_option('', '--report', dest="report_filename", metavar="<filename>", default=None,
+                      help="Write the latency of each chunk and the statistics to a JSON file")
+    parser.add_option('', "--exec-dir", metavar="<exec_dir>", dest="exec_dir", default=None,
+                      help="Directory where the Bento4 executables are located")
+    (options, args) = parser.parse_args()
+    if len(args) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    if options.work_dir:
+        work_dir = options.work_dir
+        MakeNewDir(work_dir)
+    else:
+        work_dir = tempfile.mkdtemp()
+    output_dir = path.join(work_dir, 'output')
+
+    sources = []
+    for (index, filename) in enumerate(args):
+        source = LiveSource(filename, path.join(work_dir, 'live-%02d-' % index + path.basename(filename)))
+        if not source.chunks:
+            PrintErrorAndExit('ERROR: no fragment in ' + filename)
+        if path.exists(source.live_filename):
+            os.unlink(source.live_filename)
+        source.append(source.header)
+        sources.append(source)
+    chunk_total = min([len(source.chunks) for source in sources])
+
+    # the chunks are appended in real time, unless told otherwise
+    chunk_interval = options.chunk_interval
+    if chunk_interval is None:
+        info = json.loads(Popen([path.join(options.exec_dir or '', 'mp4info'), '--format', 'json', args[0]], stdout=PIPE).communicate()[0])
+        chunk_interval = info['movie']['duration_ms']/1000.0/len(sources[0].chunks)
+
+    command = [sys.executable, path.join(SCRIPT_PATH, 'mp4-dash.py'),
+               '--live', '--live-chunks', str(options.chunk_count),
+               '--live-update-interval', str(options.update_interval),
+               '--live-idle-timeout', str(max(10.0, 10*chunk_interval)),
+               '-o', output_dir]
+    if options.exec_dir:
+        command += ['--exec-dir', options.exec_dir]
+    command += [source.live_filename for source in sources]
+    if options.verbose:
+        print 'COMMAND:', ' '.join(command)
+    packager = Popen(command, stdout=open(os.devnull, 'wb'))
+
+    try:
+        next_append_time = time.time()
+        for chunk_index in xrange(chunk_total):
+            for source in sources:
+                source.append_chunk()
+            next_append_time += chunk_interval
+            while time.time() < next_append_time:
+                for source in sources:
+                    source.check_output(output_dir, options.chunk_count, 'seg-%d.m4f')
+                time.sleep(options.poll_interval)
+            if packager.poll() is not None:
+                PrintErrorAndExit('ERROR: mp4-dash.py exited with code ' + str(packager.returncode))
+
+        # wait for the last chunks, then end the stream
+        deadline = time.time()+max(10.0, 10*chunk_interval)
+        while time.time() < deadline and any([len(source.available_times) < chunk_total for source in sources]):
+            for source in sources:
+                source.check_output(output_dir, options.chunk_count, 'seg-%d.m4f')
+            time.sleep(options.poll_interval)
+        for source in sources:
+            source.append(source.trailer)
+        packager.wait()
+    finally:
+        if packager.poll() is None:
+            packager.kill()
+
+    report = {'chunk_count': options.chunk_count, 'chunk_interval': chunk_interval, 'update_interval': options.update_interval, 'sources': []}
+    for source in sources:
+        latencies = source.get_latencies()
+        stats = ComputeStats(latencies)
+        report['sources'].append({'filename': source.filename, 'latencies': latencies, 'stats': stats})
+        if len(latencies) < chunk_total:
+            sys.stderr.write('WARNING: %d chunk(s) of %s never became available\n' % (chunk_total-len(latencies), source.filename))
+        if stats:
+            print '%s: %d chunks, latency min=%.3f avg=%.3f p95=%.3f max=%.3f s' % (source.filename, stats['count'], stats['min'], stats['average'], stats['p95'], stats['max'])
+    if options.report_filename:
+        json.dump(report, open(options.report_filename, 'wb'), indent=2, separators=(',', ': '), sort_keys=True)
+
+    if not options.work_dir:
+        shutil.rmtree(work_dir)
+
+###########################
+if __name__ == '__main__':
+    main()
@@ -13,10 +13,11 @@ __copyright__ = 'Copyright 2011-2013 Axiomatic Systems, LLC.'
 # Linux x86 --> platform = linux-x86
 # Windows   --> platform = win32
 
-from optparse import OptionParser
+from optparse import OptionParser, Values
 import shutil
+import shlex
+import cProfile
 import xml.etree.ElementTree as xml
-from xml.dom.minidom import parseString
 import tempfile
 from mp4utils import *
 
@@ -43,9 +44,6 @@ PADDED_SEGMENT_TEMPLATE    = 'seg-$Number%04d$.m4f'
 NOPAD_SEGMENT_PATTERN      = 'seg-%llu.m4f'
 NOPAD_SEGMENT_URL_PATTERN  = 'seg-%d.m4f'
 NOPAD_SEGMENT_TEMPLATE     = 'seg-$Number$.m4f'
-SEGMENT_PATTERN            = NOPAD_SEGMENT_PATTERN
-SEGMENT_URL_PATTERN        = NOPAD_SEGMENT_URL_PATTERN
-SEGMENT_TEMPLATE           = NOPAD_SEGMENT_TEMPLATE
 
 MEDIA_FILE_PATTERN        = 'media-%02d.mp4'
 MARLIN_SCHEME_ID_URI      = 'urn:uuid:5E629AF5-38DA-4063-8977-97FFBD9902D4'
@@ -55,18 +53,19 @@ PLAYREADY_SCHEME_ID_URI   = 'urn:uuid:9a04f079-9840-4286-ab92-e65be0885f95'
 PLAYREADY_MSPR_NAMESPACE  = 'urn:microsoft:playready'
 SMOOTH_DEFAULT_TIMESCALE  = 10000000
 SMIL_NAMESPACE            = 'http://www.w3.org/2001/SMIL20/Language'
+MPD_NAMESPACE_PREFIXES    = {MARLIN_MAS_NAMESPACE: 'mas', PLAYREADY_MSPR_NAMESPACE: 'mspr'}
 DASH_MEDIA_SEGMENT_URL_PATTERN_SMOOTH = "/QualityLevels($Bandwidth$)/Fragments(%s=$Time$)"
 DASH_MEDIA_SEGMENT_URL_PATTERN_HIPPO  = '%s/Bitrate($Bandwidth$)/Fragment($Time$)'
-HIPPO_MEDIA_SEGMENT_REGEXP_DEFAULT = '%s/Bitrate\\\\(%d\\\\)/Fragment\\\\((\\\\d+)\\\\)'
-HIPPO_MEDIA_SEGMENT_GROUPS_DEFAULT = '["time"]'
-HIPPO_MEDIA_SEGMENT_REGEXP_SMOOTH  = 'QualityLevels\\\\(%d\\\\)/Fragments\\\\(%s=(\\\\d+)\\\\)'
-HIPPO_MEDIA_SEGMENT_GROUPS_SMOOTH  = '["time"]'
-
-TempFiles = []
+HIPPO_MEDIA_SEGMENT_REGEXP_DEFAULT = '%(stream_id)s/Bitrate\\(%(bandwidth)d\\)/Fragment\\((\\d+)\\)'
+HIPPO_MEDIA_SEGMENT_GROUPS_DEFAULT = ['time']
+HIPPO_MEDIA_SEGMENT_REGEXP_SMOOTH  = 'QualityLevels\\(%(bandwidth)d\\)/Fragments\\(%(stream_id)s=(\\d+)\\)'
+HIPPO_MEDIA_SEGMENT_GROUPS_SMOOTH  = ['time']
+HLS_VERSION                        = 6
+HLS_AUDIO_GROUP_ID                 = 'audio'
 
 
 #############################################
-def AddSegmentList(options, container, subdir, track, use_byte_range=False):
+def AddSegmentList(options, container, subdir, track, element_writers, use_byte_range=False):
     if subdir:
         prefix = subdir+'/'
     else:
@@ -85,22 +84,17 @@ def AddSegmentList(options, container, subdir, track, use_byte_range=False):
         xml.SubElement(segment_list,
                        'Initialization',
                        sourceURL=prefix + track.init_segment_name)
-    i = 0
-    for segment_index in track.moofs:
-        segment = track.parent.segments[segment_index]
-        segment_offset = segment[0].position
-        segment_length = reduce(operator.add, [atom.size for atom in segment], 0)
-        if use_byte_range:
-            byte_range = str(segment_offset) + '-' + str(segment_offset + segment_length - 1)
-            xml.SubElement(segment_list,
-                           'SegmentURL',
-                           media=prefix + track.parent.media_name,
-                           mediaRange=byte_range)
-        else:
-            xml.SubElement(segment_list,
-                           'SegmentURL',
-                           media=prefix + (SEGMENT_URL_PATTERN % i))
-        i += 1
+    # the segment URLs are not added to the tree, they are written straight to
+    # the MPD when it is saved, the ranges from the offsets and lengths computed
+    # once per file
+    if use_byte_range:
+        offsets = track.parent.segment_offsets
+        lengths = track.parent.segment_lengths
+        ranges = ('%d-%d' % (offsets[i], offsets[i]+lengths[i]-1) for i in track.moofs)
+        element_writers[segment_list] = lambda writer: writer.elements('SegmentURL', {'media': prefix + track.parent.media_name}, 'mediaRange', ranges)
+    else:
+        urls = (prefix + (options.segment_url_pattern % i) for i in xrange(len(track.moofs)))
+        element_writers[segment_list] = lambda writer: writer.elements('SegmentURL', {}, 'media', urls)
 
 
 #############################################
@@ -112,7 +106,7 @@ def AddSegmentTemplate(options, container, subdir, track, stream_name):
     init_segment_url = prefix + track.init_segment_name
 
     if options.use_segment_timeline:
-        url_template = prefix + SEGMENT_TEMPLATE
+        url_template = prefix + options.segment_template
         init_segment_url = prefix + track.init_segment_name
         use_template_numbers = True
         if options.smooth:
@@ -127,23 +121,42 @@ def AddSegmentTemplate(options, container, subdir, track, stream_name):
         kwargs = {'timescale': str(track.timescale),
                   'initialization': init_segment_url,
                   'media': url_template}
+        if options.mpd_type == 'dynamic':
+            # only the segments in the time shift window, the first one with its start time
+            start_number = track.timeline.start_number
+            start_time   = track.timeline.start_time
+            runs         = track.timeline.runs
+        else:
+            start_number = 0
+            start_time   = None
+            runs         = ComputeDurationRuns(track.segment_scaled_durations)
         if use_template_numbers:
-            kwargs['startNumber'] = '0'
+            kwargs['startNumber'] = str(start_number)
         segment_template = xml.SubElement(*args, **kwargs)
         segment_timeline = xml.SubElement(segment_template, 'SegmentTimeline')
-        repeat_count = 0
-        for i in range(len(track.segment_scaled_durations)):
-            duration = track.segment_scaled_durations[i]
-            if i + 1 < len(track.segment_scaled_durations) and duration == track.segment_scaled_durations[i + 1]:
-                repeat_count += 1
-            else:
-                args = [segment_timeline, 'S']
-                kwargs = {'d': str(duration)}
-                if repeat_count:
-                    kwargs['r'] = str(repeat_count)
+        for (duration, count) in runs:
+            args = [segment_timeline, 'S']
+            kwargs = {'d': str(duration)}
+            if start_time is not None:
+                kwargs['t'] = str(start_time)
+                start_time = None
+            if count > 1:
+                kwargs['r'] = str(count-1)
 
-                xml.SubElement(*args, **kwargs)
-                repeat_count = 0
+            xml.SubElement(*args, **kwargs)
+    elif options.mpd_type == 'dynamic':
+        # chunked segments, that can be requested as soon as their first chunk is available
+        chunk_count = options.live_chunk_count
+        xml.SubElement(container,
+                       'SegmentTemplate',
+                       timescale=str(track.timescale),
+                       duration=str(track.chunk_duration*chunk_count),
+                       startNumber='0',
+                       presentationTimeOffset=str(track.timeline.start_time),
+                       availabilityTimeOffset='%.3f' % (float(track.chunk_duration*(chunk_count-1))/track.timescale),
+                       availabilityTimeComplete='false',
+                       initialization=init_segment_url,
+                       media=prefix + options.segment_template)
     else:
         xml.SubElement(container,
                        'SegmentTemplate',
@@ -151,13 +164,13 @@ def AddSegmentTemplate(options, container, subdir, track, stream_name):
                        duration=str(int(track.average_segment_duration*1000)),
                        startNumber='0',
                        initialization=init_segment_url,
-                       media=prefix + SEGMENT_TEMPLATE)
+                       media=prefix + options.segment_template)
 
 
 #############################################
-def AddSegments(options, container, subdir, track, use_byte_range, stream_name):
+def AddSegments(options, container, subdir, track, use_byte_range, stream_name, element_writers):
     if options.use_segment_list:
-        AddSegmentList(options, container, subdir, track, use_byte_range)
+        AddSegmentList(options, container, subdir, track, element_writers, use_byte_range)
     else:
         AddSegmentTemplate(options, container, subdir, track, stream_name)
     
@@ -168,7 +181,7 @@ def AddContentProtection(options, container, tracks):
     for track in tracks:
         kid = track.kid
         if kid is None:
-            PrintErrorAndExit('ERROR: no encryption info found in track '+str(track))
+            raise PackagingError('ERROR: no encryption info found in track '+str(track))
         if kid not in kids:
             kids.append(kid)
     xml.SubElement(container, 'ContentProtection', schemeIdUri='urn:mpeg:dash:mp4protection:2011', value='cenc')
@@ -190,7 +203,7 @@ def AddContentProtection(options, container, tracks):
             key = None
         cp = xml.SubElement(container, 'ContentProtection', schemeIdUri=PLAYREADY_SCHEME_ID_URI)
         if options.playready_header:
-            header_bin = ComputePlayReadyHeader(options.playready_header, kid, key)
+            header_bin = options.playready_header_cache.get_header(options.playready_header, kid, key)
             header_b64 = header_bin.encode('base64').replace('\n', '')
             pro = xml.SubElement(cp, '{' + PLAYREADY_MSPR_NAMESPACE + '}pro')
             pro.text = header_b64
@@ -210,15 +223,38 @@ def OutputDash(options, audio_tracks, video_tracks):
         profile = FULL_PROFILE
     else:
         profile = ISOFF_LIVE_PROFILE
-    mpd = xml.Element('MPD', 
-                      xmlns=mpd_ns, 
-                      profiles=profile,
-                      minBufferTime="PT%.02fS" % options.min_buffer_time,
-                      mediaPresentationDuration=XmlDuration(int(presentation_duration)),
-                      type='static')
+    if options.mpd_type == 'dynamic':
+        mpd = xml.Element('MPD',
+                          xmlns=mpd_ns,
+                          profiles=profile,
+                          minBufferTime="PT%.02fS" % options.min_buffer_time,
+                          availabilityStartTime=XmlDateTime(options.availability_start_time),
+                          publishTime=XmlDateTime(time.time()),
+                          type='dynamic')
+        if options.live_ended:
+            # the presentation is over, it ends with the last segment of the video
+            timeline = video_tracks[0].timeline
+            end_time = timeline.end_time
+            if options.live_chunk_count > 1:
+                end_time -= timeline.start_time
+            mpd.set('mediaPresentationDuration', XmlDuration(int(float(end_time)/video_tracks[0].timescale)))
+        else:
+            mpd.set('minimumUpdatePeriod', "PT%.02fS" % options.live_update_interval)
+        if options.live_window:
+            mpd.set('timeShiftBufferDepth', "PT%.02fS" % options.live_window)
+    else:
+        mpd = xml.Element('MPD', 
+                          xmlns=mpd_ns, 
+                          profiles=profile,
+                          minBufferTime="PT%.02fS" % options.min_buffer_time,
+                          mediaPresentationDuration=XmlDuration(int(presentation_duration)),
+                          type='static')
     mpd.append(xml.Comment(' Created with Bento4 mp4-dash.py, VERSION=' + VERSION + '-' + SVN_REVISION[11:-1] + ' '))
     period = xml.SubElement(mpd, 'Period')
 
+    # the elements written to the MPD file by a function rather than from the tree
+    element_writers = {}
+
     # process the audio tracks
     for (language, audio_track) in audio_tracks.iteritems():
         args = [period, 'AdaptationSet']
@@ -245,9 +281,9 @@ def OutputDash(options, audio_tracks, video_tracks):
             subdir = ''
             stream_name = 'audio'
         if options.split:
-            AddSegments(options, representation, 'audio' + subdir, audio_track, False, stream_name)
+            AddSegments(options, representation, 'audio' + subdir, audio_track, False, stream_name, element_writers)
         else:
-            AddSegments(options, representation, None, audio_track, True, stream_name)
+            AddSegments(options, representation, None, audio_track, True, stream_name, element_writers)
         
     # process all the video tracks
     adaptation_set = xml.SubElement(period,
@@ -269,13 +305,28 @@ def OutputDash(options, audio_tracks, video_tracks):
             representation.set('maxPlayoutRate', video_track.max_playout_rate)
 
         if options.split:
-            AddSegments(options, representation, 'video/' + str(video_track.parent.index), video_track, False, 'video')
+            AddSegments(options, representation, 'video/' + str(video_track.parent.index), video_track, False, 'video', element_writers)
         else:
-            AddSegments(options, representation, None, video_track, True, 'video')           
+            AddSegments(options, representation, None, video_track, True, 'video', element_writers)           
         
     # save the MPD
     if options.mpd_filename:
-        open(path.join(options.output_dir, options.mpd_filename), "wb").write(parseString(xml.tostring(mpd)).toprettyxml("  "))
+        with OpenFileAtomically(path.join(options.output_dir, options.mpd_filename)) as mpd_file:
+            XmlStreamWriter(mpd_file).tree(mpd, MPD_NAMESPACE_PREFIXES, element_writers)
+
+
+#############################################
+def AddSmoothChunks(options, writer, durations):
+    if options.smooth_use_chunk_repeats:
+        # Smooth Streaming 2.2 'r' attributes count the chunk itself
+        for (duration, count) in ComputeDurationRuns(durations):
+            if count > 1:
+                writer.element('c', {'d': duration, 'r': count})
+            else:
+                writer.element('c', {'d': duration})
+    else:
+        for duration in durations:
+            writer.element('c', {'d': duration})
 
 
 #############################################
@@ -284,184 +335,284 @@ def OutputSmooth(options, audio_tracks, video_tracks):
     presentation_duration = video_tracks[0].total_duration
 
     # create the Client Manifest
-    client_manifest = xml.Element('SmoothStreamingMedia', 
-                                  MajorVersion="2", 
-                                  MinorVersion="0",
-                                  TimeScale="10000000",
-                                  Duration=str(int(presentation_duration*10000000.0)))
-    client_manifest.append(xml.Comment(' Created with Bento4 mp4-dash.py, VERSION='+VERSION+'-'+SVN_REVISION[11:-1]+' '))
-    
-    # process the audio tracks
-    audio_index = 0
-    for (language, audio_track) in audio_tracks.iteritems():
-        if language:
-            stream_name = "audio_"+language
-        else:
-            stream_name = "audio"
-        audio_url_pattern="QualityLevels({bitrate})/Fragments(%s={start time})" % (stream_name)
-        stream_index = xml.SubElement(client_manifest, 
-                                      'StreamIndex', 
-                                      Chunks=str(len(audio_track.moofs)), 
-                                      Url=audio_url_pattern, 
-                                      Type="audio", 
-                                      Name=stream_name, 
-                                      QualityLevels="1",
-                                      TimeScale=str(audio_track.timescale))
-        if language and language != 'und':
-            stream_index.set('Language', language)
-        xml.SubElement(stream_index,
-                       'QualityLevel',
-                       Bitrate=str(audio_track.bandwidth),
-                       SamplingRate=str(audio_track.sample_rate),
-                       Channels=str(audio_track.channels),
-                       BitsPerSample="16",
-                       PacketSize="4",
-                       AudioTag="255",
-                       FourCC="AACL",
-                       Index="0",
-                       CodecPrivateData=audio_track.info['sample_descriptions'][0]['decoder_info'])
-
-        for duration in audio_track.segment_scaled_durations:
-            xml.SubElement(stream_index, "c", d=str(duration))
-        
-    # process all the video tracks
-    max_width  = max([track.width  for track in video_tracks])
-    max_height = max([track.height for track in video_tracks])
-    video_url_pattern="QualityLevels({bitrate})/Fragments(video={start time})"
-    stream_index = xml.SubElement(client_manifest, 
-                                  'StreamIndex',
-                                   Chunks=str(len(video_tracks[0].moofs)), 
-                                   Url=video_url_pattern, 
-                                   Type="video", 
-                                   Name="video", 
-                                   QualityLevels=str(len(video_tracks)),
-                                   TimeScale=str(video_tracks[0].timescale),
-                                   MaxWidth=str(max_width),
-                                   MaxHeight=str(max_height))
-    qindex = 0
-    for video_track in video_tracks:
-        sample_desc = video_track.info['sample_descriptions'][0]
-        codec_private_data = '00000001'+sample_desc['avc_sps'][0]+'00000001'+sample_desc['avc_pps'][0]
-        xml.SubElement(stream_index,
-                       'QualityLevel',
-                       Bitrate=str(video_track.bandwidth),
-                       MaxWidth=str(video_track.width),
-                       MaxHeight=str(video_track.height),
-                       FourCC="H264",
-                       CodecPrivateData=codec_private_data,
-                       Index=str(qindex))
-        qindex += 1
-
-    for duration in video_tracks[0].segment_scaled_durations:
-        xml.SubElement(stream_index, "c", d=str(duration))
-                
-    if options.playready_header:
-        if options.encryption_key:
-            kid = options.kid_hex
-            key = options.key_hex
-        else:
-            kid = video_tracks[0].kid
-            key = None
-        header_bin = ComputePlayReadyHeader(options.playready_header, kid, key)
-        header_b64 = header_bin.encode('base64').replace('\n', '')
-        protection = xml.SubElement(client_manifest, 'Protection')
-        protection_header = xml.SubElement(protection,
-                                           'ProtectionHeader',
-                                           SystemID='9a04f079-9840-4286-ab92-e65be0885f95')
-        protection_header.text = header_b64
-        
-    # save the Smooth Client Manifest
     if options.smooth_client_manifest_filename != '':
-        open(path.join(options.output_dir, options.smooth_client_manifest_filename), "wb").write(parseString(xml.tostring(client_manifest)).toprettyxml("  "))
-        
+        if options.smooth_use_chunk_repeats:
+            minor_version = '2'
+        else:
+            minor_version = '0'
+        client_manifest_file = open(path.join(options.output_dir, options.smooth_client_manifest_filename), "wb")
+        writer = XmlStreamWriter(client_manifest_file)
+        writer.start('SmoothStreamingMedia',
+                     {'MajorVersion': '2',
+                      'MinorVersion': minor_version,
+                      'TimeScale':    '10000000',
+                      'Duration':     str(int(presentation_duration*10000000.0))})
+        writer.comment(' Created with Bento4 mp4-dash.py, VERSION='+VERSION+'-'+SVN_REVISION[11:-1]+' ')
+
+        # process the audio tracks
+        for (language, audio_track) in audio_tracks.iteritems():
+            if language:
+                stream_name = "audio_"+language
+            else:
+                stream_name = "audio"
+            audio_url_pattern="QualityLevels({bitrate})/Fragments(%s={start time})" % (stream_name)
+            stream_index = {'Chunks':        str(len(audio_track.moofs)),
+                            'Url':           audio_url_pattern,
+                            'Type':          "audio",
+                            'Name':          stream_name,
+                            'QualityLevels': "1",
+                            'TimeScale':     str(audio_track.timescale)}
+            if language and language != 'und':
+                stream_index['Language'] = language
+            writer.start('StreamIndex', stream_index)
+            writer.element('QualityLevel',
+                           {'Bitrate':          str(audio_track.bandwidth),
+                            'SamplingRate':     str(audio_track.sample_rate),
+                            'Channels':         str(audio_track.channels),
+                            'BitsPerSample':    "16",
+                            'PacketSize':       "4",
+                            'AudioTag':         "255",
+                            'FourCC':           "AACL",
+                            'Index':            "0",
+                            'CodecPrivateData': audio_track.info['sample_descriptions'][0]['decoder_info']})
+            AddSmoothChunks(options, writer, audio_track.segment_scaled_durations)
+            writer.end()
+
+        # process all the video tracks
+        max_width  = max([track.width  for track in video_tracks])
+        max_height = max([track.height for track in video_tracks])
+        video_url_pattern="QualityLevels({bitrate})/Fragments(video={start time})"
+        writer.start('StreamIndex',
+                     {'Chunks':        str(len(video_tracks[0].moofs)),
+                      'Url':           video_url_pattern,
+                      'Type':          "video",
+                      'Name':          "video",
+                      'QualityLevels': str(len(video_tracks)),
+                      'TimeScale':     str(video_tracks[0].timescale),
+                      'MaxWidth':      str(max_width),
+                      'MaxHeight':     str(max_height)})
+        qindex = 0
+        for video_track in video_tracks:
+            sample_desc = video_track.info['sample_descriptions'][0]
+            codec_private_data = '00000001'+sample_desc['avc_sps'][0]+'00000001'+sample_desc['avc_pps'][0]
+            writer.element('QualityLevel',
+                           {'Bitrate':          str(video_track.bandwidth),
+                            'MaxWidth':         str(video_track.width),
+                            'MaxHeight':        str(video_track.height),
+                            'FourCC':           "H264",
+                            'CodecPrivateData': codec_private_data,
+                            'Index':            str(qindex)})
+            qindex += 1
+        AddSmoothChunks(options, writer, video_tracks[0].segment_scaled_durations)
+        writer.end()
+
+        if options.playready_header:
+            if options.encryption_key:
+                kid = options.kid_hex
+                key = options.key_hex
+            else:
+                kid = video_tracks[0].kid
+                key = None
+            header_bin = options.playready_header_cache.get_header(options.playready_header, kid, key)
+            header_b64 = header_bin.encode('base64').replace('\n', '')
+            writer.start('Protection')
+            writer.element('ProtectionHeader', {'SystemID': '9a04f079-9840-4286-ab92-e65be0885f95'}, header_b64)
+            writer.end()
+
+        writer.end()
+        client_manifest_file.close()
+
     # create the Server Manifest file
-    server_manifest = xml.Element('smil', xmlns=SMIL_NAMESPACE)
-    server_manifest_head = xml.SubElement(server_manifest, 'head')
-    xml.SubElement(server_manifest_head,
-                   'meta',
-                   name='clientManifestRelativePath',
-                   content=path.basename(options.smooth_client_manifest_filename))
-    server_manifest_body = xml.SubElement(server_manifest, 'body')
-    server_manifest_switch = xml.SubElement(server_manifest_body, 'switch')
-    for (language, audio_track) in audio_tracks.iteritems():
-        audio_entry = xml.SubElement(server_manifest_switch,
-                                     'audio',
-                                     src=audio_track.parent.media_name,
-                                     systemBitrate=str(audio_track.bandwidth))
-        xml.SubElement(audio_entry,
-                       'param',
-                       name='trackID',
-                       value=str(audio_track.id),
-                       valueType='data')
-        if language:
-            xml.SubElement(audio_entry,
-                           'param',
-                           name='trackName',
-                           value="audio_" + language,
-                           valueType='data')
-        if audio_track.timescale != SMOOTH_DEFAULT_TIMESCALE:
-            xml.SubElement(audio_entry,
-                           'param',
-                           name='timeScale',
-                           value=str(audio_track.timescale),
-                           valueType='data')
-        
-    for video_track in video_tracks:
-        video_entry = xml.SubElement(server_manifest_switch,
-                                     'video',
-                                     src=video_track.parent.media_name,
-                                     systemBitrate=str(video_track.bandwidth))
-        xml.SubElement(video_entry,
-                       'param',
-                       name='trackID',
-                       value=str(video_track.id),
-                       valueType='data')
-        if video_track.timescale != SMOOTH_DEFAULT_TIMESCALE:
-            xml.SubElement(video_entry,
-                           'param',
-                           name='timeScale',
-                           value=str(video_track.timescale),
-                           valueType='data')
-    
-    # save the Manifest
     if options.smooth_server_manifest_filename != '':
-        open(path.join(options.output_dir, options.smooth_server_manifest_filename), "wb").write(parseString(xml.tostring(server_manifest)).toprettyxml("  "))
-    
+        server_manifest_file = open(path.join(options.output_dir, options.smooth_server_manifest_filename), "wb")
+        writer = XmlStreamWriter(server_manifest_file)
+        writer.start('smil', {'xmlns': SMIL_NAMESPACE})
+        writer.start('head')
+        writer.element('meta',
+                       {'name':    'clientManifestRelativePath',
+                        'content': path.basename(options.smooth_client_manifest_filename)})
+        writer.end()
+        writer.start('body')
+        writer.start('switch')
+        for (language, audio_track) in audio_tracks.iteritems():
+            writer.start('audio',
+                         {'src':           audio_track.parent.media_name,
+                          'systemBitrate': str(audio_track.bandwidth)})
+            writer.element('param',
+                           {'name':      'trackID',
+                            'value':     str(audio_track.id),
+                            'valueType': 'data'})
+            if language:
+                writer.element('param',
+                               {'name':      'trackName',
+                                'value':     "audio_" + language,
+                                'valueType': 'data'})
+            if audio_track.timescale != SMOOTH_DEFAULT_TIMESCALE:
+                writer.element('param',
+                               {'name':      'timeScale',
+                                'value':     str(audio_track.timescale),
+                                'valueType': 'data'})
+            writer.end()
+
+        for video_track in video_tracks:
+            writer.start('video',
+                         {'src':           video_track.parent.media_name,
+                          'systemBitrate': str(video_track.bandwidth)})
+            writer.element('param',
+                           {'name':      'trackID',
+                            'value':     str(video_track.id),
+                            'valueType': 'data'})
+            if video_track.timescale != SMOOTH_DEFAULT_TIMESCALE:
+                writer.element('param',
+                               {'name':      'timeScale',
+                                'value':     str(video_track.timescale),
+                                'valueType': 'data'})
+            writer.end()
+
+        writer.end()
+        writer.end()
+        writer.end()
+        server_manifest_file.close()
+
 #############################################
 def OutputHippo(options, audio_tracks, video_tracks):
-    # create the Server Manifest file
-    server_manifest = '{\n  "media": [\n'
-    sep = ''
+    # the server manifest is a JSON object of the form:
+    # {"media": [{"trackId": <id>,
+    #             "mediaSegments": {"urls": [{"pattern": <regexp>, "fields": [<group-name>, ...]}],
+    #                               "file": <media-file>},
+    #             "initSegment": {"file": <init-segment-file>}}, ...]}
+    if options.smooth:
+        pattern_template = HIPPO_MEDIA_SEGMENT_REGEXP_SMOOTH
+        pattern_fields   = HIPPO_MEDIA_SEGMENT_GROUPS_SMOOTH
+    else:
+        pattern_template = HIPPO_MEDIA_SEGMENT_REGEXP_DEFAULT
+        pattern_fields   = HIPPO_MEDIA_SEGMENT_GROUPS_DEFAULT
+
+    media = []
     for track in audio_tracks.values()+video_tracks:
-        server_manifest += sep+'    {\n'
-        server_manifest += '      "trackId": '+ str(track.id) + ',\n'
-        server_manifest += '      "mediaSegments": {\n'
-        server_manifest += '        "urls": [\n'
-        server_manifest += '          {\n'
-        if options.smooth:
-            server_manifest += '            "pattern": "'+(HIPPO_MEDIA_SEGMENT_REGEXP_SMOOTH % (track.bandwidth, track.stream_id))+'",\n'
-            server_manifest += '            "fields": '+HIPPO_MEDIA_SEGMENT_GROUPS_SMOOTH+'\n'
-        else:
-            server_manifest += '            "pattern": "'+(HIPPO_MEDIA_SEGMENT_REGEXP_DEFAULT % (track.stream_id, track.bandwidth))+'",\n'
-            server_manifest += '            "fields": '+HIPPO_MEDIA_SEGMENT_GROUPS_DEFAULT+'\n'
-        server_manifest += '          }\n'
-        server_manifest += '        ],\n'
-        server_manifest += '        "file": "' + track.parent.media_name + '"\n'
-        server_manifest += '      },\n'
-        server_manifest += '      "initSegment": {\n'
-        server_manifest += '        "file": "' + track.init_segment_name + '"\n'
-        server_manifest += '      }\n'
-        server_manifest += '    }'
-        sep = ',\n'
-    server_manifest += '\n  ]\n}'
+        url = collections.OrderedDict()
+        url['pattern'] = pattern_template % {'stream_id': track.stream_id, 'bandwidth': track.bandwidth}
+        url['fields']  = pattern_fields
+        media_segments = collections.OrderedDict()
+        media_segments['urls'] = [url]
+        media_segments['file'] = track.parent.media_name
+        entry = collections.OrderedDict()
+        entry['trackId']       = track.id
+        entry['mediaSegments'] = media_segments
+        entry['initSegment']   = {'file': track.init_segment_name}
+        media.append(entry)
 
     # save the Manifest
     if options.hippo_server_manifest_filename != '':
-        open(path.join(options.output_dir, options.hippo_server_manifest_filename), "wb").write(server_manifest)
+        server_manifest_file = open(path.join(options.output_dir, options.hippo_server_manifest_filename), "wb")
+        json.dump({'media': media}, server_manifest_file, indent=2, separators=(',', ': '))
+        server_manifest_file.close()
 
 #############################################
-Options = None            
-def main():
+def AddHlsMediaPlaylist(options, filename, subdir, track):
+    # one playlist per track, with the segment files (or byte ranges of the
+    # media file in --no-split mode) and the durations found by the analysis
+    if subdir:
+        prefix = subdir+'/'
+    else:
+        prefix = ''
+    target_duration = max([int(round(duration)) for duration in track.segment_durations]+[1])
+    lines = ['#EXTM3U',
+             '#EXT-X-VERSION:%d' % HLS_VERSION,
+             '#EXT-X-TARGETDURATION:%d' % target_duration,
+             '#EXT-X-MEDIA-SEQUENCE:0',
+             '#EXT-X-PLAYLIST-TYPE:VOD',
+             '#EXT-X-INDEPENDENT-SEGMENTS']
+    if options.split:
+        lines.append('#EXT-X-MAP:URI="%s"' % (prefix + track.init_segment_name))
+    else:
+        # the init segment is everything up to the end of the 'moov' atom
+        init_segment = track.parent.init_segment
+        lines.append('#EXT-X-MAP:URI="%s",BYTERANGE="%d@0"' % (track.parent.media_name, init_segment.position+init_segment.size))
+    for (i, segment_index) in enumerate(track.moofs):
+        lines.append('#EXTINF:%.3f,' % track.segment_durations[i])
+        if options.split:
+            lines.append(prefix + (options.segment_url_pattern % i))
+        else:
+            # the range ends with the 'mdat' atom, the atoms that follow the last
+            # fragment ('mfra', ...) are not part of it
+            segment = track.parent.segments[segment_index]
+            segment_end = segment[0].position
+            for atom in segment:
+                segment_end = atom.position+atom.size
+                if atom.type == 'mdat':
+                    break
+            lines.append('#EXT-X-BYTERANGE:%d@%d' % (segment_end-segment[0].position, segment[0].position))
+            lines.append(track.parent.media_name)
+    lines.append('#EXT-X-ENDLIST')
+    WriteFileAtomically(path.join(options.output_dir, filename), '\n'.join(lines)+'\n')
+
+def OutputHls(options, audio_tracks, video_tracks):
+    # the master playlist lists one variant per video track, all of them
+    # using the group of audio renditions
+    lines = ['#EXTM3U',
+             '#EXT-X-VERSION:%d' % HLS_VERSION,
+             '#EXT-X-INDEPENDENT-SEGMENTS']
+
+    # process the audio tracks
+    audio_codecs = []
+    max_audio_bandwidth = 0
+    max_audio_average_bandwidth = 0
+    for (language, audio_track) in audio_tracks.iteritems():
+        if language:
+            subdir = AUDIO_DIR + '/' + language
+            stream_name = 'audio_' + language
+        else:
+            subdir = AUDIO_DIR
+            stream_name = 'audio'
+        if not options.split:
+            subdir = None
+        playlist_filename = stream_name + '.m3u8'
+        AddHlsMediaPlaylist(options, playlist_filename, subdir, audio_track)
+        attributes = ['TYPE=AUDIO', 'GROUP-ID="%s"' % HLS_AUDIO_GROUP_ID, 'NAME="%s"' % (language or 'audio')]
+        if language and language != 'und':
+            attributes.append('LANGUAGE="%s"' % language)
+        attributes.append('DEFAULT=%s' % ('NO' if audio_codecs else 'YES'))
+        attributes += ['AUTOSELECT=YES', 'URI="%s"' % playlist_filename]
+        lines.append('#EXT-X-MEDIA:' + ','.join(attributes))
+        if audio_track.codec not in audio_codecs:
+            audio_codecs.append(audio_track.codec)
+        max_audio_bandwidth = max(max_audio_bandwidth, audio_track.max_segment_bitrate, audio_track.bandwidth)
+        max_audio_average_bandwidth = max(max_audio_average_bandwidth, audio_track.average_segment_bitrate)
+
+    # process all the video tracks
+    for video_track in video_tracks:
+        subdir = None
+        if options.split:
+            subdir = VIDEO_DIR + '/' + str(video_track.parent.index)
+        playlist_filename = 'video_' + str(video_track.parent.index) + '.m3u8'
+        AddHlsMediaPlaylist(options, playlist_filename, subdir, video_track)
+        attributes = ['BANDWIDTH=%d' % (max(video_track.max_segment_bitrate, video_track.bandwidth)+max_audio_bandwidth),
+                      'AVERAGE-BANDWIDTH=%d' % (video_track.average_segment_bitrate+max_audio_average_bandwidth),
+                      'CODECS="%s"' % ','.join([video_track.codec]+audio_codecs),
+                      'RESOLUTION=%dx%d' % (video_track.width, video_track.height)]
+        if audio_codecs:
+            attributes.append('AUDIO="%s"' % HLS_AUDIO_GROUP_ID)
+        lines.append('#EXT-X-STREAM-INF:' + ','.join(attributes))
+        lines.append(playlist_filename)
+
+    # save the master playlist
+    if options.hls_master_playlist_filename:
+        WriteFileAtomically(path.join(options.output_dir, options.hls_master_playlist_filename), '\n'.join(lines)+'\n')
+
+#############################################
+def WriteReport(options, filename, report):
+    # a relative report filename is in the output directory, like all the files
+    # output by the packager
+    report_filename = path.join(options.output_dir, filename)
+    report_dir = path.dirname(report_filename)
+    if report_dir and not path.exists(report_dir):
+        os.makedirs(report_dir)
+    WriteFileAtomically(report_filename, json.dumps(report, indent=2, separators=(',', ': '), sort_keys=True))
+
+
+#############################################
+def CreateOptionParser():
     # determine the platform binary name
     platform = sys.platform
     if platform.startswith('linux'):
@@ -496,6 +647,8 @@ def main():
                       help="Use padded numbers in segment URL/filename templates")
     parser.add_option('', "--use-segment-timeline", action="store_true", dest="use_segment_timeline", default=False,
                       help="Use segment timelines (necessary if segment durations vary)")
+    parser.add_option('', "--validation-report", dest="validation_report_filename", metavar="<filename>", default=None,
+                      help="Write the results of the track alignment and segment duration checks to a JSON file (relative to the output directory, as for all the report options)")
     parser.add_option('', "--min-buffer-time", metavar='<duration>', dest="min_buffer_time", type="float", default=0.0,
                       help="Minimum buffer time (in seconds)")
     parser.add_option('', "--max-playout-rate", metavar='<strategy>', dest='max_playout_rate_strategy',
@@ -508,10 +661,16 @@ def main():
                       help="Smooth Streaming Client Manifest file name", metavar="<filename>", default='stream.ismc')
     parser.add_option('', '--smooth-server-manifest-name', dest="smooth_server_manifest_filename",
                       help="Smooth Streaming Server Manifest file name", metavar="<filename>", default='stream.ism')
+    parser.add_option('', '--smooth-use-chunk-repeats', dest="smooth_use_chunk_repeats", action="store_true", default=False,
+                      help="Compress runs of equal chunk durations with 'r' attributes in the Smooth Streaming Client Manifest (Smooth Streaming 2.2)")
     parser.add_option('', "--hippo", dest="hippo", default=False, action="store_true",
                       help="Produce an output compatible with the Hippo Media Server")
     parser.add_option('', '--hippo-server-manifest-name', dest="hippo_server_manifest_filename",
                       help="Hippo Media Server Manifest file name", metavar="<filename>", default='stream.msm')
+    parser.add_option('', "--hls", dest="hls", default=False, action="store_true",
+                      help="Also produce HLS playlists (fragmented MP4 segments), from the same analysis as the MPD")
+    parser.add_option('', '--hls-master-playlist-name', dest="hls_master_playlist_filename",
+                      help="HLS Master Playlist file name", metavar="<filename>", default='master.m3u8')
     parser.add_option('', "--encryption-key", dest="encryption_key", metavar='<key-spec>', default=None,
                       help="Encrypt all audio and video tracks with MPEG CENC (AES-128), where <key-spec> specifies the KID and Key to use, using one of the following ways: " +
                            "(1) <KID>:<key> with <KID> as a 32-character hex string and <key> either a 32-character hex string or the character '#' followed by a base64-encoded key seed; or " +
@@ -532,105 +691,263 @@ def main():
                            "(3) one or more <name>:<value> pair(s) (separated by '#' if more than one) specifying fields of a PlayReady Header Object (field names include LA_URL, LUI_URL and DS_ID)")
     parser.add_option('', "--playready-add-pssh", dest="playready_add_pssh", action="store_true", default=False,
                       help="Store the PlayReady header in a 'pssh' box in the init segment(s)")
+    parser.add_option('', "--no-bento4-lib", dest="use_bento4_lib", action="store_false", default=True,
+                      help="Do not load the Bento4 shared library to inspect files in-process, always run the mp4info/mp4dump command line tools")
+    parser.add_option('', "--jobs", dest="jobs", metavar="<n>", type="int", default=1,
+                      help="Maximum number of Bento4 tools to run concurrently (default: 1)")
     parser.add_option('', "--exec-dir", metavar="<exec_dir>", dest="exec_dir", default=path.join(SCRIPT_PATH, 'bin', platform),
                       help="Directory where the Bento4 executables are located")
-    (options, args) = parser.parse_args()
-    if len(args) == 0:
-        parser.print_help()
-        sys.exit(1)
-    global Options
-    Options = options
-    
-    # parse media sources syntax
-    media_sources = [MediaSource(source) for source in args]
-    
-    # check the consistency of the options
-    if options.smooth:
-        options.split = False
-        options.use_segment_timeline = True
-        if options.use_segment_list:
-            raise Exception('ERROR: --smooth and --use-segment-list are mutually exclusive')
-    if options.hippo:
-        options.split = False
-        options.use_segment_timeline = True
-        if options.use_segment_list:
-            raise Exception('ERROR: --hippo and --use-segment-list are mutually exclusive')
-    if not options.split:
-        if not options.smooth and not options.hippo and not options.use_segment_list:
-            sys.stderr.write('WARNING: --no-split requires --use-segment-list, which will be enabled automatically\n')
-            options.use_segment_list = True
-                    
-    if not path.exists(Options.exec_dir):
-        PrintErrorAndExit('Executable directory does not exist ('+Options.exec_dir+'), use --exec-dir')
-
-    if options.max_playout_rate_strategy:
-        if not options.max_playout_rate_strategy.startswith('lowest:'):
-            PrintErrorAndExit('Max Playout Rate strategy '+options.max_playout_rate_strategy+' is not supported')
-
-    # switch variables
-    if options.segment_template_padding:
-        global SEGMENT_PATTERN, SEGMENT_URL_PATTERN, SEGMENT_TEMPLATE
-        SEGMENT_PATTERN     = PADDED_SEGMENT_PATTERN
-        SEGMENT_URL_PATTERN = PADDED_SEGMENT_URL_PATTERN
-        SEGMENT_TEMPLATE    = PADDED_SEGMENT_TEMPLATE
-
-    # post-process some of the options
-    if options.playready_header or options.playready_add_pssh:
-        options.playready = True
-
-    if options.playready and options.playready_header:
-        options.playready_add_pssh = True
-
-    # compute the KID and encryption key if needed
-    if options.encryption_key:
-        if options.encryption_key.startswith('@'):
-            (kid_hex, key_hex) = GetEncryptionKey(options, options.encryption_key[1:])
+    parser.add_option('', "--incremental", dest="incremental", action="store_true", default=False,
+                      help="Re-package a title in an output directory where it was packaged before, only splitting the inputs that changed since then " +
+                           "(the other inputs are not analyzed again either). The files that are rewritten are listed. Implies --force")
+    parser.add_option('', "--incremental-report", dest="incremental_report_filename", metavar="<filename>", default=None,
+                      help="With --incremental, write the lists of rewritten, removed and unchanged output files to a JSON file (relative to the output directory)")
+    parser.add_option('', "--segment-store", dest="segment_store_dir", metavar="<dir>", default=None,
+                      help="Keep a single copy of each output file in the content-addressed store <dir>, and hardlink it into the output directory. " +
+                           "Splits that were already done for an identical input, by this title or another one, are linked from the store instead of being run again. " +
+                           "<dir> must be on the same filesystem as the output directory")
+    parser.add_option('', "--segment-store-report", dest="segment_store_report_filename", metavar="<filename>", default=None,
+                      help="With --segment-store, write the deduplication statistics of the run to a JSON file (relative to the output directory)")
+    parser.add_option('', "--profile", dest="profile_report_filename", metavar="<filename>", default=None,
+                      help="Write the wall time, CPU time, bytes read and written and number of tool runs of each phase of the run to a JSON file (relative to the output directory)")
+    parser.add_option('', "--profile-cprofile", dest="cprofile_filename", metavar="<filename>", default=None,
+                      help="Run under cProfile and dump the statistics to <filename> (to be read with the pstats module). Only the main thread is profiled")
+    parser.add_option('', "--live", dest="live", action="store_true", default=False,
+                      help="Package inputs that are still being written, with a dynamic MPD. The segments are output as the fragments are appended to the inputs, " +
+                           "and the MPD is updated until the inputs end (with an 'mfra' atom) or stop growing. Each input must have a single track")
+    parser.add_option('', "--live-update-interval", dest="live_update_interval", metavar="<seconds>", type="float", default=2.0,
+                      help="How often to look for new fragments in live inputs (default: 2)")
+    parser.add_option('', "--live-idle-timeout", dest="live_idle_timeout", metavar="<seconds>", type="float", default=30.0,
+                      help="End the live presentation when no new fragment has been appended for that long (default: 30)")
+    parser.add_option('', "--live-window", dest="live_window", metavar="<seconds>", type="float", default=0.0,
+                      help="Only list the last <seconds> of a live presentation in the MPD (time shift buffer depth). By default all the segments are listed")
+    parser.add_option('', "--live-chunks", dest="live_chunk_count", metavar="<n>", type="int", default=1,
+                      help="Low latency chunked output for --live: each fragment of the inputs is a chunk and <n> chunks make a segment. " +
+                           "The segments are written chunk by chunk as the chunks are appended to the inputs, and the MPD signals the " +
+                           "availabilityTimeOffset that lets clients request them early. The fragments must all have the same duration (default: 1, no chunks)")
+    parser.add_option('', "--batch", dest="batch_filename", metavar="<job-file>", default=None,
+                      help="Package several titles in the same run. Each line of <job-file> lists the options and media files of one title. " +
+                           "The options given on the command line apply to all the titles, and the batch-wide options (--exec-dir, --jobs, --segment-store, --profile and --batch) can only be set there")
+    return parser
+
+#############################################
+class DashPackagerConfig:
+    # immutable set of packaging options, with the same attributes as the
+    # command line options. Each packager works on its own copy
+    def __init__(self, options):
+        self.__dict__['values'] = copy.deepcopy(vars(options))
+
+    def __getattr__(self, name):
+        try:
+            return self.values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('the packager configuration cannot be modified')
+
+    def __delattr__(self, name):
+        raise AttributeError('the packager configuration cannot be modified')
+
+    def get_options(self):
+        return Values(copy.deepcopy(self.values))
+
+def ParseDashPackagerArguments(arguments):
+    # returns the configuration and the media sources for a command line
+    (options, args) = CreateOptionParser().parse_args(arguments)
+    return (DashPackagerConfig(options), args)
+
+#############################################
+class DashPackager:
+    # packages one title. The stages are called in order: analyze(), output_manifests()
+    # and output_media(), then cleanup() to remove the temporary files (package() does
+    # all of that). Nothing is shared with other packagers except the executor and the
+    # caches passed in, so several packagers can run in parallel threads
+    def __init__(self, config, media_sources, executor=None, mp4_file_cache=None, playready_header_cache=None, segment_store=None, profiler=None):
+        self.config  = config
+        self.options = config.get_options()
+        self.media_sources = [MediaSource(source) for source in media_sources]
+
+        self.owns_executor = executor is None
+        if executor is None:
+            executor = Bento4Executor(config.exec_dir, config.jobs, debug=config.debug, verbose=config.verbose)
+        if mp4_file_cache is None:
+            mp4_file_cache = Mp4FileCache()
+        if playready_header_cache is None:
+            playready_header_cache = PlayReadyHeaderCache()
+        if config.segment_store_dir and (segment_store is None or segment_store.store_dir != config.segment_store_dir):
+            segment_store = SegmentStore(config.segment_store_dir)
+        elif not config.segment_store_dir:
+            segment_store = None
+        self.executor = executor
+        self.mp4_file_cache = mp4_file_cache
+        self.segment_store = segment_store
+        self.options.bento4_executor = executor
+        self.options.playready_header_cache = playready_header_cache
+        self.options.profiler = profiler
+
+        self.temp_files        = []
+        self.packaging_state   = None
+        self.job_records       = []
+        self.unchanged_files   = []
+        self.pssh_filename     = None
+        self.file_name_map     = {}
+        self.mp4_files         = {}
+        self.audio_tracks      = {}
+        self.video_tracks      = []
+        self.validation_report = None
+
+    def package(self):
+        try:
+            self.analyze()
+            with ProfilePhase(self.options, 'manifests'):
+                self.output_manifests()
+            with ProfilePhase(self.options, 'media'):
+                self.output_media()
+            if self.packaging_state:
+                self.packaging_state.save()
+        finally:
+            self.cleanup()
+
+    def cleanup(self):
+        for f in self.temp_files:
+            os.unlink(f)
+        self.temp_files = []
+        if self.owns_executor:
+            self.executor.close()
+
+    def analyze(self):
+        self.check_options()
+        
+        # create the output directory
+        options = self.options
+        severity = 'ERROR'
+        if options.no_media: severity = 'WARNING'
+        if options.force_output: severity = None
+        MakeNewDir(dir=options.output_dir, exit_if_exists = not (options.no_media or options.force_output), severity=severity)
+        if options.incremental:
+            self.packaging_state = PackagingState(options.output_dir)
+
+        # keep track of media file names (in case we use temporary files when encrypting)
+        for media_source in self.media_sources:
+            self.file_name_map[media_source.filename] = media_source.filename
+
+        with ProfilePhase(options, 'encrypt'):
+            self.encrypt_media()
+        with ProfilePhase(options, 'parse'):
+            self.parse_media()
+        with ProfilePhase(options, 'select'):
+            self.select_tracks()
+        with ProfilePhase(options, 'process'):
+            self.process_tracks()
+
+    def check_options(self):
+        options = self.options
+
+        # check the consistency of the options
+        if options.smooth:
+            options.split = False
+            options.use_segment_timeline = True
+            if options.use_segment_list:
+                raise PackagingError('ERROR: --smooth and --use-segment-list are mutually exclusive')
+        if options.hippo:
+            options.split = False
+            options.use_segment_timeline = True
+            if options.use_segment_list:
+                raise PackagingError('ERROR: --hippo and --use-segment-list are mutually exclusive')
+        if options.incremental:
+            if options.encryption_key:
+                raise PackagingError('ERROR: --incremental cannot be used with --encryption-key, since the encryption is different every time')
+            options.force_output = True
+        if not options.split:
+            if not options.smooth and not options.hippo and not options.use_segment_list:
+                sys.stderr.write('WARNING: --no-split requires --use-segment-list, which will be enabled automatically\n')
+                options.use_segment_list = True
+                        
+        if not path.exists(options.exec_dir):
+            raise PackagingError('Executable directory does not exist ('+options.exec_dir+'), use --exec-dir')
+
+        if options.max_playout_rate_strategy:
+            if not options.max_playout_rate_strategy.startswith('lowest:'):
+                raise PackagingError('Max Playout Rate strategy '+options.max_playout_rate_strategy+' is not supported')
+
+        # select the segment name patterns
+        if options.segment_template_padding:
+            options.segment_pattern     = PADDED_SEGMENT_PATTERN
+            options.segment_url_pattern = PADDED_SEGMENT_URL_PATTERN
+            options.segment_template    = PADDED_SEGMENT_TEMPLATE
         else:
-            if ':' not in options.encryption_key:
-                raise Exception('Invalid argument syntax for --encryption-key option')
-            kid_hex, key_hex = options.encryption_key.split(':')
-            if len(kid_hex) != 32:
-                raise Exception('Invalid argument format for --encryption-key option')
-
-            if key_hex.startswith('#'):
-                if len(key_hex) != 41:
-                    raise Exception('Invalid argument format for --encryption-key option')
-                key_seed_bin = key_hex[1:].decode('base64')
-                kid_bin = kid_hex.decode('hex')
-                key_hex = DerivePlayReadyKey(key_seed_bin, kid_bin).encode('hex')
-                if options.verbose:
-                    print 'Derived Key =', key_hex
+            options.segment_pattern     = NOPAD_SEGMENT_PATTERN
+            options.segment_url_pattern = NOPAD_SEGMENT_URL_PATTERN
+            options.segment_template    = NOPAD_SEGMENT_TEMPLATE
+
+        # post-process some of the options
+        if options.playready_header or options.playready_add_pssh:
+            options.playready = True
+
+        if options.playready and options.playready_header:
+            options.playready_add_pssh = True
+
+        if options.hls and (options.encryption_key or options.marlin or options.playready):
+            raise PackagingError('ERROR: --hls cannot be used with encryption, the playlists do not signal it')
+
+        # compute the KID and encryption key if needed
+        if options.encryption_key:
+            if options.encryption_key.startswith('@'):
+                (kid_hex, key_hex) = GetEncryptionKey(options, options.encryption_key[1:])
             else:
-                if len(key_hex) != 32:
+                if ':' not in options.encryption_key:
+                    raise Exception('Invalid argument syntax for --encryption-key option')
+                kid_hex, key_hex = options.encryption_key.split(':')
+                if len(kid_hex) != 32:
                     raise Exception('Invalid argument format for --encryption-key option')
-        options.key_hex = key_hex
-        options.kid_hex = kid_hex
-
-    # process language map options
-    if options.language_map:
-        mappings = options.language_map.split(',')
-        options.language_map = {}
-        for mapping in mappings:
-            from_lang, to_lang = mapping.split(':')
-            options.language_map[from_lang] = to_lang
-
-    # create the output directory
-    severity = 'ERROR'
-    if options.no_media: severity = 'WARNING'
-    if options.force_output: severity = None
-    MakeNewDir(dir=options.output_dir, exit_if_exists = not (options.no_media or options.force_output), severity=severity)
-
-    # keep track of media file names (in case we use temporary files when encrypting)
-    file_name_map = {}
-    for media_source in media_sources:
-        file_name_map[media_source.filename] = media_source.filename
-
-    # encrypt the input files if needed
-    encrypted_files = {}
-    if not options.no_media and options.encryption_key:
 
+                if key_hex.startswith('#'):
+                    if len(key_hex) != 41:
+                        raise Exception('Invalid argument format for --encryption-key option')
+                    key_seed_bin = key_hex[1:].decode('base64')
+                    kid_bin = kid_hex.decode('hex')
+                    key_hex = DerivePlayReadyKey(key_seed_bin, kid_bin).encode('hex')
+                    if options.verbose:
+                        print 'Derived Key =', key_hex
+                else:
+                    if len(key_hex) != 32:
+                        raise Exception('Invalid argument format for --encryption-key option')
+            options.key_hex = key_hex
+            options.kid_hex = kid_hex
+
+        # process language map options
+        if options.language_map:
+            mappings = options.language_map.split(',')
+            options.language_map = {}
+            for mapping in mappings:
+                from_lang, to_lang = mapping.split(':')
+                options.language_map[from_lang] = to_lang
+
+        options.mpd_type = 'static'
+
+    def get_pssh_file(self):
+        # all the inputs are encrypted with the same KID and key, so they can
+        # share the same 'pssh' payload, written once for this title
+        if self.pssh_filename is None:
+            options = self.options
+            pssh_file = tempfile.NamedTemporaryFile(dir = options.output_dir, delete=False)
+            pssh_file.write(options.playready_header_cache.get_header(options.playready_header, options.kid_hex, options.key_hex))
+            self.temp_files.append(pssh_file.name)
+            pssh_file.close() # necessary on Windows
+            self.pssh_filename = pssh_file.name
+        return self.pssh_filename
+
+    def encrypt_media(self):
+        # encrypt the input files if needed
+        options = self.options
+        if options.no_media or not options.encryption_key:
+            return
+
+        encrypted_files = {}
         track_ids = []
-        for media_source in media_sources:
+        encryption_jobs = []
+        for media_source in self.media_sources:
             media_file = media_source.filename
             
             # check if we have already encrypted this file
@@ -639,8 +956,7 @@ def main():
                 continue
                 
             # get the mp4 file info
-            json_info = Mp4Info(Options, media_file, format='json', fast=True)
-            info = json.loads(json_info, strict=False)
+            info = GetMp4FileInfo(options, media_file, LoadBento4Lib(options) if options.use_bento4_lib else None)
 
             if 'tracks' not in info:
                 raise Exception('No track found in input file(s)')
@@ -649,9 +965,9 @@ def main():
             print 'Encrypting track IDs '+str(track_ids)+' in '+ media_file
             encrypted_file = tempfile.NamedTemporaryFile(dir = options.output_dir, delete=False)
             encrypted_files[media_file] = encrypted_file 
-            TempFiles.append(encrypted_file.name)
+            self.temp_files.append(encrypted_file.name)
             encrypted_file.close() # necessary on Windows
-            file_name_map[encrypted_file.name] = encrypted_file.name + ' (Encrypted ' + media_file + ')'
+            self.file_name_map[encrypted_file.name] = encrypted_file.name + ' (Encrypted ' + media_file + ')'
             args = ['--method', 'MPEG-CENC']
                 
             if options.encryption_args:
@@ -663,282 +979,692 @@ def main():
             args.append(media_file)
             args.append(encrypted_file.name)
             for track_id in track_ids:
-                args += ['--key', str(track_id)+':'+key_hex+':random', '--property', str(track_id)+':KID:'+kid_hex]
+                args += ['--key', str(track_id)+':'+options.key_hex+':random', '--property', str(track_id)+':KID:'+options.kid_hex]
             if options.playready_add_pssh:
-                playready_header = ComputePlayReadyHeader(options.playready_header, kid_hex, key_hex)
-                pssh_file = tempfile.NamedTemporaryFile(dir = options.output_dir, delete=False)
-                pssh_file.write(playready_header)
-                TempFiles.append(pssh_file.name)
-                pssh_file.close() # necessary on Windows
-                args += ['--pssh', PLAYREADY_PSSH_SYSTEM_ID+':'+pssh_file.name]
-            cmd = [path.join(Options.exec_dir, 'mp4encrypt')] + args
-            if options.debug:
-                print 'COMMAND: ', cmd
-            try:
-                check_output(cmd) 
-            except CalledProcessError, e:
-                message = "binary tool failed with error %d" % e.returncode
-                if options.verbose:
-                    message += " - " + str(cmd)
-                raise Exception(message)
+                args += ['--pssh', PLAYREADY_PSSH_SYSTEM_ID+':'+self.get_pssh_file()]
+            encryption_jobs.append(args)
             media_source.filename = encrypted_file.name
+
+        # run the encryptions, as many at a time as allowed
+        self.executor.map(lambda args: self.executor.run('mp4encrypt', *args), encryption_jobs)
+
+    def parse_media(self):
+        # parse the media files, as many at a time as allowed
+        options = self.options
+        media_files_to_parse = []
+        for media_source in self.media_sources:
+            media_file = media_source.filename
+            if media_file in media_files_to_parse:
+                continue
+            print 'Parsing media file', str(len(media_files_to_parse)+1)+':', self.file_name_map[media_file]
+            if not os.path.exists(media_file):
+                raise PackagingError('ERROR: media file ' + media_file + ' does not exist')
+            media_files_to_parse.append(media_file)
+        parsed_files = dict(zip(media_files_to_parse, self.executor.map(self.load_media_file, media_files_to_parse)))
+
+        index = 1
+        mp4_media_names = []
+        for media_source in self.media_sources:
+            media_file = media_source.filename
             
-    # parse the media files
-    index = 1
-    mp4_files = {}
-    mp4_media_names = []
-    for media_source in media_sources:
-        media_file = media_source.filename
-        
-        # check if we have already parsed this file
-        if media_file in mp4_files:
-            media_source.mp4_file = mp4_files[media_file]
-            continue
-        
-        # parse the file
-        print 'Parsing media file', str(index)+':', file_name_map[media_file]
-        if not os.path.exists(media_file):
-            PrintErrorAndExit('ERROR: media file ' + media_file + ' does not exist')
+            # check if we have already parsed this file
+            if media_file in self.mp4_files:
+                media_source.mp4_file = self.mp4_files[media_file]
+                continue
             
-        # get the file info
-        mp4_file = Mp4File(Options, media_file)
-        
-        # set some metadata properties for this file
-        mp4_file.index = index
-        if options.rename_media:
-            mp4_file.media_name = MEDIA_FILE_PATTERN % (mp4_file.index)
-        elif 'media' in media_source.spec:
-            mp4_file.media_name = media_source.spec['media']
-        else:
-            mp4_file.media_name = path.basename(media_source.original_filename)
+            # get the parsed file
+            mp4_file = parsed_files[media_file]
             
-        if not options.split:
-            if mp4_file.media_name in mp4_media_names:
-                PrintErrorAndExit('ERROR: output media name %s is not unique, consider using --rename-media'%mp4_file.media_name)
-        
-        # check the file
-        if mp4_file.info['movie']['fragments'] != True:
-            PrintErrorAndExit('ERROR: file '+str(mp4_file.index)+' is not fragmented (use mp4fragment to fragment it)')
+            # set some metadata properties for this file
+            mp4_file.index = index
+            if options.rename_media:
+                mp4_file.media_name = MEDIA_FILE_PATTERN % (mp4_file.index)
+            elif 'media' in media_source.spec:
+                mp4_file.media_name = media_source.spec['media']
+            else:
+                mp4_file.media_name = path.basename(media_source.original_filename)
+                
+            if not options.split:
+                if mp4_file.media_name in mp4_media_names:
+                    raise PackagingError('ERROR: output media name %s is not unique, consider using --rename-media'%mp4_file.media_name)
             
-        # set the source property
-        media_source.mp4_file = mp4_file
-        mp4_files[media_file] = mp4_file
-        mp4_media_names.append(mp4_file.media_name)
-        
-        index += 1
-        
-    # select the audio and video tracks
-    audio_tracks = {}
-    video_tracks = []
-    for media_source in media_sources:
-        track_id       = media_source.spec['track']
-        track_type     = media_source.spec['type']
-        track_language = media_source.spec['language']
-        tracks         = []
-        
-        if track_type not in ['', 'audio', 'video']:
-            sys.stderr.write('WARNING: ignoring source '+media_source.name+', unknown type')
+            # check the file
+            if mp4_file.info['movie']['fragments'] != True:
+                raise PackagingError('ERROR: file '+str(mp4_file.index)+' is not fragmented (use mp4fragment to fragment it)')
+                
+            # set the source property
+            media_source.mp4_file = mp4_file
+            self.mp4_files[media_file] = mp4_file
+            mp4_media_names.append(mp4_file.media_name)
 
-        if track_id and track_type:
-            PrintErrorAndExit('ERROR: track ID and track type selections are mutually exclusive')
+            # unless it is set, the min buffer time is the average segment
+            # duration of the first track of the first file
+            if options.min_buffer_time == 0.0 and mp4_file.tracks:
+                options.min_buffer_time = mp4_file.tracks.values()[0].average_segment_duration
+            
+            index += 1
 
-        if track_id:
-            tracks = [media_source.mp4_file.find_track_by_id(track_id)]
-            if not tracks:
-                PrintErrorAndExit('ERROR: track id not found for media file '+media_source.name)
-        
-        if track_type:
-            tracks = media_source.mp4_file.find_tracks_by_type(track_type)
-            if not tracks:
-                PrintErrorAndExit('ERROR: no ' + track_type + ' found for media file '+media_source.name)
-        
-        if not tracks:
-            tracks = media_source.mp4_file.tracks.values()
+    def load_media_file(self, media_file):
+        if self.packaging_state:
+            return self.packaging_state.get_file(self.options, media_file)
+        return self.mp4_file_cache.get_file(self.options, media_file)
+
+    def select_tracks(self):
+        # select the audio and video tracks
+        options = self.options
+        audio_tracks = self.audio_tracks
+        video_tracks = self.video_tracks
+        for media_source in self.media_sources:
+            track_id       = media_source.spec['track']
+            track_type     = media_source.spec['type']
+            track_language = media_source.spec['language']
+            tracks         = []
             
-        # process audio tracks
-        for track in [t for t in tracks if t.type == 'audio']:
-            language = LanguageCodeMap.get(track.language, track.language)
-            if track_language and track_language != language and track_language != track.language:
-                continue
-            if options.language_map and language in options.language_map:
-                language = options.language_map[language]
-            if language not in audio_tracks:
-                audio_tracks[language] = track
-
-        # process video tracks
-        video_tracks += [t for t in tracks if t.type == 'video']
-
-    # check that we have at least one audio and one video
-    if not audio_tracks:
-        PrintErrorAndExit('ERROR: no audio track selected')
-    if not video_tracks:
-        PrintErrorAndExit('ERROR: no video track selected')
-        
-    if Options.verbose:
-        print 'Audio:', audio_tracks
-        print 'Video:', video_tracks
-        
-    # check that segments are consistent between files
-    prev_track = None
-    for track in video_tracks:
-        if prev_track:
-            if track.total_sample_count != prev_track.total_sample_count:
-                sys.stderr.write('WARNING: video sample count mismatch between "'+str(track)+'" and "'+str(prev_track)+'"\n')
-        prev_track = track
-        
-    # check that the video segments match
-    for track in video_tracks:
-        if track.sample_counts[:-1] != video_tracks[0].sample_counts[:-1]:
-            PrintErrorAndExit('ERROR: video tracks are not aligned ("'+str(track)+'" differs)')
-               
-    # check that the video segment durations are almost all equal
-    if not options.use_segment_timeline:
-        for video_track in video_tracks:
-            for segment_duration in video_track.segment_durations[:-2]:
-                ratio = segment_duration/video_track.average_segment_duration
-                if ratio > 1.1 or ratio < 0.9:
-                    sys.stderr.write('WARNING: video segment durations for "' + str(video_track) + '" vary by more than 10% (consider using --use-segment-timeline)\n')
-                    break
-        for audio_track in audio_tracks.values():
-            for segment_duration in audio_track.segment_durations[:-2]:
-                ratio = segment_duration/audio_track.average_segment_duration
-                if ratio > 1.1 or ratio < 0.9:
-                    sys.stderr.write('WARNING: audio segment durations for "' + str(audio_track) + '" vary by more than 10% (consider using --use-segment-timeline)\n')
-                    break
-    
-    # round the audio segment durations to be equal to the video segment durations
-    if len(video_tracks):
-        for audio_track in audio_tracks.values():
-            ratio = audio_track.average_segment_duration/video_tracks[0].average_segment_duration
-            if abs(ratio-1.0) < 0.05:
-                # within 5%, make it equal
-                if options.verbose:
-                    print 'INFO: adjusting segment duration for audio track '+str(audio_track)+' to '+str(video_tracks[0].average_segment_duration)+' to match the video'
-                audio_track.average_segment_duration = video_tracks[0].average_segment_duration
-
-    # compute the audio codecs
-    for audio_track in audio_tracks.values(): 
-        audio_desc = audio_track.info['sample_descriptions'][0]
-        audio_coding = audio_desc['coding']
-        if audio_coding == 'mp4a':
-            audio_codec = 'mp4a.%02x' % (audio_desc['object_type'])
-            if audio_desc['object_type'] == 64:
-                audio_codec += '.'+str(audio_desc['mpeg_4_audio_object_type'])
-        else:
-            audio_codec = audio_coding
+            if track_type not in ['', 'audio', 'video']:
+                sys.stderr.write('WARNING: ignoring source '+media_source.name+', unknown type')
+
+            if track_id and track_type:
+                raise PackagingError('ERROR: track ID and track type selections are mutually exclusive')
+
+            if track_id:
+                tracks = [media_source.mp4_file.find_track_by_id(track_id)]
+                if not tracks:
+                    raise PackagingError('ERROR: track id not found for media file '+media_source.name)
+            
+            if track_type:
+                tracks = media_source.mp4_file.find_tracks_by_type(track_type)
+                if not tracks:
+                    raise PackagingError('ERROR: no ' + track_type + ' found for media file '+media_source.name)
+            
+            if not tracks:
+                tracks = media_source.mp4_file.tracks.values()
                 
-        audio_track.codec = audio_codec
-        
-    # compute the video codecs and dimensions
-    for video_track in video_tracks:
-        video_desc = video_track.info['sample_descriptions'][0]
-        if video_desc['coding'].startswith('avc'):
-            video_codec = video_desc['coding'] + '.%02x%02x%02x' % (video_desc['avc_profile'],
-                                                                    video_desc['avc_profile_compat'],
-                                                                    video_desc['avc_level'])
-        else:
-            video_codec = video_desc['coding']
+            # process audio tracks
+            for track in [t for t in tracks if t.type == 'audio']:
+                language = LanguageCodeMap.get(track.language, track.language)
+                if track_language and track_language != language and track_language != track.language:
+                    continue
+                if options.language_map and language in options.language_map:
+                    language = options.language_map[language]
+                if language not in audio_tracks:
+                    audio_tracks[language] = track
 
-        video_track.codec = video_codec
+            # process video tracks
+            video_tracks += [t for t in tracks if t.type == 'video']
 
-        # get the width and height
-        video_track.width  = video_desc['width']
-        video_track.height = video_desc['height']
+        # check that we have at least one audio and one video
+        if not audio_tracks:
+            raise PackagingError('ERROR: no audio track selected')
+        if not video_tracks:
+            raise PackagingError('ERROR: no video track selected')
+            
+        if options.verbose:
+            print 'Audio:', audio_tracks
+            print 'Video:', video_tracks
 
-    # compute the track stream id init segment name for each track
-    for (language, audio_track) in audio_tracks.items():
-        if options.split:
-            audio_track.init_segment_name = SPLIT_INIT_SEGMENT_NAME
-        else:
-            audio_track.init_segment_name = NOSPLIT_INIT_FILE_PATTERN % (audio_track.parent.index, audio_track.id)
-        if language:
-            audio_track.stream_id = 'audio_'+language
-        else:
-            audio_track.stream_id = 'audio'
-    for video_track in video_tracks:
-        if options.split:
-            video_track.init_segment_name = SPLIT_INIT_SEGMENT_NAME
-        else:
-            video_track.init_segment_name = NOSPLIT_INIT_FILE_PATTERN % (video_track.parent.index, video_track.id)
-        video_track.stream_id = 'video'
+    def validate_tracks(self):
+        # check that segments are consistent between files, that the video segments
+        # match, and that the segment durations are almost all equal
+        options = self.options
+        self.validation_report = ValidateTracks(self.audio_tracks.values(), self.video_tracks, check_durations=not options.use_segment_timeline)
+        if options.validation_report_filename:
+            WriteReport(options, options.validation_report_filename, self.validation_report)
+        for warning in self.validation_report['warnings']:
+            sys.stderr.write('WARNING: '+warning['message']+'\n')
+        for error in self.validation_report['errors']:
+            raise PackagingError('ERROR: '+error['message']+' at fragment '+str(error['fragment']))
 
-    # compute some values if not set
-    if options.min_buffer_time == 0.0:
-        options.min_buffer_time = video_tracks[0].average_segment_duration
-                
-    # print info about the tracks
-    if options.verbose:
-        for audio_track in audio_tracks.itervalues():
-            print 'Audio Track: ' + str(audio_track) + ' - max bitrate=%d, avg bitrate=%d, req bandwidth=%d' % (audio_track.max_segment_bitrate, audio_track.average_segment_bitrate, audio_track.bandwidth)
+    def process_tracks(self):
+        options = self.options
+        audio_tracks = self.audio_tracks
+        video_tracks = self.video_tracks
+
+        self.validate_tracks()
+
+        # compute the bandwidth of the selected tracks with the min buffer time
+        with ProfilePhase(options, 'process.bandwidth'):
+            for track in audio_tracks.values() + video_tracks:
+                track.compute_bandwidth(options.min_buffer_time)
+        
+        # round the audio segment durations to be equal to the video segment durations
+        if len(video_tracks):
+            for audio_track in audio_tracks.values():
+                ratio = audio_track.average_segment_duration/video_tracks[0].average_segment_duration
+                if abs(ratio-1.0) < 0.05:
+                    # within 5%, make it equal
+                    if options.verbose:
+                        print 'INFO: adjusting segment duration for audio track '+str(audio_track)+' to '+str(video_tracks[0].average_segment_duration)+' to match the video'
+                    audio_track.average_segment_duration = video_tracks[0].average_segment_duration
+
+        # compute the audio codecs
+        for audio_track in audio_tracks.values(): 
+            audio_desc = audio_track.info['sample_descriptions'][0]
+            audio_coding = audio_desc['coding']
+            if audio_coding == 'mp4a':
+                audio_codec = 'mp4a.%02x' % (audio_desc['object_type'])
+                if audio_desc['object_type'] == 64:
+                    audio_codec += '.'+str(audio_desc['mpeg_4_audio_object_type'])
+            else:
+                audio_codec = audio_coding
+                    
+            audio_track.codec = audio_codec
+            
+        # compute the video codecs and dimensions
         for video_track in video_tracks:
-            print 'Video Track: ' + str(video_track) + ' - max bitrate=%d, avg bitrate=%d, req bandwidth=%d' % (video_track.max_segment_bitrate, video_track.average_segment_bitrate, video_track.bandwidth)
+            video_desc = video_track.info['sample_descriptions'][0]
+            if video_desc['coding'].startswith('avc'):
+                video_codec = video_desc['coding'] + '.%02x%02x%02x' % (video_desc['avc_profile'],
+                                                                        video_desc['avc_profile_compat'],
+                                                                        video_desc['avc_level'])
+            else:
+                video_codec = video_desc['coding']
+
+            video_track.codec = video_codec
 
-    # deal with the max playout strategy if set
-    if options.max_playout_rate_strategy:
-        max_playout_rate = options.max_playout_rate_strategy.split(':')[1]
-        lowest_bandwidth_track = None
-        lowest_bandwidth = -1
+            # get the width and height
+            video_track.width  = video_desc['width']
+            video_track.height = video_desc['height']
+
+        # compute the track stream id init segment name for each track
+        for (language, audio_track) in audio_tracks.items():
+            if options.split:
+                audio_track.init_segment_name = SPLIT_INIT_SEGMENT_NAME
+            else:
+                audio_track.init_segment_name = NOSPLIT_INIT_FILE_PATTERN % (audio_track.parent.index, audio_track.id)
+            if language:
+                audio_track.stream_id = 'audio_'+language
+            else:
+                audio_track.stream_id = 'audio'
         for video_track in video_tracks:
-            if lowest_bandwidth < 0 or video_track.bandwidth < lowest_bandwidth:
-                lowest_bandwidth = video_track.bandwidth
-                lowest_bandwidth_track = video_track
-        if lowest_bandwidth_track:
-            lowest_bandwidth_track.max_playout_rate = max_playout_rate
+            if options.split:
+                video_track.init_segment_name = SPLIT_INIT_SEGMENT_NAME
+            else:
+                video_track.init_segment_name = NOSPLIT_INIT_FILE_PATTERN % (video_track.parent.index, video_track.id)
+            video_track.stream_id = 'video'
+                    
+        # print info about the tracks
+        if options.verbose:
+            for audio_track in audio_tracks.itervalues():
+                print 'Audio Track: ' + str(audio_track) + ' - max bitrate=%d, avg bitrate=%d, req bandwidth=%d' % (audio_track.max_segment_bitrate, audio_track.average_segment_bitrate, audio_track.bandwidth)
+            for video_track in video_tracks:
+                print 'Video Track: ' + str(video_track) + ' - max bitrate=%d, avg bitrate=%d, req bandwidth=%d' % (video_track.max_segment_bitrate, video_track.average_segment_bitrate, video_track.bandwidth)
 
-    # output the DASH MPD
-    OutputDash(options, audio_tracks, video_tracks)
+        # deal with the max playout strategy if set
+        if options.max_playout_rate_strategy:
+            max_playout_rate = options.max_playout_rate_strategy.split(':')[1]
+            lowest_bandwidth_track = None
+            lowest_bandwidth = -1
+            for video_track in video_tracks:
+                if lowest_bandwidth < 0 or video_track.bandwidth < lowest_bandwidth:
+                    lowest_bandwidth = video_track.bandwidth
+                    lowest_bandwidth_track = video_track
+            if lowest_bandwidth_track:
+                lowest_bandwidth_track.max_playout_rate = max_playout_rate
 
-    # output the Smooth Manifests
-    if options.smooth:
-        OutputSmooth(options, audio_tracks, video_tracks)
-    
-    # output the Hippo Manifest
-    if options.hippo:
-        OutputHippo(options, audio_tracks, video_tracks)
+    def output_manifests(self):
+        options = self.options
+
+        # output the DASH MPD
+        OutputDash(options, self.audio_tracks, self.video_tracks)
+
+        # output the Smooth Manifests
+        if options.smooth:
+            OutputSmooth(options, self.audio_tracks, self.video_tracks)
+        
+        # output the Hippo Manifest
+        if options.hippo:
+            OutputHippo(options, self.audio_tracks, self.video_tracks)
+
+        # output the HLS Playlists
+        if options.hls:
+            OutputHls(options, self.audio_tracks, self.video_tracks)
+
+    def output_media(self):
+        # create the directories and split the media
+        options = self.options
+        if options.no_media:
+            return
 
-    # create the directories and split the media
-    if not options.no_media:
+        split_jobs = []
         if options.split:
             MakeNewDir(path.join(options.output_dir, 'audio'))
-            for (language, audio_track) in audio_tracks.iteritems():
+            for (language, audio_track) in self.audio_tracks.iteritems():
                 out_dir = path.join(options.output_dir, 'audio')
                 if language:
                     out_dir = path.join(out_dir, language)
                     MakeNewDir(out_dir)
-                print 'Processing media file (audio)', file_name_map[audio_track.parent.filename]
-                Mp4Split(options,
-                         audio_track.parent.filename,
-                         track_id               = str(audio_track.id),
-                         pattern_parameters     = 'N',
-                         init_segment           = path.join(out_dir, audio_track.init_segment_name),
-                         media_segment          = path.join(out_dir, SEGMENT_PATTERN))
+                print 'Processing media file (audio)', self.file_name_map[audio_track.parent.filename]
+                split_jobs.append((audio_track.parent.filename,
+                                   dict(track_id               = str(audio_track.id),
+                                        pattern_parameters     = 'N',
+                                        init_segment           = path.join(out_dir, audio_track.init_segment_name),
+                                        media_segment          = path.join(out_dir, options.segment_pattern))))
         
             MakeNewDir(path.join(options.output_dir, 'video'))
-            for video_track in video_tracks:
+            for video_track in self.video_tracks:
                 out_dir = path.join(options.output_dir, 'video', str(video_track.parent.index))
                 MakeNewDir(out_dir)
-                print 'Processing media file (video)', file_name_map[video_track.parent.filename]
-                Mp4Split(Options,
-                         video_track.parent.filename,
-                         track_id               = str(video_track.id),
-                         pattern_parameters     = 'N',
-                         init_segment           = path.join(out_dir, video_track.init_segment_name),
-                         media_segment          = path.join(out_dir, SEGMENT_PATTERN))
+                print 'Processing media file (video)', self.file_name_map[video_track.parent.filename]
+                split_jobs.append((video_track.parent.filename,
+                                   dict(track_id               = str(video_track.id),
+                                        pattern_parameters     = 'N',
+                                        init_segment           = path.join(out_dir, video_track.init_segment_name),
+                                        media_segment          = path.join(out_dir, options.segment_pattern))))
         else:
-            for mp4_file in mp4_files.values():
-                print 'Processing media file', file_name_map[mp4_file.filename]
+            copy_jobs = []
+            for mp4_file in self.mp4_files.values():
+                print 'Processing media file', self.file_name_map[mp4_file.filename]
                 media_filename = path.join(options.output_dir, mp4_file.media_name)
                 if not options.force_output and path.exists(media_filename):
-                    PrintErrorAndExit('ERROR: file ' + media_filename + ' already exists')
-                    
-                shutil.copyfile(mp4_file.filename, media_filename)
+                    raise PackagingError('ERROR: file ' + media_filename + ' already exists')
+                copy_jobs.append((mp4_file.filename, dict(media_file=media_filename)))
+            if self.packaging_state:
+                copy_jobs = self.select_changed_jobs(copy_jobs, 'copy')
+            for (filename, args) in copy_jobs:
+                shutil.copyfile(filename, args['media_file'])
             if options.smooth or options.hippo:
-                for track in audio_tracks.values() + video_tracks:
-                    Mp4Split(options,
-                             track.parent.filename,
-                             track_id     = str(track.id),
-                             init_only    = True,
-                             init_segment = path.join(options.output_dir, track.init_segment_name))
+                for track in self.audio_tracks.values() + self.video_tracks:
+                    split_jobs.append((track.parent.filename,
+                                       dict(track_id     = str(track.id),
+                                            init_only    = True,
+                                            init_segment = path.join(options.output_dir, track.init_segment_name))))
+
+        # run the splits, as many at a time as allowed
+        if self.packaging_state:
+            split_jobs = self.select_changed_jobs(split_jobs, 'split')
+        self.executor.map(self.run_split_job, split_jobs)
+        if self.packaging_state:
+            self.record_jobs()
+
+    def get_job_signature(self, job_type, digest, args):
+        # identifies a job by its input and its arguments (with paths relative to the output directory)
+        relative_args = dict([(name, path.relpath(value, self.options.output_dir) if name in ['init_segment', 'media_segment', 'media_file'] else value) for (name, value) in args.iteritems()])
+        return hashlib.sha1(json.dumps([job_type, digest, relative_args], sort_keys=True)).hexdigest()
+
+    def run_split_job(self, (filename, args)):
+        options = self.options
+        if self.segment_store is None:
+            # the outputs may be links to the read-only files of a segment store
+            # used by a previous run, they are replaced rather than overwritten
+            for output in self.get_job_outputs(filename, args):
+                if path.exists(path.join(options.output_dir, output)):
+                    os.unlink(path.join(options.output_dir, output))
+            return Mp4Split(options, filename, **args)
+        signature = self.get_job_signature('split', self.segment_store.get_digest(filename), args)
+        self.segment_store.run_job(signature, options.output_dir, self.get_job_outputs(filename, args), lambda: Mp4Split(options, filename, **args))
+
+    def get_job_outputs(self, filename, args):
+        # the files output by a split or a copy job, relative to the output directory
+        output_dir = self.options.output_dir
+        if 'media_file' in args:
+            return [path.relpath(args['media_file'], output_dir)]
+        outputs = [path.relpath(args['init_segment'], output_dir)]
+        if not args.get('init_only'):
+            track = self.mp4_files[filename].tracks[int(args['track_id'])]
+            segment_dir = path.dirname(outputs[0])
+            outputs += [path.join(segment_dir, self.options.segment_url_pattern % i) for i in xrange(len(track.moofs))]
+        return outputs
+
+    def select_changed_jobs(self, jobs, job_type):
+        # only keep the jobs whose input, arguments or output files changed since the previous run
+        state = self.packaging_state
+        changed_jobs = []
+        for (filename, args) in jobs:
+            outputs = self.get_job_outputs(filename, args)
+            signature = self.get_job_signature(job_type, state.get_digest(filename), args)
+            key = job_type + ':' + outputs[0]
+            self.job_records.append((key, signature, outputs))
+            if state.is_output_current(key, signature, outputs):
+                self.unchanged_files += outputs
+            else:
+                changed_jobs.append((filename, args))
+        return changed_jobs
+
+    def record_jobs(self):
+        # update the state with the outputs of the jobs, remove the files that
+        # are no longer output, and report what has been rewritten
+        options = self.options
+        state = self.packaging_state
+        job_records = self.job_records
+        unchanged_files = set(self.unchanged_files)
+        rewritten_files = []
+        stale_files = state.remove_outputs([key for (key, signature, outputs) in job_records])
+        for (key, signature, outputs) in job_records:
+            stale_files += state.set_output(key, signature, outputs)
+            rewritten_files += [output for output in outputs if output not in unchanged_files]
+        removed_files = []
+        for stale_file in sorted(set(stale_files)-set(rewritten_files)-unchanged_files):
+            if path.exists(path.join(options.output_dir, stale_file)):
+                os.unlink(path.join(options.output_dir, stale_file))
+                removed_files.append(stale_file)
+                stale_dir = path.dirname(path.join(options.output_dir, stale_file))
+                if stale_dir != path.normpath(options.output_dir) and not os.listdir(stale_dir):
+                    os.rmdir(stale_dir)
+
+        print 'Incremental packaging: %d file(s) rewritten, %d removed, %d unchanged' % (len(rewritten_files), len(removed_files), len(unchanged_files))
+        if options.verbose:
+            for rewritten_file in rewritten_files:
+                print '  rewritten:', rewritten_file
+            for removed_file in removed_files:
+                print '  removed:', removed_file
+        if options.incremental_report_filename:
+            report = {'rewritten': rewritten_files, 'removed': removed_files, 'unchanged': sorted(unchanged_files)}
+            WriteReport(options, options.incremental_report_filename, report)
+
+#############################################
+class DashLivePackager(DashPackager):
+    # packages inputs that are still being written. Once the first fragments are
+    # there, the segments are copied out of the inputs as their fragments are
+    # completed, and the dynamic MPD is rewritten after each update, until the
+    # inputs end or stop growing
+    def __init__(self, config, media_sources, executor=None, mp4_file_cache=None, playready_header_cache=None, profiler=None):
+        DashPackager.__init__(self, config, media_sources, executor, mp4_file_cache, playready_header_cache, profiler=profiler)
+        self.output_tracks = []
+
+    def package(self):
+        try:
+            self.analyze()
+            with ProfilePhase(self.options, 'media'):
+                self.output_media()
+            with ProfilePhase(self.options, 'manifests'):
+                self.output_manifests()
+            with ProfilePhase(self.options, 'live'):
+                self.follow_media()
+        finally:
+            self.cleanup()
+
+    def check_options(self):
+        options = self.options
+        if options.smooth or options.hippo or options.hls:
+            raise PackagingError('ERROR: --live cannot be used with --smooth, --hippo or --hls')
+        if options.use_segment_list or not options.split:
+            raise PackagingError('ERROR: --live cannot be used with --use-segment-list or --no-split')
+        if options.encryption_key:
+            raise PackagingError('ERROR: --live cannot be used with --encryption-key, the inputs must be encrypted beforehand')
+        if options.incremental or options.segment_store_dir:
+            raise PackagingError('ERROR: --live cannot be used with --incremental or --segment-store')
+        if options.live_update_interval <= 0:
+            raise PackagingError('ERROR: --live-update-interval must be positive')
+        if options.live_chunk_count < 1:
+            raise PackagingError('ERROR: --live-chunks must be at least 1')
+
+        # chunked segments are listed with a fixed duration, since the
+        # timeline could only list them once they are complete
+        options.use_segment_timeline = options.live_chunk_count == 1
+
+        DashPackager.check_options(self)
+        options.mpd_type = 'dynamic'
+        options.live_ended = False
+
+    def load_media_file(self, media_file):
+        # wait until there is at least one fragment for each track
+        options = self.options
+        mp4_file = Mp4LiveFile(options, media_file)
+        deadline = time.time()+options.live_idle_timeout
+        while True:
+            mp4_file.update(options)
+            if mp4_file.tracks and min([len(track.moofs) for track in mp4_file.tracks.values()]) > 0:
+                break
+            if mp4_file.ended or time.time() > deadline:
+                raise PackagingError('ERROR: no media fragment found in ' + media_file)
+            time.sleep(options.live_update_interval)
+        if len(mp4_file.tracks) != 1:
+            raise PackagingError('ERROR: live input ' + media_file + ' must have exactly one track')
+
+        # the bandwidth and segment duration are those of the first fragments
+        for track in mp4_file.tracks.values():
+            track.update(options)
+        return mp4_file
+
+    def validate_tracks(self):
+        # the inputs are still growing, each at its own pace, so
+        # their fragments cannot be compared yet
+        pass
+
+    def process_tracks(self):
+        DashPackager.process_tracks(self)
+
+        # the segments already in the inputs are available now (with chunks,
+        # the presentation starts with the first one)
+        options = self.options
+        tracks = self.audio_tracks.values()+self.video_tracks
+        if options.live_chunk_count > 1:
+            # the SegmentTemplate announces a single chunk duration, so all
+            # the tracks must have it
+            reference = tracks[0]
+            for track in tracks:
+                track.chunk_duration = track.segment_scaled_durations[0]
+                track.checked_chunk_count = 0
+                if track.chunk_duration*reference.timescale != reference.chunk_duration*track.timescale:
+                    raise PackagingError('ERROR: with --live-chunks, all tracks must have the same fragment duration (%s: %.3f s, %s: %.3f s)' %
+                                        (self.file_name_map[reference.parent.filename], float(reference.chunk_duration)/reference.timescale,
+                                         self.file_name_map[track.parent.filename], float(track.chunk_duration)/track.timescale))
+            self.check_chunk_durations()
+            media_time = max([float(track.timeline.end_time-track.timeline.start_time)/track.timescale for track in tracks])
+        else:
+            media_time = max([float(track.timeline.end_time)/track.timescale for track in tracks])
+        options.availability_start_time = time.time()-media_time
+        self.trim_timelines()
+
+    def check_chunk_durations(self):
+        # check the fragments appended since the last check against the chunk
+        # duration (only the last fragment of an input that has ended may be
+        # shorter)
+        for track in self.audio_tracks.values()+self.video_tracks:
+            durations = track.segment_scaled_durations
+            for i in xrange(track.checked_chunk_count, len(durations)):
+                if durations[i] == track.chunk_duration:
+                    continue
+                if i == len(durations)-1 and track.parent.ended and durations[i] < track.chunk_duration:
+                    continue
+                raise PackagingError('ERROR: with --live-chunks, all fragments must have the same duration (fragment %d of %s: %.3f s, expected %.3f s)' %
+                                    (i, self.file_name_map[track.parent.filename], float(durations[i])/track.timescale, float(track.chunk_duration)/track.timescale))
+            track.checked_chunk_count = len(durations)
+
+    def trim_timelines(self):
+        if self.options.live_window and self.options.live_chunk_count == 1:
+            for track in self.audio_tracks.values()+self.video_tracks:
+                track.timeline.trim(self.options.live_window*track.timescale)
+
+    def output_media(self):
+        # output the segments that have not been output yet
+        options = self.options
+        if options.no_media:
+            return
+
+        if not self.output_tracks:
+            # create the directories and output the init segments
+            MakeNewDir(path.join(options.output_dir, 'audio'))
+            for (language, audio_track) in self.audio_tracks.iteritems():
+                out_dir = path.join(options.output_dir, 'audio')
+                if language:
+                    out_dir = path.join(out_dir, language)
+                    MakeNewDir(out_dir)
+                self.output_tracks.append((audio_track, out_dir))
+            MakeNewDir(path.join(options.output_dir, 'video'))
+            for video_track in self.video_tracks:
+                out_dir = path.join(options.output_dir, 'video', str(video_track.parent.index))
+                MakeNewDir(out_dir)
+                self.output_tracks.append((video_track, out_dir))
+            for (track, out_dir) in self.output_tracks:
+                print 'Processing live media file', self.file_name_map[track.parent.filename]
+                WriteFileAtomically(path.join(out_dir, track.init_segment_name), track.parent.read_init_segment())
+                track.output_segment_count = 0
+
+        chunk_count = options.live_chunk_count
+        for (track, out_dir) in self.output_tracks:
+            while track.output_segment_count < len(track.moofs):
+                data = track.parent.read_segment(track.moofs[track.output_segment_count])
+                if chunk_count > 1:
+                    # append the chunk to its segment right away
+                    segment_filename = path.join(out_dir, options.segment_url_pattern % (track.output_segment_count/chunk_count))
+                    if track.output_segment_count % chunk_count:
+                        segment_file = open(segment_filename, 'ab')
+                    else:
+                        segment_file = open(segment_filename, 'wb')
+                    segment_file.write(data)
+                    segment_file.close()
+                else:
+                    segment_filename = path.join(out_dir, options.segment_url_pattern % track.output_segment_count)
+                    WriteFileAtomically(segment_filename, data)
+                track.output_segment_count += 1
+
+    def follow_media(self):
+        # read the new fragments of the inputs as they grow, output them and
+        # update the MPD, until the inputs end or stop growing
+        options = self.options
+        mp4_files = self.mp4_files.values()
+        last_fragment_time = time.time()
+        while not all([mp4_file.ended for mp4_file in mp4_files]):
+            time.sleep(options.live_update_interval)
+            new_segment_count = 0
+            for mp4_file in mp4_files:
+                new_segment_count += len(mp4_file.update(options))
+            if new_segment_count:
+                if options.verbose:
+                    print 'Live update:', new_segment_count, 'new segment(s)'
+                last_fragment_time = time.time()
+                if options.live_chunk_count > 1:
+                    self.check_chunk_durations()
+                self.trim_timelines()
+                self.output_media()
+                if options.live_chunk_count == 1:
+                    # (with chunks, the MPD does not list the segments)
+                    self.output_manifests()
+            elif time.time()-last_fragment_time > options.live_idle_timeout:
+                sys.stderr.write('WARNING: no new fragment for %.1f s, ending the live presentation\n' % options.live_idle_timeout)
+                break
+
+        # the final MPD
+        options.live_ended = True
+        self.output_manifests()
+
+#############################################
+# options that apply to the whole batch, and cannot be set per title
+BATCH_OPTIONS = [('--exec-dir',             'exec_dir'),
+                 ('--jobs',                 'jobs'),
+                 ('--segment-store',        'segment_store_dir'),
+                 ('--segment-store-report', 'segment_store_report_filename'),
+                 ('--profile',              'profile_report_filename'),
+                 ('--profile-cprofile',     'cprofile_filename'),
+                 ('--batch',                'batch_filename')]
+
+def PackageBatch(parser, options, executor, mp4_file_cache, playready_header_cache, segment_store, profiler):
+    # package the titles listed in the job file, one title per line,
+    # each with its own copy of the command line options
+    try:
+        job_file = open(options.batch_filename)
+        jobs = [shlex.split(line, comments=True) for line in job_file]
+        job_file.close()
+    except IOError, e:
+        PrintErrorAndExit('ERROR: cannot read job file ' + options.batch_filename + ' (' + str(e) + ')')
+    jobs = [job for job in jobs if job]
+
+    start_time = time.time()
+    failures = 0
+    for (job_index, job) in enumerate(jobs):
+        print 'Packaging title', str(job_index+1)+'/'+str(len(jobs))+':', ' '.join(job)
+        title_start_time = time.time()
+        try:
+            (title_options, title_args) = parser.parse_args(job, copy.copy(options))
+        except SystemExit:
+            # invalid options, already reported by the parser
+            failures += 1
+            continue
+        try:
+            batch_options = [name for (name, dest) in BATCH_OPTIONS if getattr(title_options, dest) != getattr(options, dest)]
+            if batch_options:
+                raise Exception(', '.join(batch_options)+' can only be set on the command line, not in a job file')
+            if len(title_args) == 0:
+                raise Exception('no media file for title')
+            if title_options.live:
+                raise Exception('--live cannot be used with --batch')
+            packager = DashPackager(DashPackagerConfig(title_options), title_args, executor, mp4_file_cache, playready_header_cache, segment_store, profiler)
+            packager.package()
+        except PackagingError, err:
+            if options.debug:
+                raise
+            sys.stderr.write(str(err)+'\n')
+            failures += 1
+        except Exception, err:
+            if options.debug:
+                raise
+            sys.stderr.write('ERROR: %s\n' % str(err))
+            failures += 1
+        if options.verbose:
+            print 'Title', job_index+1, 'done in %.3f s' % (time.time()-title_start_time)
+
+    elapsed = time.time()-start_time
+    packaged = len(jobs)-failures
+    print 'Packaged %d title(s), %d failed, in %.1f s (%.1f titles/hour)' % (packaged, failures, elapsed, 3600.0*packaged/elapsed if elapsed else 0.0)
+    if options.verbose:
+        print 'Media analysis cache: %d hit(s), %d miss(es)' % (mp4_file_cache.hits, mp4_file_cache.misses)
+    if failures:
+        sys.exit(1)
+
+#############################################
+Options = None
+def main():
+    parser = CreateOptionParser()
+    (options, args) = parser.parse_args()
+    if len(args) == 0 and not options.batch_filename:
+        parser.print_help()
+        sys.exit(1)
+    global Options
+    Options = options
+
+    if options.jobs < 1:
+        PrintErrorAndExit('--jobs must be at least 1')
+
+    # the Bento4 executor, the PlayReady headers and the analysis
+    # of the media files are shared by all the titles
+    executor = Bento4Executor(options.exec_dir, options.jobs, debug=options.debug, verbose=options.verbose)
+    mp4_file_cache = Mp4FileCache()
+    playready_header_cache = PlayReadyHeaderCache()
+    segment_store = None
+    if options.segment_store_dir:
+        segment_store = SegmentStore(options.segment_store_dir)
+    profiler = None
+    if options.profile_report_filename:
+        profiler = Profiler(executor)
+    cprofile = None
+    if options.cprofile_filename:
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+
+    try:
+        if options.batch_filename:
+            if len(args):
+                PrintErrorAndExit('ERROR: with --batch, media files must be listed in the job file')
+            PackageBatch(parser, options, executor, mp4_file_cache, playready_header_cache, segment_store, profiler)
+        else:
+            if options.live:
+                packager = DashLivePackager(DashPackagerConfig(options), args, executor, mp4_file_cache, playready_header_cache, profiler=profiler)
+            else:
+                packager = DashPackager(DashPackagerConfig(options), args, executor, mp4_file_cache, playready_header_cache, segment_store, profiler)
+            packager.package()
+    except PackagingError, err:
+        if options.debug:
+            raise
+        PrintErrorAndExit(str(err))
+    finally:
+        if cprofile:
+            cprofile.disable()
+            cprofile.dump_stats(options.cprofile_filename)
+        if profiler:
+            if options.verbose:
+                for line in profiler.format_report():
+                    print 'PROFILE:', line
+            WriteReport(options, options.profile_report_filename, profiler.get_report())
+        if options.debug or options.verbose:
+            for line in executor.format_stats():
+                print 'TOOL STATS:', line
+        executor.close()
+        if segment_store:
+            for line in segment_store.format_stats():
+                print 'SEGMENT STORE:', line
+            if options.segment_store_report_filename:
+                WriteReport(options, options.segment_store_report_filename, segment_store.stats)
 
 ###########################
 if __name__ == '__main__':
@@ -949,6 +1675,3 @@ if __name__ == '__main__':
             raise
         else:
             PrintErrorAndExit('ERROR: %s\n' % str(err))
-    finally:
-        for f in TempFiles:
-            os.unlink(f)
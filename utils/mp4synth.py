@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+###
+# Generates synthetic fragmented MP4 files, without any encoder: the sample
+# data is filler, but the structure (ftyp, moov with one trak per track, one
+# moof/mdat pair per track and fragment, optional mfra index and CENC signaling)
+# is what the packaging tools expect. The same parameters always produce the
+# same bytes, so the files can be used as fixtures for benchmarks
+
+from optparse import OptionParser
+import struct
+import random
+
+SYNTH_VIDEO_SPS      = '\x67\x42\xc0\x1e\xd9\x00\xa0\x2f\xf9\x70\x11\x00\x00\x03\x00\x01\x00\x00\x03\x00\x30\x0f\x16\x2e\x48'
+SYNTH_VIDEO_PPS      = '\x68\xcb\x83\xcb\x20'
+SYNTH_AUDIO_CONFIG   = '\x12\x10'
+SYNTH_DEFAULT_KID    = '000102030405060708090a0b0c0d0e0f'
+SYNTH_MATRIX         = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+TRUN_FLAG_DATA_OFFSET_PRESENT     = 0x000001
+TRUN_FLAG_SAMPLE_DURATION_PRESENT = 0x000100
+TRUN_FLAG_SAMPLE_SIZE_PRESENT     = 0x000200
+TFHD_FLAG_DEFAULT_BASE_IS_MOOF    = 0x020000
+
+def Box(type, payload):
+    return struct.pack('>I', 8+len(payload)) + type + payload
+
+def FullBox(type, version, flags, payload):
+    return Box(type, struct.pack('>I', (version << 24) | flags) + payload)
+
+class SynthTrack:
+    # parameters of one track of a synthetic file
+    def __init__(self, type='video', track_id=1, timescale=24000, sample_duration=1000, samples_per_fragment=48,
+                 sample_size=2000, sample_size_variation=0.0, language='und', width=640, height=360,
+                 sample_rate=48000, channels=2, bitrate=128000):
+        self.type                  = type
+        self.track_id              = track_id
+        self.timescale             = timescale
+        self.sample_duration       = sample_duration
+        self.samples_per_fragment  = samples_per_fragment
+        self.sample_size           = sample_size
+        self.sample_size_variation = sample_size_variation
+        self.language              = language
+        self.width                 = width
+        self.height                = height
+        self.sample_rate           = sample_rate
+        self.channels              = channels
+        self.bitrate               = bitrate
+
+    def make_sample_entry(self, kid):
+        if self.type == 'video':
+            avcc = Box('avcC', struct.pack('>BBBBB', 1, 0x42, 0xc0, 0x1e, 0xff) +
+                               struct.pack('>BH', 0xe1, len(SYNTH_VIDEO_SPS)) + SYNTH_VIDEO_SPS +
+                               struct.pack('>BH', 1, len(SYNTH_VIDEO_PPS)) + SYNTH_VIDEO_PPS)
+            format = 'avc1'
+            payload = ('\0'*6 + struct.pack('>H', 1) + '\0'*16 +
+                       struct.pack('>HHIIIH', self.width, self.height, 0x480000, 0x480000, 0, 1) +
+                       '\0'*32 + struct.pack('>Hh', 0x18, -1) + avcc)
+        else:
+            dsi = '\x05' + chr(len(SYNTH_AUDIO_CONFIG)) + SYNTH_AUDIO_CONFIG
+            dcd = '\x04' + chr(13+len(dsi)) + struct.pack('>BBHBII', 0x40, 0x15, 0, 0, self.bitrate, self.bitrate) + dsi
+            sl  = '\x06\x01\x02'
+            esd = '\x03' + chr(3+len(dcd)+len(sl)) + struct.pack('>HB', 1, 0) + dcd + sl
+            format = 'mp4a'
+            payload = ('\0'*6 + struct.pack('>H', 1) + '\0'*8 +
+                       struct.pack('>HHHHI', self.channels, 16, 0, 0, self.sample_rate << 16) +
+                       FullBox('esds', 0, 0, esd))
+        if kid is None:
+            return Box(format, payload)
+
+        # CENC signaling: the original format is in the 'frma' box
+        tenc = FullBox('tenc', 0, 0, '\0\0' + struct.pack('>BB', 1, 8) + kid.decode('hex'))
+        sinf = Box('sinf', Box('frma', format) +
+                           FullBox('schm', 0, 0, 'cenc' + struct.pack('>I', 0x10000)) +
+                           Box('schi', tenc))
+        return Box(format == 'avc1' and 'encv' or 'enca', payload + sinf)
+
+    def make_trak(self, kid):
+        if self.type == 'video':
+            (width, height, volume) = (self.width, self.height, 0)
+            handler = 'vide'
+            media_header = FullBox('vmhd', 0, 1, '\0'*8)
+        else:
+            (width, height, volume) = (0, 0, 0x100)
+            handler = 'soun'
+            media_header = FullBox('smhd', 0, 0, '\0'*4)
+        tkhd = FullBox('tkhd', 0, 7, struct.pack('>IIIII', 0, 0, self.track_id, 0, 0) + '\0'*8 +
+                                     struct.pack('>hhhH', 0, 0, volume, 0) + SYNTH_MATRIX +
+                                     struct.pack('>II', width << 16, height << 16))
+        language = [ord(c)-0x60 for c in self.language]
+        mdhd = FullBox('mdhd', 0, 0, struct.pack('>IIII', 0, 0, self.timescale, 0) +
+                                     struct.pack('>HH', (language[0] << 10) | (language[1] << 5) | language[2], 0))
+        hdlr = FullBox('hdlr', 0, 0, struct.pack('>I', 0) + handler + '\0'*12 + 'synth\0')
+        stsd = FullBox('stsd', 0, 0, struct.pack('>I', 1) + self.make_sample_entry(kid))
+        stbl = Box('stbl', stsd +
+                           FullBox('stts', 0, 0, '\0'*4) +
+                           FullBox('stsc', 0, 0, '\0'*4) +
+                           FullBox('stsz', 0, 0, '\0'*8) +
+                           FullBox('stco', 0, 0, '\0'*4))
+        dinf = Box('dinf', FullBox('dref', 0, 0, struct.pack('>I', 1) + FullBox('url ', 0, 1, '')))
+        return Box('trak', tkhd + Box('mdia', mdhd + hdlr + Box('minf', media_header + dinf + stbl)))
+
+    def make_sample(self, size):
+        if self.type == 'video':
+            # a single IDR slice NAL unit
+            return struct.pack('>I', size-4) + '\x65' + '\0'*(size-5)
+        return '\0'*size
+
+def MakeFragmentedMp4(filename, tracks, fragment_count=10, mfra=True, encrypted=False, kid=SYNTH_DEFAULT_KID,
+                      sample_durations_in_trun=False, seed=0):
+    # write a fragmented MP4 file with the given tracks, each fragment (a moof and mdat
+    # pair) holds samples from a single track, and the tracks alternate
+    randomizer = random.Random(seed)
+    if not encrypted:
+        kid = None
+    ftyp = Box('ftyp', 'isom' + struct.pack('>I', 1) + 'isomiso2avc1iso6dash')
+    mvhd = FullBox('mvhd', 0, 0, struct.pack('>IIII', 0, 0, 1000, 0) + struct.pack('>IH', 0x10000, 0x100) + '\0'*10 +
+                                 SYNTH_MATRIX + '\0'*24 + struct.pack('>I', max([track.track_id for track in tracks])+1))
+    trexs = ''.join([FullBox('trex', 0, 0, struct.pack('>IIIII', track.track_id, 1, track.sample_duration, 0, 0)) for track in tracks])
+    moov = Box('moov', mvhd + ''.join([track.make_trak(kid) for track in tracks]) + Box('mvex', trexs))
+
+    output = open(filename, 'wb')
+    output.write(ftyp + moov)
+    position = len(ftyp) + len(moov)
+    decode_times = dict([(track.track_id, 0) for track in tracks])
+    tfra_entries = dict([(track.track_id, []) for track in tracks])
+    sequence_number = 1
+    for fragment_index in xrange(fragment_count):
+        for track in tracks:
+            sample_sizes = []
+            for i in xrange(track.samples_per_fragment):
+                variation = int(track.sample_size*track.sample_size_variation*(2.0*randomizer.random()-1.0))
+                sample_sizes.append(max(8, track.sample_size+variation))
+            flags = TRUN_FLAG_DATA_OFFSET_PRESENT | TRUN_FLAG_SAMPLE_SIZE_PRESENT
+            if sample_durations_in_trun:
+                flags |= TRUN_FLAG_SAMPLE_DURATION_PRESENT
+                entries = ''.join([struct.pack('>II', track.sample_duration, size) for size in sample_sizes])
+            else:
+                entries = ''.join([struct.pack('>I', size) for size in sample_sizes])
+            decode_time = decode_times[track.track_id]
+
+            def make_moof(data_offset):
+                traf = (FullBox('tfhd', 0, TFHD_FLAG_DEFAULT_BASE_IS_MOOF, struct.pack('>I', track.track_id)) +
+                        FullBox('tfdt', 1, 0, struct.pack('>Q', decode_time)) +
+                        FullBox('trun', 0, flags, struct.pack('>Ii', len(sample_sizes), data_offset) + entries))
+                if kid:
+                    ivs = ''.join([struct.pack('>Q', (sequence_number << 32) | i) for i in xrange(len(sample_sizes))])
+                    traf += FullBox('senc', 0, 0, struct.pack('>I', len(sample_sizes)) + ivs)
+                return Box('moof', FullBox('mfhd', 0, 0, struct.pack('>I', sequence_number)) + Box('traf', traf))
+            moof = make_moof(0)
+            moof = make_moof(len(moof)+8)
+            mdat = struct.pack('>I', 8+sum(sample_sizes)) + 'mdat' + ''.join([track.make_sample(size) for size in sample_sizes])
+            output.write(moof)
+            output.write(mdat)
+
+            tfra_entries[track.track_id].append((decode_time, position))
+            position += len(moof)+len(mdat)
+            decode_times[track.track_id] += len(sample_sizes)*track.sample_duration
+            sequence_number += 1
+
+    if mfra:
+        tfras = ''
+        for track in tracks:
+            entries = tfra_entries[track.track_id]
+            tfras += FullBox('tfra', 1, 0, struct.pack('>III', track.track_id, 0, len(entries)) +
+                                           ''.join([struct.pack('>QQBBB', time, offset, 1, 1, 1) for (time, offset) in entries]))
+        mfro = FullBox('mfro', 0, 0, struct.pack('>I', 8+len(tfras)+16))
+        output.write(Box('mfra', tfras + mfro))
+    output.close()
+
+def MakeTracks(video_count=1, audio_count=1, **video_args):
+    # video tracks first, with decreasing sample sizes, then audio tracks
+    tracks = []
+    for i in xrange(video_count):
+        args = dict(video_args)
+        args['sample_size'] = max(64, args.get('sample_size', 2000) >> i)
+        tracks.append(SynthTrack('video', track_id=len(tracks)+1, **args))
+    for i in xrange(audio_count):
+        tracks.append(SynthTrack('audio', track_id=len(tracks)+1, timescale=48000, sample_duration=1024,
+                                 samples_per_fragment=94, sample_size=400, language='und'))
+    return tracks
+
+def main():
+    parser = OptionParser(usage="%prog [options] <output-file>",
+                          description="Generate a synthetic fragmented MP4 file")
+    parser.add_option('', '--video-tracks', dest='video_count', type='int', default=1,
+                      help="Number of video tracks (default: 1)")
+    parser.add_option('', '--audio-tracks', dest='audio_count', type='int', default=0,
+                      help="Number of audio tracks (default: 0)")
+    parser.add_option('', '--fragments', dest='fragment_count', type='int', default=10,
+                      help="Number of fragments per track (default: 10)")
+    parser.add_option('', '--samples', dest='samples_per_fragment', type='int', default=48,
+                      help="Number of video samples per fragment (default: 48)")
+    parser.add_option('', '--sample-size', dest='sample_size', type='int', default=2000,
+                      help="Size of the video samples, in bytes (default: 2000)")
+    parser.add_option('', '--sample-size-variation', dest='sample_size_variation', type='float', default=0.0,
+                      help="Maximum relative variation of the video sample sizes (default: 0)")
+    parser.add_option('', '--sample-durations', dest='sample_durations_in_trun', action='store_true', default=False,
+                      help="Store the duration of each sample in the 'trun' boxes")
+    parser.add_option('', '--no-mfra', dest='mfra', action='store_false', default=True,
+                      help="Do not write an 'mfra' index")
+    parser.add_option('', '--encrypted', dest='encrypted', action='store_true', default=False,
+                      help="Add CENC signaling (the samples are not actually encrypted)")
+    parser.add_option('', '--seed', dest='seed', type='int', default=0,
+                      help="Seed for the sample size variations (default: 0)")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    tracks = MakeTracks(options.video_count, options.audio_count,
+                        samples_per_fragment=options.samples_per_fragment,
+                        sample_size=options.sample_size,
+                        sample_size_variation=options.sample_size_variation)
+    MakeFragmentedMp4(args[0], tracks, options.fragment_count, mfra=options.mfra, encrypted=options.encrypted,
+                      sample_durations_in_trun=options.sample_durations_in_trun, seed=options.seed)
+
+###########################
+if __name__ == '__main__':
+    import sys
+    main()
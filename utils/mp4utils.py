@@ -7,13 +7,29 @@ __copyright__ = 'Copyright 2011-2013 Axiomatic Systems, LLC.'
 import sys
 import os
 import os.path as path
-from subprocess import check_output, CalledProcessError
+from subprocess import check_output, CalledProcessError, Popen, PIPE
 import json
 import io
 import struct
 import operator
 import hashlib
+import re
+import array
+import itertools
+import tempfile
+import copy
+import cPickle
+import contextlib
+import threading
+import time
+import multiprocessing.pool
+try:
+    import resource
+except ImportError:
+    resource = None
 import xml.sax.saxutils as saxutils
+import xml.etree.ElementTree as ElementTree
+from bento4lib import LoadBento4Lib, ParseBox
 
 LanguageCodeMap = {
     'aar': 'aa', 'abk': 'ab', 'afr': 'af', 'aka': 'ak', 'alb': 'sq', 'amh': 'am', 'ara': 'ar', 'arg': 'an',
@@ -61,31 +77,393 @@ def XmlDuration(d):
     if s:
         xsd += str(s)+'S'
     return xsd
-    
-def Bento4Command(options, name, *args, **kwargs):
-    cmd = [path.join(options.exec_dir, name)]
-    for kwarg in kwargs:
-        arg = kwarg.replace('_', '-')
-        cmd.append('--'+arg)
-        if not isinstance(kwargs[kwarg], bool):
-            cmd.append(kwargs[kwarg])
-    cmd += args
-    if options.debug:
-        print 'COMMAND: ', cmd
+
+def XmlDateTime(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+@contextlib.contextmanager
+def OpenFileAtomically(filename):
+    # write to a temporary file next to the target first, so that a client
+    # reading the file never gets a partially written one
+    temp_filename = filename+'.tmp'
+    file = open(temp_filename, 'wb')
     try:
-        return check_output(cmd) 
-    except CalledProcessError, e:
-        message = "binary tool failed with error %d" % e.returncode
-        if options.verbose:
-            message += " - " + str(cmd)
-        raise Exception(message)
-    
+        yield file
+    finally:
+        file.close()
+    if sys.platform == 'win32' and path.exists(filename):
+        os.unlink(filename)
+    os.rename(temp_filename, filename)
+
+def WriteFileAtomically(filename, data):
+    with OpenFileAtomically(filename) as file:
+        file.write(data)
+
+XML_ATTRIBUTE_ENTITIES = {'"': '&quot;'}
+
+class XmlStreamWriter:
+    # writes an XML document element by element, with the same layout as
+    # minidom's toprettyxml(), without building the whole tree in memory
+    def __init__(self, file, indent='  '):
+        self.file   = file
+        self.indent = indent
+        self.stack  = []
+        self.file.write('<?xml version="1.0" ?>\n')
+
+    def open_tag(self, name, attributes):
+        tag = '<'+name
+        for attribute_name in sorted(attributes):
+            tag += ' '+attribute_name+'="'+saxutils.escape(str(attributes[attribute_name]), XML_ATTRIBUTE_ENTITIES)+'"'
+        return tag
+
+    def start(self, name, attributes={}):
+        self.file.write(self.indent*len(self.stack)+self.open_tag(name, attributes)+'>\n')
+        self.stack.append(name)
+
+    def end(self):
+        name = self.stack.pop()
+        self.file.write(self.indent*len(self.stack)+'</'+name+'>\n')
+
+    def element(self, name, attributes={}, text=None):
+        if text is None:
+            self.file.write(self.indent*len(self.stack)+self.open_tag(name, attributes)+'/>\n')
+        else:
+            self.file.write(self.indent*len(self.stack)+self.open_tag(name, attributes)+'>'+saxutils.escape(text, XML_ATTRIBUTE_ENTITIES)+'</'+name+'>\n')
+
+    def comment(self, text):
+        self.file.write(self.indent*len(self.stack)+'<!--'+text+'-->\n')
+
+    def text(self, text):
+        self.file.write(self.indent*len(self.stack)+saxutils.escape(text, XML_ATTRIBUTE_ENTITIES)+'\n')
+
+    def elements(self, name, attributes, variable_name, values):
+        # an element per value of the variable_name attribute, the other attributes
+        # being the same for all of them, so they are only formatted once
+        names = sorted(attributes.keys()+[variable_name])
+        position = names.index(variable_name)
+        head = self.indent*len(self.stack)+self.open_tag(name, dict([(x, attributes[x]) for x in names[:position]]))+' '+variable_name+'="'
+        tail = '"'+self.open_tag('', dict([(x, attributes[x]) for x in names[position+1:]]))[1:]+'/>\n'
+        for value in values:
+            self.file.write(head+saxutils.escape(str(value), XML_ATTRIBUTE_ENTITIES)+tail)
+
+    def tree(self, root, namespaces={}, element_writers={}):
+        # write an ElementTree element and its children. Namespaced names get the
+        # prefix of their namespace in namespaces (uri -> prefix), declared on the
+        # root. An element in element_writers gets more children, written after
+        # the ones in the tree by its function
+        uris = set()
+        for element in root.iter():
+            for name in [element.tag]+element.keys():
+                if isinstance(name, basestring) and name.startswith('{'):
+                    uris.add(name[1:].split('}')[0])
+        declarations = dict([('xmlns:'+namespaces[uri], uri) for uri in uris])
+        self.tree_element(root, namespaces, element_writers, declarations)
+
+    def qualified_name(self, name, namespaces):
+        if name.startswith('{'):
+            (uri, local_name) = name[1:].split('}')
+            return namespaces[uri]+':'+local_name
+        return name
+
+    def tree_element(self, element, namespaces, element_writers, declarations={}):
+        if element.tag is ElementTree.Comment:
+            self.comment(element.text)
+            return
+        name = self.qualified_name(element.tag, namespaces)
+        attributes = dict([(self.qualified_name(key, namespaces), value) for (key, value) in element.items()])
+        attributes.update(declarations)
+        element_writer = element_writers.get(element)
+        if len(element) == 0 and element_writer is None:
+            self.element(name, attributes, element.text or None)
+            return
+        self.start(name, attributes)
+        if element.text:
+            self.text(element.text)
+        for child in element:
+            self.tree_element(child, namespaces, element_writers)
+            if child.tail:
+                self.text(child.tail)
+        if element_writer is not None:
+            element_writer(self)
+        self.end()
+
+def ComputeDurationRuns(durations):
+    # run-length encode a list of durations into (duration, count) pairs
+    runs = []
+    for duration in durations:
+        if runs and runs[-1][0] == duration:
+            runs[-1][1] += 1
+        else:
+            runs.append([duration, 1])
+    return runs
+
+BENTO4_STREAM_CHUNK_SIZE = 65536
+
+class PackagingError(Exception):
+    # invalid input or options, with the message to print before exiting
+    pass
+
+class Bento4Executor:
+    # runs Bento4 tools (or any other command line tool) with at most
+    # max_concurrency processes at a time, streams their output and keeps
+    # per-tool counters (number of calls, cumulated time, output bytes)
+    def __init__(self, exec_dir=None, max_concurrency=1, debug=False, verbose=False):
+        self.exec_dir        = exec_dir
+        self.max_concurrency = max(1, max_concurrency)
+        self.debug           = debug
+        self.verbose         = verbose
+        self.slots           = threading.BoundedSemaphore(self.max_concurrency)
+        self.lock            = threading.Lock()
+        self.pool            = None
+        self.stats           = collections.OrderedDict()
+
+    def command(self, name, *args, **kwargs):
+        if self.exec_dir:
+            cmd = [path.join(self.exec_dir, name)]
+        else:
+            cmd = [name]
+        for kwarg in kwargs:
+            arg = kwarg.replace('_', '-')
+            cmd.append('--'+arg)
+            if not isinstance(kwargs[kwarg], bool):
+                cmd.append(kwargs[kwarg])
+        cmd += args
+        return cmd
+
+    def record(self, name, elapsed, output_size):
+        with self.lock:
+            if name not in self.stats:
+                self.stats[name] = {'calls': 0, 'time': 0.0, 'bytes': 0}
+            self.stats[name]['calls'] += 1
+            self.stats[name]['time']  += elapsed
+            self.stats[name]['bytes'] += output_size
+
+    def stream(self, name, *args, **kwargs):
+        # generator that yields the output of the tool in chunks, as it is produced.
+        # the process occupies one of the slots until the generator is exhausted or closed,
+        # so the caller must not run other tools while iterating with max_concurrency=1
+        cmd = self.command(name, *args, **kwargs)
+        if self.debug:
+            print 'COMMAND: ', cmd
+        self.slots.acquire()
+        start = time.time()
+        output_size = 0
+        try:
+            process = Popen(cmd, stdout=PIPE)
+            try:
+                while True:
+                    chunk = process.stdout.read(BENTO4_STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    output_size += len(chunk)
+                    yield chunk
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+        finally:
+            self.slots.release()
+            self.record(name, time.time()-start, output_size)
+        if returncode:
+            message = "binary tool failed with error %d" % returncode
+            if self.verbose:
+                message += " - " + str(cmd)
+            raise Exception(message)
+
+    def run(self, name, *args, **kwargs):
+        return ''.join(self.stream(name, *args, **kwargs))
+
+    def map(self, function, items):
+        # call function on each item, up to max_concurrency at a time, and return
+        # the results in order. Calls are made inline when there is only one slot
+        if self.max_concurrency == 1 or len(items) < 2:
+            return map(function, items)
+        if self.pool is None:
+            self.pool = multiprocessing.pool.ThreadPool(self.max_concurrency)
+        return self.pool.map(function, items)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def format_stats(self):
+        lines = []
+        for (name, stats) in self.stats.iteritems():
+            lines.append('%s: %d calls, %.3f s, %d bytes' % (name, stats['calls'], stats['time'], stats['bytes']))
+        return lines
+
+def GetBento4Executor(options):
+    # one executor is shared by all the calls made with the same options
+    executor = getattr(options, 'bento4_executor', None)
+    if executor is None:
+        executor = Bento4Executor(options.exec_dir,
+                                  getattr(options, 'jobs', 1),
+                                  debug=options.debug,
+                                  verbose=options.verbose)
+        options.bento4_executor = executor
+    return executor
+
+def ReadProcessIoCounters():
+    # bytes read and written by this process so far, where the system provides them
+    try:
+        counters = dict([line.split(':') for line in open('/proc/self/io').read().splitlines()])
+        return (int(counters['rchar']), int(counters['wchar']))
+    except (IOError, KeyError, ValueError):
+        return (None, None)
+
+class Profiler:
+    # records wall time, CPU time (of this process and of the tools it ran), bytes read
+    # and written, and the number of tool runs for each phase of a run. Phases with
+    # the same name are added up, they can be nested and run in parallel threads, in
+    # which case the CPU time and byte counts (which are process-wide) overlap
+    def __init__(self, executor=None):
+        self.executor = executor
+        self.lock     = threading.Lock()
+        self.phases   = collections.OrderedDict()
+        self.start    = self.sample()
+
+    def sample(self):
+        # (resource usage has a better resolution than os.times(), where it is available)
+        if resource:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            tool_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            times = (usage.ru_utime, usage.ru_stime, tool_usage.ru_utime, tool_usage.ru_stime)
+        else:
+            times = os.times()
+        (bytes_read, bytes_written) = ReadProcessIoCounters()
+        tool_runs = 0
+        tool_output_bytes = 0
+        if self.executor is not None:
+            with self.executor.lock:
+                for stats in self.executor.stats.itervalues():
+                    tool_runs         += stats['calls']
+                    tool_output_bytes += stats['bytes']
+        return {'wall_time':         time.time(),
+                'cpu_time':          times[0]+times[1],
+                'tool_cpu_time':     times[2]+times[3],
+                'bytes_read':        bytes_read,
+                'bytes_written':     bytes_written,
+                'tool_runs':         tool_runs,
+                'tool_output_bytes': tool_output_bytes}
+
+    def difference(self, start, end):
+        result = {}
+        for (name, value) in end.iteritems():
+            if value is None or start[name] is None:
+                result[name] = None
+            else:
+                result[name] = value-start[name]
+        return result
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.sample()
+        try:
+            yield
+        finally:
+            delta = self.difference(start, self.sample())
+            with self.lock:
+                if name not in self.phases:
+                    self.phases[name] = dict([(counter, 0) for counter in delta])
+                    self.phases[name]['count'] = 0
+                phase = self.phases[name]
+                phase['count'] += 1
+                for (counter, value) in delta.iteritems():
+                    if value is None or phase[counter] is None:
+                        phase[counter] = None
+                    else:
+                        phase[counter] += value
+
+    def get_report(self):
+        with self.lock:
+            phases = [dict(phase, name=name) for (name, phase) in self.phases.iteritems()]
+        report = {'total': self.difference(self.start, self.sample()), 'phases': phases}
+        if self.executor is not None:
+            report['tools'] = self.executor.stats
+        return report
+
+    def format_report(self):
+        lines = []
+        for phase in self.get_report()['phases']:
+            lines.append('%-20s %4d x, %8.3f s wall, %8.3f s cpu, %8.3f s tool cpu, %3d tool run(s)' % (phase['name'], phase['count'], phase['wall_time'], phase['cpu_time'], phase['tool_cpu_time'], phase['tool_runs']))
+        return lines
+
+class NullProfilerPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+def ProfilePhase(options, name):
+    # times a phase if the options have a profiler
+    profiler = getattr(options, 'profiler', None)
+    if profiler is None:
+        return NullProfilerPhase()
+    return profiler.phase(name)
+
+def Bento4Command(options, name, *args, **kwargs):
+    return GetBento4Executor(options).run(name, *args, **kwargs)
+
+JSON_ARRAY_SEPARATORS = re.compile(r'[\s,\[\]]*')
+
+def DecodeJsonArray(chunks):
+    # decode a JSON array produced in chunks (like the output of mp4dump)
+    # one element at a time, keeping at most one incomplete element in memory.
+    # mp4dump closes each top-level object with a '}' at the start of a line,
+    # so decoding is only attempted when one of those has been received
+    decoder = json.JSONDecoder(strict=False, object_pairs_hook=collections.OrderedDict)
+    buffer = ''
+    position = 0
+    scan_position = 0
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is not None:
+            # drop what has already been decoded
+            buffer = buffer[position:]+chunk
+            scan_position -= position
+            position = 0
+        while True:
+            position = JSON_ARRAY_SEPARATORS.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            scan_position = max(scan_position, position)
+            end = buffer.find('\n}', scan_position)
+            if end < 0:
+                if chunk is not None:
+                    scan_position = max(position, len(buffer)-1)
+                    break
+                end = len(buffer)
+            else:
+                end += 2
+            try:
+                (element, position) = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if chunk is None and end == len(buffer):
+                    raise
+                scan_position = end
+                continue
+            yield element
+            scan_position = position
+        if chunk is None:
+            break
+
 def Mp4Info(options, filename, **args):
     return Bento4Command(options, 'mp4info', filename, **args)
 
+def GetMp4FileInfo(options, filename, bento4_lib=None):
+    if bento4_lib:
+        return bento4_lib.get_info(filename)
+    json_info = Mp4Info(options, filename, format='json', fast=True)
+    return json.loads(json_info, strict=False, object_pairs_hook=collections.OrderedDict)
+
 def Mp4Dump(options, filename, **args):
     return Bento4Command(options, 'mp4dump', filename, **args)
 
+def Mp4DumpBoxes(options, filename, **args):
+    # decode the JSON output of mp4dump top-level box by top-level box, while it is running
+    return DecodeJsonArray(GetBento4Executor(options).stream('mp4dump', filename, format='json', **args))
+
 def Mp4Split(options, filename, **args):
     return Bento4Command(options, 'mp4split', filename, **args)
 
@@ -120,6 +498,92 @@ def WalkAtoms(filename):
         
     return atoms
 
+def ScanAtoms(file, cursor):
+    # scan the top-level atoms of a file that may still be growing, from the
+    # cursor on. Only complete atoms are returned, with the position where
+    # the next scan should start
+    atoms = []
+    file.seek(0, os.SEEK_END)
+    file_size = file.tell()
+    while cursor+8 <= file_size:
+        file.seek(cursor)
+        (size, type) = struct.unpack('>I4s', file.read(8))
+        if size == 1:
+            if cursor+16 > file_size:
+                break
+            size = struct.unpack('>Q', file.read(8))[0]
+        if size < 8 or cursor+size > file_size:
+            break
+        atoms.append(Mp4Atom(type, size, cursor))
+        cursor += size
+    return (atoms, cursor)
+
+
+TRUN_FLAG_SAMPLE_DURATION_PRESENT = 0x100
+TRUN_SAMPLE_DURATION_PATTERN      = re.compile(r'(?:^|,)d:(\d+)')
+
+def HasTrunSampleDurations(filename, atoms):
+    # look for 'trun' boxes with per-sample durations in all the 'moof' atoms
+    file = io.FileIO(filename, "rb")
+    try:
+        for atom in atoms:
+            if atom.type != 'moof':
+                continue
+            file.seek(atom.position)
+            moof = file.read(atom.size)
+            moof_cursor = 8
+            while moof_cursor+8 <= len(moof):
+                (traf_size, traf_type) = struct.unpack('>I4s', moof[moof_cursor:moof_cursor+8])
+                if traf_size < 8:
+                    break
+                if traf_type == 'traf':
+                    traf_cursor = moof_cursor+8
+                    while traf_cursor+12 <= moof_cursor+traf_size:
+                        (size, type, version_and_flags) = struct.unpack('>I4sI', moof[traf_cursor:traf_cursor+12])
+                        if size < 8:
+                            break
+                        if type == 'trun' and version_and_flags & TRUN_FLAG_SAMPLE_DURATION_PRESENT:
+                            return True
+                        traf_cursor += size
+                moof_cursor += traf_size
+    finally:
+        file.close()
+    return False
+
+def ReadTfraEntries(filename, mfra_atom):
+    # parse the 'tfra' boxes of an 'mfra' atom, returning the entries for each track ID
+    file = io.FileIO(filename, "rb")
+    try:
+        file.seek(mfra_atom.position)
+        mfra = file.read(mfra_atom.size)
+    finally:
+        file.close()
+    entries = {}
+    cursor = 8
+    while cursor+8 <= len(mfra):
+        (size, type) = struct.unpack('>I4s', mfra[cursor:cursor+8])
+        if size < 8:
+            break
+        if type == 'tfra':
+            (version_and_flags, track_id, length_sizes, entry_count) = struct.unpack('>IIII', mfra[cursor+8:cursor+24])
+            if version_and_flags >> 24 == 1:
+                field_sizes = [8, 8]
+            else:
+                field_sizes = [4, 4]
+            field_sizes += [((length_sizes >> 4) & 3)+1, ((length_sizes >> 2) & 3)+1, (length_sizes & 3)+1]
+            track_entries = entries.setdefault(track_id, [])
+            entry_cursor = cursor+24
+            for i in xrange(entry_count):
+                fields = []
+                for field_size in field_sizes:
+                    value = 0
+                    for byte in mfra[entry_cursor:entry_cursor+field_size]:
+                        value = (value << 8) | ord(byte)
+                    fields.append(value)
+                    entry_cursor += field_size
+                track_entries.append(dict(zip(['time', 'moof_offset', 'traf_number', 'trun_number', 'sample_number'], fields)))
+        cursor += size
+    return entries
 
 def FilterChildren(parent, type):
     if isinstance(parent, list):
@@ -135,6 +599,24 @@ def FindChild(top, path):
         top = children[0]
     return top
 
+def SetTrackParameters(tracks, moov):
+    # compute default sample durations and timescales
+    for c1 in moov['children']:
+        if c1['name'] == 'mvex':
+            for c2 in c1['children']:
+                if c2['name'] == 'trex':
+                    tracks[c2['track id']].default_sample_duration = c2['default sample duration']
+        elif c1['name'] == 'trak':
+            track_id = 0
+            for c2 in c1['children']:
+                if c2['name'] == 'tkhd':
+                    track_id = c2['id']
+            for c2 in c1['children']:
+                if c2['name'] == 'mdia':
+                    for c3 in c2['children']:
+                        if c3['name'] == 'mdhd':
+                            tracks[track_id].timescale = c3['timescale']
+
 class Mp4Track:
     def __init__(self, parent, info):
         self.parent = parent
@@ -155,6 +637,7 @@ class Mp4Track:
         self.average_segment_bitrate  = 0
         self.max_segment_bitrate      = 0
         self.bandwidth                = 0
+        self.bandwidth_buffer_time    = None
         self.language                 = ''
         self.id = info['id']
         if info['type'] == 'Audio':
@@ -200,14 +683,65 @@ class Mp4Track:
         if len(self.segment_bitrates) > 1:
             self.max_segment_bitrate = max(self.segment_bitrates[:-1])            
         
-        # compute bandwidth
-        if options.min_buffer_time == 0.0:
-            options.min_buffer_time = self.average_segment_duration
-        self.bandwidth = ComputeBandwidth(options.min_buffer_time, self.segment_sizes, self.segment_durations)
+        # compute bandwidth (with the average segment duration as the buffer time
+        # if none is set, the packager recomputes it once it has chosen one)
+        self.compute_bandwidth(options.min_buffer_time or self.average_segment_duration)
+
+    def compute_bandwidth(self, min_buffer_time):
+        if min_buffer_time == self.bandwidth_buffer_time:
+            return
+        self.bandwidth = ComputeBandwidth(min_buffer_time, self.segment_sizes, self.segment_durations)
+        self.bandwidth_buffer_time = min_buffer_time
+
+    def add_fragment(self, segment_index, traf, has_sample_durations=False):
+        # add the samples and the duration of a fragment
+        self.moofs.append(segment_index)
+        tfhd = FilterChildren(traf, 'tfhd')[0]
+        segment_duration = 0
+        default_sample_duration = tfhd.get('default sample duration', self.default_sample_duration)
+        for trun in FilterChildren(traf, 'trun'):
+            sample_count = trun['sample count']
+            self.sample_counts.append(sample_count)
+            if 'sample durations' in trun:
+                # the in-process parser has already added up the sample durations
+                segment_duration += trun['sample durations']
+            elif has_sample_durations:
+                # add up all the 'd:' fields of the sample entries in one pass,
+                # samples without one use the default duration
+                sample_entries = ','.join([value for (name, value) in trun.iteritems() if name[0] in '0123456789'])
+                sample_durations = TRUN_SAMPLE_DURATION_PATTERN.findall(sample_entries)
+                segment_duration += sum(map(int, sample_durations))
+                segment_duration += (sample_count-len(sample_durations))*default_sample_duration
+            else:
+                segment_duration += sample_count*default_sample_duration
+        self.segment_scaled_durations.append(segment_duration)
+        self.segment_durations.append(float(segment_duration) / float(self.timescale))
+        return segment_duration
+
+    def add_fragment_size(self, segment_size):
+        # set the size of the last fragment, including its 'mdat' atom
+        segment_duration_sec = self.segment_durations[-1]
+        self.segment_sizes.append(segment_size)
+        if segment_duration_sec > 0.0:
+            segment_bitrate = int((8.0 * float(segment_size)) / segment_duration_sec)
+        else:
+            segment_bitrate = 0
+        self.segment_bitrates.append(segment_bitrate)
+
+    def get_segment_table(self):
+        # start times and durations of the segments, in seconds. The start times
+        # are computed from the running total of the scaled durations, so they
+        # do not accumulate rounding errors
+        timescale   = float(self.timescale)
+        scaled_time = 0
+        start_times = []
+        for scaled_duration in self.segment_scaled_durations:
+            start_times.append(scaled_time/timescale)
+            scaled_time += scaled_duration
+        return (start_times, self.segment_durations)
 
     def compute_kid(self):
-        moov = FilterChildren(self.parent.tree, 'moov')[0]
-        traks = FilterChildren(moov, 'trak')
+        traks = FilterChildren(self.parent.moov, 'trak')
         for trak in traks:
             tkhd = FindChild(trak, ['tkhd'])
             tenc = FindChild(trak, ('mdia', 'minf', 'stbl', 'stsd', 'encv', 'sinf', 'schi', 'tenc'))
@@ -219,6 +753,19 @@ class Mp4Track:
     def __repr__(self):
         return 'File '+str(self.parent.index)+'#'+str(self.id)
     
+# the atoms of a file are contiguous, so the byte range of a segment goes from
+# its first atom to the end of its last one. The ranges are kept in arrays when
+# their items hold 64-bit offsets, in lists of (long) ints otherwise
+def ComputeSegmentRanges(segments):
+    offsets = [segment[0].position for segment in segments]
+    lengths = [segment[-1].position+segment[-1].size-segment[0].position for segment in segments]
+    if array.array('L').itemsize >= 8:
+        return (array.array('L', offsets), array.array('L', lengths))
+    return (offsets, lengths)
+
+# bumped when Mp4File gets new fields, so that analyses saved by older versions are redone
+MP4_FILE_ANALYSIS_VERSION = 2
+
 class Mp4File:
     def __init__(self, options, filename):
         self.filename = filename
@@ -231,7 +778,8 @@ class Mp4File:
         self.media_name = os.path.basename(filename)
 
         # walk the atom structure
-        self.atoms = WalkAtoms(filename)
+        with ProfilePhase(options, 'parse.walk_atoms'):
+            self.atoms = WalkAtoms(filename)
         self.segments = []
         for atom in self.atoms:
             if atom.type == 'moov':
@@ -244,130 +792,103 @@ class Mp4File:
         #print self.segments
         if options.debug:
             print '  found', len(self.segments), 'segments'
+        self.analysis_version = MP4_FILE_ANALYSIS_VERSION
+        (self.segment_offsets, self.segment_lengths) = ComputeSegmentRanges(self.segments)
                         
+        # use the Bento4 library in-process if we can, the command line tools otherwise
+        bento4_lib = None
+        if options.use_bento4_lib:
+            bento4_lib = LoadBento4Lib(options)
+
         # get the mp4 file info
-        json_info = Mp4Info(options, filename, format='json', fast=True)
-        self.info = json.loads(json_info, strict=False, object_pairs_hook=collections.OrderedDict)
+        with ProfilePhase(options, 'parse.info'):
+            self.info = GetMp4FileInfo(options, filename, bento4_lib)
 
         for track in self.info['tracks']:
             self.tracks[track['id']] = Mp4Track(self, track)
 
-        # get a complete file dump
-        json_dump = Mp4Dump(options, filename, format='json', verbosity='1')
-        #print json_dump
-        self.tree = json.loads(json_dump, strict=False, object_pairs_hook=collections.OrderedDict)
-        
+        # get a dump of the file (sample-level details are only needed
+        # when the 'trun' boxes carry individual sample durations)
+        if bento4_lib:
+            self.has_sample_durations = False
+            boxes = bento4_lib.iterate_fragments(filename)
+        else:
+            self.has_sample_durations = HasTrunSampleDurations(filename, self.atoms)
+            if self.has_sample_durations:
+                verbosity = '1'
+            else:
+                verbosity = '0'
+            boxes = Mp4DumpBoxes(options, filename, verbosity=verbosity)
+
+        # go through the dump one top-level box at a time, as it is decoded
+        # (so this is also where the dump is produced). only the 'moov' box
+        # is kept, the fragments are reduced to their totals and dropped right away
+        with ProfilePhase(options, 'parse.fragments'):
+            self.moov = None
+            segment_index = 0
+            track = None
+            segment_size = 0
+            for atom in boxes:
+                segment_size += atom['size']
+                if atom['name'] == 'moov':
+                    self.moov = atom
+                    SetTrackParameters(self.tracks, atom)
+
+                elif atom['name'] == 'moof':
+                    trafs = FilterChildren(atom, 'traf')
+                    if len(trafs) != 1:
+                        raise PackagingError('ERROR: unsupported input file, more than one "traf" box in fragment')
+                    tfhd = FilterChildren(trafs[0], 'tfhd')[0]
+                    track = self.tracks[tfhd['track ID']]
+                    track.add_fragment(segment_index, trafs[0], self.has_sample_durations)
+                    segment_index += 1
+
+                elif atom['name'] == 'mdat':
+                    # end of fragment on 'mdat' atom
+                    if track:
+                        track.add_fragment_size(segment_size)
+                    segment_size = 0
+
         # look for KIDs
         for track in self.tracks.itervalues():
             track.compute_kid()
-                
-        # compute default sample durations and timescales
-        for atom in self.tree:
-            if atom['name'] == 'moov':
-                for c1 in atom['children']:
-                    if c1['name'] == 'mvex':
-                        for c2 in c1['children']:
-                            if c2['name'] == 'trex':
-                                self.tracks[c2['track id']].default_sample_duration = c2['default sample duration']
-                    elif c1['name'] == 'trak':
-                        track_id = 0
-                        for c2 in c1['children']:
-                            if c2['name'] == 'tkhd':
-                                track_id = c2['id']
-                        for c2 in c1['children']:
-                            if c2['name'] == 'mdia':
-                                for c3 in c2['children']:
-                                    if c3['name'] == 'mdhd':
-                                        self.tracks[track_id].timescale = c3['timescale']
-
-        # partition the segments
-        segment_index = 0
-        track = None
-        segment_size = 0
-        segment_duration_sec = 0.0
-        for atom in self.tree:
-            segment_size += atom['size']
-            if atom['name'] == 'moof':
-                trafs = FilterChildren(atom, 'traf')
-                if len(trafs) != 1:
-                    PrintErrorAndExit('ERROR: unsupported input file, more than one "traf" box in fragment')
-                tfhd = FilterChildren(trafs[0], 'tfhd')[0]
-                track = self.tracks[tfhd['track ID']]
-                track.moofs.append(segment_index)
-                segment_duration = 0
-                default_sample_duration = tfhd.get('default sample duration', track.default_sample_duration)
-                for trun in FilterChildren(trafs[0], 'trun'):
-                    track.sample_counts.append(trun['sample count'])
-                    for (name, value) in trun.items():
-                        if name[0] in '0123456789':
-                            sample_duration = -1
-                            fields = value.split(',')
-                            for field in fields:
-                                if field.startswith('d:'):
-                                    sample_duration = int(field[2:])
-                            if sample_duration == -1:
-                                sample_duration = default_sample_duration
-                            segment_duration += sample_duration
-                track.segment_scaled_durations.append(segment_duration)
-                segment_duration_sec = float(segment_duration) / float(track.timescale)
-                track.segment_durations.append(segment_duration_sec)
-                segment_index += 1
-
-                # remove the 'trun' entries to save some memory
-                for traf in trafs:
-                    traf['children'] = [x for x in traf['children'] if x['name'] != 'trun']
-
-            elif atom['name'] == 'mdat':
-                # end of fragment on 'mdat' atom
-                if track:
-                    track.segment_sizes.append(segment_size)
-                    if segment_duration_sec > 0.0:
-                        segment_bitrate = int((8.0 * float(segment_size)) / segment_duration_sec)
-                    else:
-                        segment_bitrate = 0
-                    track.segment_bitrates.append(segment_bitrate)
-                segment_size = 0
                                                 
         # parse the 'mfra' index if there is one and update segment durations.
         # this is needed to deal with input files that have an 'mfra' index that
         # does not exactly match the sample durations (because of rounding errors),
         # which will make the Smooth Streaming URL mapping fail since the IIS Smooth Streaming
         # server uses the 'mfra' index to locate the segments in the source .ismv file
-        mfra = FindChild(self.tree, ['mfra'])
-        if mfra:
-            for tfra in FilterChildren(mfra, 'tfra'):
-                track_id = tfra['track_ID']
-                if track_id not in self.tracks:
-                    continue
-                track = self.tracks[track_id]
-                moof_pointers = []
-                for (name, value) in tfra.items():
-                    if name.startswith('['):
-                        attributes = value.split(',')
-                        attribute_dict = {}
-                        for attribute in attributes:
-                            (attribute_name, attribute_value) = attribute.strip().split('=')
-                            attribute_dict[attribute_name] = int(attribute_value)
+        # (the 'tfra' entries are read directly from the file, since they are
+        # not included in a dump with verbosity 0)
+        with ProfilePhase(options, 'parse.mfra'):
+            for mfra in [atom for atom in self.atoms if atom.type == 'mfra']:
+                for (track_id, tfra_entries) in ReadTfraEntries(filename, mfra).iteritems():
+                    if track_id not in self.tracks:
+                        continue
+                    track = self.tracks[track_id]
+                    moof_pointers = []
+                    for attribute_dict in tfra_entries:
                         if attribute_dict['traf_number'] == 1 and attribute_dict['trun_number'] == 1 and attribute_dict['sample_number'] == 1:
                             # this points to the first sample of the first trun of the first traf, use it as a start time indication
                             moof_pointers.append(attribute_dict)
-                if len(moof_pointers) > 1:
-                    for i in range(len(moof_pointers)-1):
-                        if i+1 >= len(track.moofs):
-                            break
+                    if len(moof_pointers) > 1:
+                        for i in range(len(moof_pointers)-1):
+                            if i+1 >= len(track.moofs):
+                                break
 
-                        moof1 = self.segments[track.moofs[i]][0]
-                        moof2 = self.segments[track.moofs[i+1]][0]
-                        if moof1.position == moof_pointers[i]['moof_offset'] and moof2.position == moof_pointers[i+1]['moof_offset']:
-                            # pointers match two consecutive moofs
-                            moof_duration = moof_pointers[i+1]['time'] - moof_pointers[i]['time']
-                            moof_duration_sec = float(moof_duration) / float(track.timescale)
-                            track.segment_durations[i] = moof_duration_sec
-                            track.segment_scaled_durations[i] = moof_duration
+                            moof1 = self.segments[track.moofs[i]][0]
+                            moof2 = self.segments[track.moofs[i+1]][0]
+                            if moof1.position == moof_pointers[i]['moof_offset'] and moof2.position == moof_pointers[i+1]['moof_offset']:
+                                # pointers match two consecutive moofs
+                                moof_duration = moof_pointers[i+1]['time'] - moof_pointers[i]['time']
+                                moof_duration_sec = float(moof_duration) / float(track.timescale)
+                                track.segment_durations[i] = moof_duration_sec
+                                track.segment_scaled_durations[i] = moof_duration
 
         # compute the total numer of samples for each track
-        for track_id in self.tracks:
-            self.tracks[track_id].update(options)
+        with ProfilePhase(options, 'parse.update'):
+            for track_id in self.tracks:
+                self.tracks[track_id].update(options)
                                                    
         # print debug info if requested
         if options.debug:
@@ -390,7 +911,361 @@ class Mp4File:
 
     def find_tracks_by_type(self, track_type_to_find):
         return [track for track in self.tracks.values() if track_type_to_find == '' or track_type_to_find == track.type]
-            
+
+MP4_FILE_CACHE_MAX_ENTRIES = 64
+
+class Mp4FileCache:
+    # keeps the analysis of the media files used by several titles packaged in the
+    # same process. Callers get their own copy, since the packager modifies it
+    def __init__(self, max_entries=MP4_FILE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries     = collections.OrderedDict()
+        self.lock        = threading.Lock()
+        self.hits        = 0
+        self.misses      = 0
+
+    def get_file(self, options, filename):
+        stat = os.stat(filename)
+        cache_key = (path.abspath(filename), stat.st_size, stat.st_mtime)
+        with self.lock:
+            entry = self.entries.pop(cache_key, None)
+            if entry is not None:
+                self.entries[cache_key] = entry
+                self.hits += 1
+        if entry is None:
+            entry = Mp4File(options, filename)
+            with self.lock:
+                self.misses += 1
+                self.entries[cache_key] = entry
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        mp4_file = copy.deepcopy(entry)
+        mp4_file.filename = filename
+        return mp4_file
+
+def ComputeFileDigest(filename):
+    digest = hashlib.sha1()
+    file = open(filename, 'rb')
+    try:
+        while True:
+            chunk = file.read(BENTO4_STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        file.close()
+    return digest.hexdigest()
+
+PACKAGING_STATE_FILENAME    = '.mp4-dash-state.json'
+PACKAGING_ANALYSIS_FILENAME = '.mp4-dash-analysis.pickle'
+
+class PackagingState:
+    # what the previous runs of the packager left in an output directory: the
+    # fingerprints of the inputs, their analysis, and the files output by each
+    # job (a split or a copy), so that a new run can skip the jobs that would
+    # output the same files again
+    def __init__(self, output_dir):
+        self.output_dir        = output_dir
+        self.filename          = path.join(output_dir, PACKAGING_STATE_FILENAME)
+        self.analysis_filename = path.join(output_dir, PACKAGING_ANALYSIS_FILENAME)
+        self.lock              = threading.Lock()
+        self.inputs            = {}
+        self.outputs           = {}
+        self.analysis          = {}
+        self.used_digests      = set()
+        if path.exists(self.filename):
+            try:
+                state = json.load(open(self.filename))
+                self.inputs  = state['inputs']
+                self.outputs = state['outputs']
+                self.analysis = cPickle.load(open(self.analysis_filename, 'rb'))
+            except Exception, e:
+                sys.stderr.write('WARNING: ignoring the packaging state in ' + output_dir + ' (' + str(e) + ')\n')
+                self.inputs   = {}
+                self.outputs  = {}
+                self.analysis = {}
+
+    def get_digest(self, filename):
+        # the digest of the content is only recomputed when the size or the modification time changed
+        stat = os.stat(filename)
+        key = path.abspath(filename)
+        with self.lock:
+            entry = self.inputs.get(key)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': ComputeFileDigest(filename)}
+            with self.lock:
+                self.inputs[key] = entry
+        with self.lock:
+            self.used_digests.add(entry['digest'])
+        return entry['digest']
+
+    def get_file(self, options, filename):
+        # the analysis of a file, from a previous run if the file has not changed
+        digest = self.get_digest(filename)
+        with self.lock:
+            entry = self.analysis.get(digest)
+        if entry is None or getattr(entry, 'analysis_version', 1) != MP4_FILE_ANALYSIS_VERSION:
+            entry = Mp4File(options, filename)
+            with self.lock:
+                self.analysis[digest] = entry
+        mp4_file = copy.deepcopy(entry)
+        mp4_file.filename = filename
+        return mp4_file
+
+    def get_file_status(self, filename):
+        stat = os.stat(path.join(self.output_dir, filename))
+        return [stat.st_size, stat.st_mtime]
+
+    def is_output_current(self, key, signature, filenames):
+        # true if the job was run with the same signature and its files have not changed since
+        output = self.outputs.get(key)
+        if output is None or output['signature'] != signature or sorted(output['files']) != sorted(filenames):
+            return False
+        for filename in filenames:
+            if not path.exists(path.join(self.output_dir, filename)) or self.get_file_status(filename) != output['files'][filename]:
+                return False
+        return True
+
+    def set_output(self, key, signature, filenames):
+        # record the files output by a job, and return the ones
+        # it output in the previous run that it no longer outputs
+        stale_files = []
+        if key in self.outputs:
+            stale_files = [filename for filename in self.outputs[key]['files'] if filename not in filenames]
+        self.outputs[key] = {'signature': signature,
+                             'files':     dict([(filename, self.get_file_status(filename)) for filename in filenames])}
+        return stale_files
+
+    def remove_outputs(self, keys_to_keep):
+        # forget the jobs that are gone, and return the files they had output
+        stale_files = []
+        for key in self.outputs.keys():
+            if key not in keys_to_keep:
+                stale_files += self.outputs.pop(key)['files'].keys()
+        return stale_files
+
+    def save(self):
+        # only keep the analysis of the files used by this run
+        self.analysis = dict([(digest, entry) for (digest, entry) in self.analysis.iteritems() if digest in self.used_digests])
+        self.inputs = dict([(key, entry) for (key, entry) in self.inputs.iteritems() if entry['digest'] in self.used_digests])
+        WriteFileAtomically(self.analysis_filename, cPickle.dumps(self.analysis, cPickle.HIGHEST_PROTOCOL))
+        WriteFileAtomically(self.filename, json.dumps({'inputs': self.inputs, 'outputs': self.outputs}, indent=2, separators=(',', ': '), sort_keys=True))
+
+class SegmentStore:
+    # content-addressed store for output files, shared by titles: each file is stored
+    # once, under the SHA-1 of its content, and hardlinked into the output directories.
+    # A job (a split) that was already run on the same input with the same arguments
+    # is not run again, its files are linked from the store instead
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.lock      = threading.Lock()
+        self.digests   = {}
+        self.stats     = collections.OrderedDict([('jobs_run', 0), ('jobs_reused', 0),
+                                                  ('files_stored', 0), ('files_deduplicated', 0), ('files_reused', 0),
+                                                  ('bytes_stored', 0), ('bytes_deduplicated', 0), ('bytes_reused', 0),
+                                                  ('write_time', 0.0), ('write_time_saved', 0.0)])
+        MakeNewDir(store_dir)
+        MakeNewDir(path.join(store_dir, 'objects'))
+        MakeNewDir(path.join(store_dir, 'jobs'))
+
+    def count(self, name, value):
+        with self.lock:
+            self.stats[name] += value
+
+    def get_digest(self, filename):
+        # digest of an input, computed once per version of the file
+        stat = os.stat(filename)
+        key = (path.abspath(filename), stat.st_size, stat.st_mtime)
+        with self.lock:
+            digest = self.digests.get(key)
+        if digest is None:
+            digest = ComputeFileDigest(filename)
+            with self.lock:
+                self.digests[key] = digest
+        return digest
+
+    def get_object_filename(self, digest):
+        return path.join(self.store_dir, 'objects', digest[:2], digest)
+
+    def get_job_filename(self, signature):
+        return path.join(self.store_dir, 'jobs', signature+'.json')
+
+    def link(self, source, destination):
+        if path.exists(destination):
+            os.unlink(destination)
+        os.link(source, destination)
+
+    def add_file(self, filename):
+        # move a new file to the store, or replace it with a link to the identical file already there
+        digest = ComputeFileDigest(filename)
+        object_filename = self.get_object_filename(digest)
+        size = os.path.getsize(filename)
+        with self.lock:
+            if path.exists(object_filename):
+                deduplicated = True
+            else:
+                deduplicated = False
+                MakeNewDir(path.dirname(object_filename))
+                os.link(filename, object_filename)
+                # the stored files must not be modified through one of their links
+                os.chmod(object_filename, 0444)
+        if deduplicated:
+            self.link(object_filename, filename)
+            self.count('files_deduplicated', 1)
+            self.count('bytes_deduplicated', size)
+        else:
+            self.count('files_stored', 1)
+            self.count('bytes_stored', size)
+        return digest
+
+    def run_job(self, signature, output_dir, filenames, function):
+        # link the files of the job if it has been run before, or run it and
+        # add its files to the store. The file names are relative to output_dir
+        job = None
+        job_filename = self.get_job_filename(signature)
+        if path.exists(job_filename):
+            job = json.load(open(job_filename))
+            if sorted(job['files']) != sorted(filenames) or not all([path.exists(self.get_object_filename(digest)) for digest in job['files'].values()]):
+                job = None
+        if job is not None:
+            for filename in filenames:
+                object_filename = self.get_object_filename(job['files'][filename])
+                self.link(object_filename, path.join(output_dir, filename))
+                self.count('files_reused', 1)
+                self.count('bytes_reused', os.path.getsize(object_filename))
+            self.count('jobs_reused', 1)
+            self.count('write_time_saved', job['time'])
+            return
+
+        # the outputs may be links to stored files, which must not be overwritten
+        for filename in filenames:
+            if path.exists(path.join(output_dir, filename)):
+                os.unlink(path.join(output_dir, filename))
+        start_time = time.time()
+        function()
+        elapsed = time.time()-start_time
+        job = {'files': dict([(filename, self.add_file(path.join(output_dir, filename))) for filename in filenames]),
+               'time':  elapsed}
+        WriteFileAtomically(job_filename, json.dumps(job, indent=2, separators=(',', ': '), sort_keys=True))
+        self.count('jobs_run', 1)
+        self.count('write_time', elapsed)
+
+    def format_stats(self):
+        stats = self.stats
+        bytes_saved = stats['bytes_deduplicated']+stats['bytes_reused']
+        return ['%d job(s) run, %d reused from the store' % (stats['jobs_run'], stats['jobs_reused']),
+                '%d file(s) stored (%d bytes), %d deduplicated (%d bytes), %d reused (%d bytes)' % (stats['files_stored'], stats['bytes_stored'], stats['files_deduplicated'], stats['bytes_deduplicated'], stats['files_reused'], stats['bytes_reused']),
+                '%d bytes saved, %.3f s spent writing, %.3f s saved' % (bytes_saved, stats['write_time'], stats['write_time_saved'])]
+
+class LiveSegmentTimeline:
+    # runs of equal segment durations of a live track, updated as segments are
+    # appended and as they slide out of the time shift window. Times are in
+    # the timescale of the track
+    def __init__(self, start_time):
+        self.start_number = 0
+        self.start_time   = start_time
+        self.end_time     = start_time
+        self.runs         = collections.deque()
+
+    def append(self, duration):
+        if self.runs and self.runs[-1][0] == duration:
+            self.runs[-1][1] += 1
+        else:
+            self.runs.append([duration, 1])
+        self.end_time += duration
+
+    def trim(self, max_duration):
+        # drop the oldest segments, as long as the ones left still cover max_duration
+        while self.runs and self.end_time-self.start_time-self.runs[0][0] >= max_duration:
+            self.start_number += 1
+            self.start_time   += self.runs[0][0]
+            self.runs[0][1]   -= 1
+            if self.runs[0][1] == 0:
+                self.runs.popleft()
+
+class Mp4LiveFile(Mp4File):
+    # fragmented MP4 file that is still being written. Each call to update() only
+    # reads the atoms appended since the previous one, from the offset where that
+    # scan stopped, so the cost of an update depends on the size of the new
+    # fragments, not on the size of the file
+    def __init__(self, options, filename):
+        self.filename     = filename
+        self.media_name   = os.path.basename(filename)
+        self.tracks       = {}
+        self.info         = None
+        self.moov         = None
+        self.init_segment = None
+        self.segments     = []
+        self.cursor       = 0
+        self.moof         = None
+        self.ended        = False
+
+    def read(self, position, size):
+        file = io.FileIO(self.filename, 'rb')
+        try:
+            file.seek(position)
+            return file.read(size)
+        finally:
+            file.close()
+
+    def read_init_segment(self):
+        # everything up to the end of the 'moov' atom
+        return self.read(0, self.init_segment.position+self.init_segment.size)
+
+    def read_segment(self, segment_index):
+        segment = self.segments[segment_index]
+        return self.read(segment[0].position, segment[-1].position+segment[-1].size-segment[0].position)
+
+    def update(self, options):
+        # read the atoms completed since the last update, and return
+        # the indexes of the new segments
+        file = io.FileIO(self.filename, 'rb')
+        try:
+            (atoms, self.cursor) = ScanAtoms(file, self.cursor)
+        finally:
+            file.close()
+
+        new_segments = []
+        for atom in atoms:
+            if atom.type == 'moov':
+                self.init_segment = atom
+                self.moov = ParseBox(self.read(atom.position, atom.size), 0)
+                self.info = GetMp4FileInfo(options, self.filename, LoadBento4Lib(options) if options.use_bento4_lib else None)
+                for track_info in self.info['tracks']:
+                    self.tracks[track_info['id']] = Mp4Track(self, track_info)
+                SetTrackParameters(self.tracks, self.moov)
+                for track in self.tracks.itervalues():
+                    track.timeline = None
+                    track.compute_kid()
+            elif atom.type == 'moof':
+                if self.moov is None:
+                    raise PackagingError('ERROR: fragment found before the "moov" atom in '+self.filename)
+                self.moof = (atom, ParseBox(self.read(atom.position, atom.size), 0))
+            elif atom.type == 'mdat' and self.moof:
+                # end of fragment on 'mdat' atom
+                (moof_atom, moof) = self.moof
+                self.moof = None
+                trafs = FilterChildren(moof, 'traf')
+                if len(trafs) != 1:
+                    raise PackagingError('ERROR: unsupported input file, more than one "traf" box in fragment')
+                tfhd = FilterChildren(trafs[0], 'tfhd')[0]
+                track = self.tracks[tfhd['track ID']]
+                segment_index = len(self.segments)
+                self.segments.append([moof_atom, atom])
+                segment_duration = track.add_fragment(segment_index, trafs[0])
+                track.add_fragment_size(moof_atom.size+atom.size)
+                if track.timeline is None:
+                    tfdt = FindChild(trafs[0], ['tfdt'])
+                    track.timeline = LiveSegmentTimeline(tfdt['base media decode time'] if tfdt else 0)
+                track.timeline.append(segment_duration)
+                new_segments.append(segment_index)
+            elif atom.type == 'mfra':
+                self.ended = True
+
+        if options.debug and new_segments:
+            print '  found', len(new_segments), 'new segment(s) in', self.filename
+        return new_segments
+
 class MediaSource:
     def __init__(self, name):
         self.name = name
@@ -433,6 +1308,94 @@ def ComputeBandwidth(buffer_time, sizes, durations):
                 break
     return int(bandwidth)
     
+def FindFirstMismatch(a, b, tolerance=0):
+    # returns the index of the first entry that differs between the two sequences, or -1
+    if tolerance == 0 and a == b:
+        return -1
+    for (i, (x, y)) in enumerate(itertools.izip(a, b)):
+        if abs(x-y) > tolerance:
+            return i
+    return -1
+
+def ValidateTracks(audio_tracks, video_tracks, check_durations=True):
+    # checks that the video tracks are aligned with each other and that segment
+    # durations are regular enough, and returns the results as a report object.
+    # The errors and warnings are printed by the packager, the notices are only
+    # in the report
+    report = {'aligned': True, 'errors': [], 'warnings': [], 'notices': [], 'tracks': []}
+    tables = {}
+    for track in video_tracks+audio_tracks:
+        tables[track] = track.get_segment_table()
+        report['tracks'].append({'track':                    str(track),
+                                 'type':                     track.type,
+                                 'segment_count':            len(track.segment_durations),
+                                 'sample_count':             track.total_sample_count,
+                                 'average_segment_duration': track.average_segment_duration})
+
+    # check that the video tracks match the first one, ignoring the last trun,
+    # then compare the segment start times
+    if video_tracks:
+        reference = video_tracks[0]
+        (ref_start_times, ref_durations) = tables[reference]
+        prev_track = None
+        for track in video_tracks:
+            if prev_track and track.total_sample_count != prev_track.total_sample_count:
+                report['warnings'].append({'check':     'sample_count',
+                                           'track':     str(track),
+                                           'reference': str(prev_track),
+                                           'message':   'video sample count mismatch between "'+str(track)+'" and "'+str(prev_track)+'"'})
+            prev_track = track
+            if track is reference:
+                continue
+            index = FindFirstMismatch(track.sample_counts[:-1], reference.sample_counts[:-1])
+            if index < 0 and len(track.sample_counts) != len(reference.sample_counts):
+                index = min(len(track.sample_counts), len(reference.sample_counts))-1
+            if index >= 0:
+                # the index is the one of a trun, which is the one of the fragment
+                # when each fragment has a single trun
+                time = None
+                if len(reference.sample_counts) == len(ref_start_times) and index < len(ref_start_times):
+                    time = ref_start_times[index]
+                report['aligned'] = False
+                report['errors'].append({'check':     'alignment',
+                                         'track':     str(track),
+                                         'reference': str(reference),
+                                         'fragment':  index,
+                                         'time':      time,
+                                         'message':   'video tracks are not aligned ("'+str(track)+'" differs)'})
+                continue
+            (start_times, durations) = tables[track]
+            index = FindFirstMismatch(start_times, ref_start_times, 0.001)
+            if index >= 0:
+                report['notices'].append({'check':     'start_time',
+                                           'track':     str(track),
+                                           'reference': str(reference),
+                                           'fragment':  index,
+                                           'time':      ref_start_times[index],
+                                           'message':   'video segment start times for "'+str(track)+'" differ from "'+str(reference)+'" at fragment '+str(index)})
+
+    # check that the segment durations are almost all equal (within 10%)
+    if check_durations:
+        for track in video_tracks+audio_tracks:
+            (start_times, durations) = tables[track]
+            durations = durations[:-2]
+            if not durations:
+                continue
+            min_duration = 0.9*track.average_segment_duration
+            max_duration = 1.1*track.average_segment_duration
+            if min(durations) >= min_duration and max(durations) <= max_duration:
+                continue
+            for (index, duration) in enumerate(durations):
+                if duration < min_duration or duration > max_duration:
+                    break
+            report['warnings'].append({'check':    'duration_variance',
+                                       'track':    str(track),
+                                       'fragment': index,
+                                       'time':     start_times[index],
+                                       'message':  track.type+' segment durations for "'+str(track)+'" vary by more than 10% (consider using --use-segment-timeline)'})
+
+    return report
+
 def MakeNewDir(dir, exit_if_exists=False, severity=None):
     if os.path.exists(dir):
         if severity:
@@ -548,4 +1511,18 @@ def ComputePlayReadyHeader(header_spec, kid_hex, key_hex):
         header_xml += '</DATA></WRMHEADER>'
         return WrapPlayreadyHeaderXml(header_xml)
 
-    return ""
\ No newline at end of file
+    return ""
+
+class PlayReadyHeaderCache:
+    def __init__(self):
+        self.headers = {}
+        self.lock    = threading.Lock()
+
+    def get_header(self, header_spec, kid_hex, key_hex):
+        # the header only depends on the spec, the KID and the key, so
+        # it is computed once per run and shared by all the outputs
+        cache_key = (header_spec, kid_hex, key_hex)
+        with self.lock:
+            if cache_key not in self.headers:
+                self.headers[cache_key] = ComputePlayReadyHeader(header_spec, kid_hex, key_hex)
+            return self.headers[cache_key]